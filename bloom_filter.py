@@ -0,0 +1,112 @@
+import math
+import mmap
+import os
+import struct
+
+BLOOM_FILTER_FILE = "bloom"
+BLOOM_MAGIC = "BLM1"
+# magic, number of hash functions, number of bits, number of keys added
+BLOOM_HEADER = struct.Struct('<4sIQQ')
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+
+def bloom_filter_path(leveldb_path):
+    return os.path.join(leveldb_path, BLOOM_FILTER_FILE)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over 64 bit zobrist hashes.
+
+    Zobrist hashes are already uniformly distributed, so the k bit positions
+    are derived from the two halves of the hash by double hashing instead of
+    hashing the key again.
+    """
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(num_hashes, 1)
+        if bits is None:
+            bits = bytearray((self.num_bits + 7) / 8)
+        self.bits = bits
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        """Sizes a filter for capacity keys at the given false positive rate"""
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        num_hashes = int(round(float(num_bits) / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def positions(self, key):
+        key = int(key)
+        h1 = key & 0xffffffff
+        h2 = (key >> 32) | 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for bit in self.positions(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for bit in self.positions(key):
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        # Written to a temporary file first, so readers never see a partial filter
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.num_hashes, self.num_bits, self.count))
+            f.write(self.bits)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def add_to_file(cls, path, keys):
+        """
+        Sets the bits of keys in a filter saved with save, in place through a
+        memory map, so adding the positions of a game does not read or
+        rewrite the whole filter. Returns False if there is no filter.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path, "r+b") as f:
+            header = f.read(BLOOM_HEADER.size)
+            if len(header) < BLOOM_HEADER.size:
+                return False
+            magic, num_hashes, num_bits, count = BLOOM_HEADER.unpack(header)
+            if magic != BLOOM_MAGIC:
+                return False
+            # Only used for the bit positions, the bits stay in the file
+            bloom_filter = cls(num_bits, num_hashes, bytearray(), count)
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                for key in keys:
+                    for bit in bloom_filter.positions(key):
+                        i = BLOOM_HEADER.size + (bit >> 3)
+                        data[i] = chr(ord(data[i]) | 1 << (bit & 7))
+                    bloom_filter.count += 1
+                data[:BLOOM_HEADER.size] = BLOOM_HEADER.pack(magic, num_hashes, num_bits, bloom_filter.count)
+                data.flush()
+            finally:
+                data.close()
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """Loads a filter saved with save, returns None if there is none"""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            header = f.read(BLOOM_HEADER.size)
+            if len(header) < BLOOM_HEADER.size:
+                return None
+            magic, num_hashes, num_bits, count = BLOOM_HEADER.unpack(header)
+            if magic != BLOOM_MAGIC:
+                return None
+            bits = bytearray(f.read())
+        return cls(num_bits, num_hashes, bits, count)
@@ -0,0 +1,296 @@
+import bisect
+import bz2
+import gzip
+import os
+import struct
+import zlib
+
+SEEK_POINTS_FILE = "seek_points"
+# Compressed and uncompressed byte offset of every seek point, as little endian uint64 pairs
+SEEK_POINT = struct.Struct('<QQ')
+# Uncompressed bytes between two recorded seek points
+SEEK_POINT_SPACING = 1 << 20
+# Uncompressed bytes per member written by compress_pgn
+MEMBER_SIZE = 1 << 20
+READ_BLOCK_SIZE = 1 << 16
+
+GZIP = "gzip"
+BZIP2 = "bz2"
+MAGIC_BYTES = [("\x1f\x8b", GZIP), ("BZh", BZIP2)]
+
+
+def seek_points_path(leveldb_path):
+    return os.path.join(leveldb_path, SEEK_POINTS_FILE)
+
+
+def compression(path):
+    """Returns GZIP or BZIP2 for a compressed file, going by its magic bytes, None otherwise"""
+    with open(path, "rb") as f:
+        magic = f.read(3)
+    for prefix, kind in MAGIC_BYTES:
+        if magic.startswith(prefix):
+            return kind
+    return None
+
+
+def new_decompressor(kind):
+    if kind == GZIP:
+        # Skips the gzip header and checks the trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+
+def read_seek_points(leveldb_path):
+    """The seek points of the PGN file of an index, None if the index has none"""
+    path = seek_points_path(leveldb_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    values = struct.unpack("<{0}Q".format(len(data) / 8), data)
+    return zip(values[::2], values[1::2])
+
+
+def read_last_seek_point(leveldb_path):
+    """The last seek point of the PGN file of an index, read without the others, None if the index has none"""
+    path = seek_points_path(leveldb_path)
+    if not os.path.exists(path) or os.path.getsize(path) < SEEK_POINT.size:
+        return None
+    with open(path, "rb") as f:
+        f.seek(-SEEK_POINT.size, os.SEEK_END)
+        return SEEK_POINT.unpack(f.read(SEEK_POINT.size))
+
+
+def append_seek_point(leveldb_path, seek_point):
+    with open(seek_points_path(leveldb_path), "ab") as f:
+        f.write(SEEK_POINT.pack(*seek_point))
+
+
+def write_seek_points(leveldb_path, seek_points):
+    values = [v for point in seek_points for v in point]
+    with open(seek_points_path(leveldb_path), "wb") as f:
+        f.write(struct.pack("<{0}Q".format(len(values)), *values))
+
+
+def open_pgn(path, seek_points=None):
+    """
+    Opens a PGN file for reading at uncompressed byte offsets, through a
+    CompressedPgnReader if the file is gzip or bzip2 compressed.
+    """
+    if compression(path) is not None:
+        return CompressedPgnReader(path, seek_points)
+    return open(path, "rb")
+
+
+def pgn_size(path, seek_points=None):
+    """
+    Uncompressed size of a PGN file. For a compressed file the last seek
+    point marks the end of the file when it was indexed, only the data
+    appended after it is decompressed.
+    """
+    if compression(path) is None:
+        return os.path.getsize(path)
+    with CompressedPgnReader(path, seek_points) as reader:
+        return reader.end_point()[1]
+
+
+def append_pgn_text(path, text):
+    """
+    Appends PGN text to a PGN file. A compressed file gets the text as a new
+    gzip member or bzip2 stream, which decompressors read as if it was part
+    of the first one.
+    """
+    kind = compression(path) if os.path.exists(path) and os.path.getsize(path) else None
+    if kind == GZIP:
+        f = gzip.open(path, "ab")
+        f.write(text)
+        f.close()
+    elif kind == BZIP2:
+        with open(path, "ab") as f:
+            f.write(bz2.compress(text))
+    else:
+        with open(path, "ab") as f:
+            f.write(text)
+
+
+def compress_pgn(pgn_path, out_path, kind=GZIP, member_size=MEMBER_SIZE):
+    """
+    Compresses a PGN file into one gzip member or bzip2 stream per
+    member_size bytes, cut where a game starts. gzip and bzip2 only
+    restart at such boundaries, so the seek points of the index are as
+    dense as the members.
+    """
+    with open_pgn(pgn_path) as pgn, open(out_path, "wb") as out:
+        lines = []
+        size = 0
+        while True:
+            line = pgn.readline()
+            if not line or (size >= member_size and line.startswith("[Event ")):
+                text = "".join(lines)
+                if kind == GZIP:
+                    member = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    out.write(member.compress(text) + member.flush())
+                else:
+                    out.write(bz2.compress(text))
+                lines = []
+                size = 0
+            if not line:
+                break
+            lines.append(line)
+            size += len(line)
+
+
+class CompressedPgnReader(object):
+    """
+    Reads a gzip or bzip2 compressed PGN file as if it was uncompressed,
+    with tell and seek at uncompressed byte offsets.
+
+    Decompression can only start at the beginning of a gzip member or
+    bzip2 stream, so while reading, the start of a member is recorded as a
+    seek point, (compressed offset, uncompressed offset), whenever it is
+    at least spacing bytes past the last one. Seeking forward decompresses
+    from where the reader is, seeking elsewhere from the closest seek point
+    before the offset. The seek points are kept with the index, see
+    read_seek_points, so fetching a game decompresses at most one member.
+
+    Files compressed in one piece have a single seek point at the start,
+    compress_pgn splits them into members.
+    """
+    def __init__(self, path, seek_points=None, spacing=SEEK_POINT_SPACING):
+        self.path = path
+        self.kind = compression(path)
+        self.spacing = spacing
+        self.seek_points = sorted(set([(0, 0)] + list(seek_points or [])))
+        self.seek_offsets = [p[1] for p in self.seek_points]
+        self.file = open(path, "rb")
+        self.restart(self.seek_points[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def restart(self, seek_point):
+        """Starts decompressing at a seek point"""
+        compressed_offset, offset = seek_point
+        self.file.seek(compressed_offset)
+        self.compressed_offset = compressed_offset
+        self.decompressor = new_decompressor(self.kind)
+        self.buffer = ""
+        self.buffer_start = offset
+        self.pos = offset
+        self.eof = False
+
+    def new_member(self, compressed_offset, offset):
+        self.decompressor = new_decompressor(self.kind)
+        last_offset = self.seek_points[-1][1]
+        if offset >= last_offset + self.spacing and compressed_offset > self.seek_points[-1][0]:
+            self.seek_points.append((compressed_offset, offset))
+            self.seek_offsets.append(offset)
+
+    def decompress(self, block):
+        self.compressed_offset += len(block)
+        offset = self.buffer_start + len(self.buffer)
+        output = []
+        while block:
+            try:
+                data = self.decompressor.decompress(block)
+                unused = self.decompressor.unused_data
+            except EOFError:
+                # The last bzip2 stream ended exactly at the end of the previous block
+                data = ""
+                unused = block
+            output.append(data)
+            offset += len(data)
+            # Some tools pad the end of the file with zeros
+            if not unused.strip("\0"):
+                break
+            self.new_member(self.compressed_offset - len(unused), offset)
+            block = unused
+        return "".join(output)
+
+    def fill(self):
+        """Decompresses the next block into the buffer, returns False at the end of the file"""
+        # The data before the read position is not needed any more
+        drop = min(self.pos - self.buffer_start, len(self.buffer))
+        if drop > 0:
+            self.buffer = self.buffer[drop:]
+            self.buffer_start += drop
+        while not self.eof:
+            block = self.file.read(READ_BLOCK_SIZE)
+            if not block:
+                self.eof = True
+                break
+            data = self.decompress(block)
+            if data:
+                self.buffer += data
+                return True
+        return False
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.end_point()[1]
+        end = self.buffer_start + len(self.buffer)
+        if not self.buffer_start <= offset <= end:
+            seek_point = self.seek_points[bisect.bisect_right(self.seek_offsets, offset) - 1]
+            if not seek_point[1] <= end <= offset:
+                self.restart(seek_point)
+            self.pos = offset
+            while self.buffer_start + len(self.buffer) < offset and self.fill():
+                pass
+        self.pos = min(offset, self.buffer_start + len(self.buffer))
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer_start + len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+        # fill drops the data before the read position
+        start = self.pos - self.buffer_start
+        end = len(self.buffer) if size < 0 else start + size
+        data = self.buffer[start:end]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        start = self.pos - self.buffer_start
+        i = self.buffer.find("\n", start)
+        while i < 0:
+            if not self.fill():
+                break
+            start = self.pos - self.buffer_start
+            i = self.buffer.find("\n", start)
+        start = self.pos - self.buffer_start
+        end = i + 1 if i >= 0 else len(self.buffer)
+        line = self.buffer[start:end]
+        self.pos += len(line)
+        return line
+
+    def end_point(self):
+        """
+        (compressed size, uncompressed size) of the file, decompressing the
+        rest of it unless the last seek point already marks its end.
+        """
+        compressed_size = os.path.getsize(self.path)
+        if self.seek_points[-1][0] == compressed_size:
+            return self.seek_points[-1]
+        if not self.eof:
+            self.seek(self.seek_points[-1][1])
+            while self.fill():
+                self.pos = self.buffer_start + len(self.buffer)
+        self.pos = self.buffer_start + len(self.buffer)
+        return compressed_size, self.pos
+
+    def index_seek_points(self):
+        """The seek points found so far, followed by the end point once the whole file was read"""
+        if self.eof:
+            return sorted(set(self.seek_points + [self.end_point()]))
+        return list(self.seek_points)
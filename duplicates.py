@@ -0,0 +1,127 @@
+import heapq
+import os
+import struct
+
+FINGERPRINTS_FILE = "fingerprints"
+DUPLICATES_REPORT = "duplicates.txt"
+FINGERPRINT = struct.Struct('<Q')
+
+# What the indexer does with a game it has already indexed
+DUPLICATES_SKIP = "skip"
+DUPLICATES_FLAG = "flag"
+
+
+def append_fingerprint(path, fingerprint):
+    """Records the fingerprint of a game appended to an index, without reading the fingerprints of the others"""
+    with open(os.path.join(path, FINGERPRINTS_FILE), "ab") as f:
+        f.write(FINGERPRINT.pack(fingerprint))
+
+
+class DuplicateTracker(object):
+    """
+    Remembers the fingerprint of every indexed game and reports repeats.
+
+    The fingerprints are appended to a file in game order, so a resumed
+    build gets them back by truncating the file to the games covered by its
+    checkpoint. Each duplicate found adds a tab separated line to the
+    report: the offset of the duplicate, the id of the game it repeats,
+    whether it was skipped or only flagged, and its players and date.
+
+    The fingerprints are looked up in a dict, about 120 bytes per game, which
+    is not counted in the memory budget of an index build, so duplicate
+    detection is left off unless asked for.
+    """
+    def __init__(self, path, num_games=None, report_size=None):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        fingerprints_path = os.path.join(path, FINGERPRINTS_FILE)
+        report_path = os.path.join(path, DUPLICATES_REPORT)
+        self.fingerprints_file = open(fingerprints_path, "ab")
+        self.report_file = open(report_path, "ab")
+        if num_games is not None:
+            self.fingerprints_file.truncate(min(num_games * FINGERPRINT.size, os.path.getsize(fingerprints_path)))
+            self.fingerprints_file.seek(0, os.SEEK_END)
+        if report_size is not None:
+            self.report_file.truncate(min(report_size, os.path.getsize(report_path)))
+            self.report_file.seek(0, os.SEEK_END)
+        self.games = {}
+        self.num_games = 0
+        for fingerprint in self.read_fingerprints(fingerprints_path):
+            self.games.setdefault(fingerprint, self.num_games)
+            self.num_games += 1
+        with open(report_path) as f:
+            self.num_duplicates = sum(1 for line in f)
+        self.pending = []
+
+    @staticmethod
+    def read_fingerprints(path):
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            data = f.read()
+        return struct.unpack("<{0}Q".format(len(data) / FINGERPRINT.size), data)
+
+    def find(self, fingerprint):
+        """Returns the id of the game with this fingerprint, or None"""
+        return self.games.get(fingerprint)
+
+    def add(self, fingerprint):
+        """Records the fingerprint of the next game id"""
+        self.games.setdefault(fingerprint, self.num_games)
+        self.pending.append(fingerprint)
+        self.num_games += 1
+
+    def report(self, offset, original, action, white, black, date):
+        self.num_duplicates += 1
+        self.report_file.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(offset, original, action, white, black, date))
+
+    def extend(self, path, store=None, skipped=()):
+        """
+        Appends the fingerprints and report of the tracker in path, such as
+        the one of a parallel index chunk. Its skipped games are not among
+        its fingerprints, so their report lines are copied. Its games that
+        repeat a game of this tracker or an earlier game of its own are
+        indexed, and flagged from the fingerprints, with their offset and
+        headers read from the chunk's header store, so they are reported
+        once and against the first game, as by a single pass.
+
+        skipped holds the report fields of games skipped outside the other
+        tracker, in file order, which are merged with its report lines.
+        """
+        first_game = self.num_games
+        report_path = os.path.join(path, DUPLICATES_REPORT)
+        reports = []
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if fields[2] == DUPLICATES_SKIP:
+                        # Game ids of the other tracker start at 0
+                        reports.append((int(fields[0]), int(fields[1]) + first_game) + tuple(fields[2:]))
+        for fields in heapq.merge(reports, skipped):
+            self.report(*fields)
+        for game, fingerprint in enumerate(self.read_fingerprints(os.path.join(path, FINGERPRINTS_FILE))):
+            original = self.find(fingerprint)
+            if original is not None:
+                if store is not None:
+                    self.report(store.value("offset", game), original, DUPLICATES_FLAG, store.value("white", game),
+                                store.value("black", game), store.value("date", game))
+                else:
+                    self.report("?", original, DUPLICATES_FLAG, "?", "?", "?")
+            self.add(fingerprint)
+
+    def report_size(self):
+        return self.report_file.tell()
+
+    def flush(self):
+        if self.pending:
+            self.fingerprints_file.write(struct.pack("<{0}Q".format(len(self.pending)), *self.pending))
+            self.pending = []
+        self.fingerprints_file.flush()
+        self.report_file.flush()
+
+    def close(self):
+        self.flush()
+        self.fingerprints_file.close()
+        self.report_file.close()
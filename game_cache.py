@@ -0,0 +1,91 @@
+import copy
+from collections import OrderedDict
+
+DEFAULT_GAME_CACHE_SIZE = 256
+
+
+def copy_game(game, positions=None):
+    """
+    Copies a parsed game tree, and the zobrist hash -> node dict of its
+    positions, so that a cached game can be handed out and edited. The nodes
+    are copied without parsing or replaying anything: their cached boards
+    are shared, as a node never changes its board once it is set and hands
+    out copies of it.
+    """
+    root = copy.copy(game)
+    root.headers = OrderedDict(game.headers)
+    if hasattr(game, "errors"):
+        root.errors = list(game.errors)
+    copies = {id(game): root}
+    stack = [(game, root)]
+    while stack:
+        node, node_copy = stack.pop()
+        node_copy.variations = []
+        for child in node.variations:
+            child_copy = copy.copy(child)
+            child_copy.parent = node_copy
+            child_copy.nags = set(child.nags)
+            node_copy.variations.append(child_copy)
+            copies[id(child)] = child_copy
+            stack.append((child, child_copy))
+    if positions is None:
+        return root
+    # Nodes dropped from the tree while parsing are left out
+    return root, dict((h, copies[id(n)]) for h, n in positions.iteritems() if id(n) in copies)
+
+
+class GameCache(object):
+    """
+    Size-bounded LRU cache of parsed games, keyed by (database path, game
+    number). Loaded games are edited in place, so callers hand out a
+    copy_game of the cached game and never the game itself.
+
+    Every lookup counts as a hit or a miss. Once more than max_size games are
+    cached, the least recently used one is dropped. The games of a database
+    have to be invalidated whenever its PGN file is rewritten, as the game
+    numbers then point at other games.
+    """
+    def __init__(self, max_size=DEFAULT_GAME_CACHE_SIZE):
+        self.max_size = max_size
+        self.games = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.games)
+
+    def get(self, db_path, game_num):
+        """Returns the cached value of a game, or None"""
+        key = (db_path, game_num)
+        value = self.games.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        # Moved to the most recently used end
+        self.games[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, db_path, game_num, value):
+        key = (db_path, game_num)
+        self.games.pop(key, None)
+        self.games[key] = value
+        while len(self.games) > self.max_size:
+            self.games.popitem(last=False)
+
+    def invalidate(self, db_path=None):
+        """Drops the games of a database, or every game if db_path is None"""
+        if db_path is None:
+            self.games.clear()
+            return
+        for key in [k for k in self.games if k[0] == db_path]:
+            del self.games[key]
+
+    def __str__(self):
+        stats = self.stats()
+        return "{0} cached games, {1:.0f}% hits".format(stats["size"], stats["hit_rate"] * 100)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.games),
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
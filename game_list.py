@@ -0,0 +1,86 @@
+DEFAULT_PAGE_SIZE = 100
+# Games before and after the page whose headers are fetched with it
+DEFAULT_PREFETCH = 50
+
+
+class GameListPager(object):
+    """
+    Splits the game ids of the database list into pages.
+
+    Only the ids of the current page are turned into list rows. Their header
+    records are fetched in one call to fetch_headers, which takes a list of
+    game ids and returns a dict of game id -> record, together with the
+    prefetch games on either side, so turning to the next page usually finds
+    its headers already fetched. Headers outside that window are dropped.
+
+    If the list is sorted, order takes the game ids and a limit and returns
+    the first limit ids in sorted order, or all of them if the limit is
+    None. Only as many games as the pages shown so far need are sorted, so
+    the first page of a large list comes from a partial sort.
+    """
+    def __init__(self, game_ids, fetch_headers, page_size=DEFAULT_PAGE_SIZE, prefetch=DEFAULT_PREFETCH,
+                 order=None):
+        self.game_ids = game_ids
+        self.fetch_headers = fetch_headers
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.order = order
+        self.ordered_ids = None
+        self.page = 0
+        self.headers = {}
+
+    @property
+    def total(self):
+        return len(self.game_ids)
+
+    @property
+    def num_pages(self):
+        return max((self.total + self.page_size - 1) / self.page_size, 1)
+
+    def set_page(self, page):
+        """Turns to a page, clamped to the existing pages, and returns its game ids"""
+        self.page = min(max(page, 0), self.num_pages - 1)
+        return self.page_ids()
+
+    def next_page(self):
+        return self.set_page(self.page + 1)
+
+    def previous_page(self):
+        return self.set_page(self.page - 1)
+
+    def sorted_ids(self, end=None):
+        """The first end game ids of the list in sorted order, all of them if end is None"""
+        if self.order is None:
+            return self.game_ids[:end]
+        if end is None or end > self.total:
+            end = self.total
+        if self.ordered_ids is None or len(self.ordered_ids) < end:
+            # Sorts twice as many games as before, so paging on does not sort again every page
+            limit = max(end, 2 * len(self.ordered_ids)) if self.ordered_ids is not None else end
+            self.ordered_ids = self.order(self.game_ids, limit if limit < self.total else None)
+        return self.ordered_ids[:end]
+
+    def page_ids(self):
+        start = self.page * self.page_size
+        return [int(g) for g in self.sorted_ids(start + self.page_size)[start:]]
+
+    def window_ids(self):
+        """Ids of the current page and its prefetch margin"""
+        start = max(self.page * self.page_size - self.prefetch, 0)
+        end = (self.page + 1) * self.page_size + self.prefetch
+        return [int(g) for g in self.sorted_ids(end)[start:]]
+
+    def header(self, game_id):
+        """Header record of a game of the current window, fetching the window if needed"""
+        game_id = int(game_id)
+        record = self.headers.get(game_id)
+        if record is None:
+            window = self.window_ids()
+            headers = dict((g, self.headers[g]) for g in window if g in self.headers)
+            missing = [g for g in window if g not in headers]
+            if game_id not in window:
+                missing.append(game_id)
+            headers.update(self.fetch_headers(missing))
+            self.headers = headers
+            record = headers.get(game_id)
+        return record
@@ -0,0 +1,759 @@
+import cStringIO
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+import chess.pgn
+
+from compressed_pgn import READ_BLOCK_SIZE, CompressedPgnReader, compression, pgn_size, read_seek_points
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER_STORE_DIR = "headers"
+# Start and end byte offset of every game in the PGN file, as little endian uint64 pairs
+GAME_OFFSETS_FILE = "game_offsets"
+GAME_OFFSETS = struct.Struct('<QQ')
+
+RESULT_CODES = ["*", "1-0", "0-1", "1/2-1/2"]
+# Position of each result code when the results are sorted as strings
+RESULT_SORT_RANKS = [0, 2, 1, 3]
+
+# Column name, struct format and numpy dtype. String columns hold ids into the string table.
+HEADER_COLUMNS = [("white", "<I", "<u4"), ("whiteelo", "<H", "<u2"), ("black", "<I", "<u4"),
+                  ("blackelo", "<H", "<u2"), ("result", "<B", "u1"), ("date", "<I", "<u4"),
+                  ("event", "<I", "<u4"), ("site", "<I", "<u4"), ("eco", "<I", "<u4"),
+                  ("offset", "<Q", "<u8")]
+STRING_COLUMNS = ["white", "black", "event", "site", "eco"]
+STRINGS_FILE = "strings"
+STRING_OFFSETS_FILE = "strings.offsets"
+# Written once the store is complete, see write_string_tables
+SORTED_STRINGS_FILE = "strings.sorted"
+STRING_RANKS_FILE = "strings.ranks"
+WORDS_FILE = "words"
+WORD_OFFSETS_FILE = "words.offsets"
+WORD_IDS_FILE = "words.ids"
+STRING_TABLE_FILES = [SORTED_STRINGS_FILE, STRING_RANKS_FILE, WORDS_FILE, WORD_OFFSETS_FILE, WORD_IDS_FILE]
+
+# Words of the player, event and site names, as kept in the token index
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+
+# Rows buffered per column before they are written out
+WRITE_BUFFER_ROWS = 10000
+
+
+def encode_date(date):
+    """Packs a PGN date (YYYY.MM.DD, unknown parts as ??) into YYYYMMDD, unknown parts as 0"""
+    parts = (date.split(".") + ["", "", ""])[:3]
+    value = 0
+    for part, scale in zip(parts, [10000, 100, 1]):
+        if part.isdigit():
+            value += int(part) * scale
+    return value
+
+
+def decode_date(value):
+    parts = [value / 10000, value / 100 % 100, value % 100]
+    return ".".join("{0:0{1}d}".format(p, w) if p else "?" * w for p, w in zip(parts, [4, 2, 2]))
+
+
+def encode_result(result):
+    try:
+        return RESULT_CODES.index(result)
+    except ValueError:
+        return 0
+
+
+def encode_elo(elo):
+    """Elo as stored in its 16 bit column, 0 if it is not a number, clamped to the column range"""
+    try:
+        return min(max(int(elo), 0), 0xffff)
+    except (TypeError, ValueError):
+        return 0
+
+
+def header_tokens(text):
+    """Lower cased alphanumeric words of a header value or filter text"""
+    # Kivy text inputs hold unicode, the index keys are UTF-8 like the PGN headers
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def header_store_path(leveldb_path):
+    return os.path.join(leveldb_path, HEADER_STORE_DIR)
+
+
+def game_offsets_path(leveldb_path):
+    return os.path.join(leveldb_path, GAME_OFFSETS_FILE)
+
+
+def write_game_text(out, text):
+    """Writes the PGN text of a game followed by the blank line separating it from the next game"""
+    out.write(text)
+    tail = text[-2:]
+    if tail != "\n\n":
+        out.write("\n" if tail[-1:] == "\n" else "\n\n")
+
+
+class Column(object):
+    """Fixed width little endian column memory-mapped from a file"""
+    def __init__(self, path, fmt, dtype):
+        self.struct = struct.Struct(fmt)
+        self.data = None
+        self.values = None
+        self.size = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.data) / self.struct.size
+            if numpy is not None:
+                self.values = numpy.frombuffer(self.data, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.struct.unpack_from(self.data, i * self.struct.size)[0]
+
+    def take(self, ids):
+        """Values at the given rows, as a numpy array when numpy is available"""
+        if self.values is not None:
+            return self.values[numpy.asarray(ids, dtype=numpy.intp)]
+        return [self[i] for i in ids]
+
+
+class IndexedView(object):
+    """Sequence of get(i), so that bisect can search a table stored in several files"""
+    def __init__(self, get):
+        self.get = get
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+
+def write_string_tables(path):
+    """
+    Writes the string tables of a complete header store: the string ids in
+    sorted order, the rank of every string in that order, used to sort the
+    string columns, and the sorted (word, string id) pairs of the words of
+    every string, see header_tokens, used to filter on word prefixes.
+    Strings interned later by appended games are not in the tables.
+    """
+    store = HeaderStore(path)
+    strings = [store.string(i) for i in xrange(store.num_strings)]
+    del store
+    order = sorted(xrange(len(strings)), key=strings.__getitem__)
+    ranks = [0] * len(strings)
+    for rank, string_id in enumerate(order):
+        ranks[string_id] = rank
+    words = sorted(set((word, string_id) for string_id, s in enumerate(strings) for word in header_tokens(s)))
+    word_offsets = []
+    size = 0
+    for word, string_id in words:
+        word_offsets.append(size)
+        size += len(word)
+    for name, fmt, values in [(SORTED_STRINGS_FILE, "I", order), (STRING_RANKS_FILE, "I", ranks),
+                              (WORD_OFFSETS_FILE, "Q", word_offsets), (WORD_IDS_FILE, "I", [w[1] for w in words])]:
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(struct.pack("<{0}{1}".format(len(values), fmt), *values))
+    with open(os.path.join(path, WORDS_FILE), "wb") as f:
+        f.write("".join(w[0] for w in words))
+
+
+class HeaderStoreWriter(object):
+    """
+    Appends game headers to a columnar header store.
+
+    Every column is a flat file of fixed width values indexed by game
+    number. Player, event, site and ECO strings are interned into a string
+    table and stored as ids. When appending to an existing store, strings are
+    not looked up in the table again, so a few duplicates may be added.
+
+    If num_rows is given, rows past it are dropped first, which is how an
+    interrupted index build discards the rows written after its checkpoint.
+    num_strings and strings_size do the same for the string table, and the
+    string tables of a previous build are removed until the build writes
+    them again.
+    """
+    def __init__(self, path, num_rows=None, num_strings=None, strings_size=None):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if num_rows is not None:
+            for name in STRING_TABLE_FILES:
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+        self.files = {}
+        self.buffers = {}
+        for name, fmt, dtype in HEADER_COLUMNS:
+            column_path = os.path.join(path, name)
+            self.files[name] = open(column_path, "ab")
+            if num_rows is not None:
+                self.files[name].truncate(min(num_rows * struct.calcsize(fmt), os.path.getsize(column_path)))
+                self.files[name].seek(0, os.SEEK_END)
+            self.buffers[name] = []
+        strings_path = os.path.join(path, STRINGS_FILE)
+        string_offsets_path = os.path.join(path, STRING_OFFSETS_FILE)
+        self.strings_file = open(strings_path, "ab")
+        self.string_offsets_file = open(string_offsets_path, "ab")
+        if strings_size is not None:
+            self.strings_file.truncate(min(strings_size, os.path.getsize(strings_path)))
+            self.strings_file.seek(0, os.SEEK_END)
+        if num_strings is not None:
+            self.string_offsets_file.truncate(min(num_strings * 8, os.path.getsize(string_offsets_path)))
+            self.string_offsets_file.seek(0, os.SEEK_END)
+        self.strings_size = self.strings_file.tell()
+        self.num_rows = self.files["offset"].tell() / 8
+        self.string_ids = {}
+        self.num_strings = self.string_offsets_file.tell() / 8
+
+    def intern(self, s):
+        string_id = self.string_ids.get(s)
+        if string_id is None:
+            string_id = self.string_ids[s] = self.num_strings
+            self.string_offsets_file.write(struct.pack("<Q", self.strings_size))
+            self.strings_file.write(s)
+            self.strings_size += len(s)
+            self.num_strings += 1
+        return string_id
+
+    def add_row(self, values):
+        """Adds a row of column name -> value, string columns as already interned ids"""
+        for name, fmt, dtype in HEADER_COLUMNS:
+            self.buffers[name].append(values[name])
+        self.num_rows += 1
+        if len(self.buffers["offset"]) >= WRITE_BUFFER_ROWS:
+            self.flush()
+        return self.num_rows - 1
+
+    def add(self, fields):
+        """Adds a game from its header fields in DB_HEADER_MAP order, returns its row"""
+        values = {"white": self.intern(fields[0]), "whiteelo": encode_elo(fields[1]),
+                  "black": self.intern(fields[2]), "blackelo": encode_elo(fields[3]),
+                  "result": encode_result(fields[4]), "date": encode_date(fields[5]),
+                  "event": self.intern(fields[6]), "site": self.intern(fields[7]),
+                  "eco": self.intern(fields[8]), "offset": int(fields[9])}
+        return self.add_row(values)
+
+    def extend(self, store):
+        """Appends every row of another HeaderStore, re-interning its strings"""
+        string_ids = [self.intern(store.string(i)) for i in xrange(store.num_strings)]
+        for row in xrange(len(store)):
+            values = {}
+            for name, fmt, dtype in HEADER_COLUMNS:
+                value = store.columns[name][row]
+                values[name] = string_ids[value] if name in STRING_COLUMNS else value
+            self.add_row(values)
+
+    def flush(self):
+        for name, fmt, dtype in HEADER_COLUMNS:
+            values = self.buffers[name]
+            if values:
+                self.files[name].write(struct.pack("<{0}{1}".format(len(values), fmt[1]), *values))
+                self.buffers[name] = []
+            self.files[name].flush()
+        self.strings_file.flush()
+        self.string_offsets_file.flush()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.strings_file.close()
+        self.string_offsets_file.close()
+
+
+class HeaderStore(object):
+    """
+    Read access to a columnar header store written by HeaderStoreWriter.
+
+    The columns are memory-mapped, so opening the store costs nothing and
+    reading a header never touches LevelDB. With numpy installed the columns
+    are exposed as numpy arrays and filters and sorts run as vectorised
+    array operations over a position's game ids.
+
+    The string tables of write_string_tables give the sort rank of every
+    string and are bisected for the strings with a word starting with a
+    filter word. The strings past the tables are looked at one by one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.columns = {}
+        for name, fmt, dtype in HEADER_COLUMNS:
+            self.columns[name] = Column(os.path.join(path, name), fmt, dtype)
+        self.string_offsets = Column(os.path.join(path, STRING_OFFSETS_FILE), "<Q", "<u8")
+        self.num_strings = len(self.string_offsets)
+        self.strings = None
+        strings_path = os.path.join(path, STRINGS_FILE)
+        if os.path.getsize(strings_path):
+            with open(strings_path, "rb") as f:
+                self.strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sorted_ids = Column(os.path.join(path, SORTED_STRINGS_FILE), "<I", "<u4")
+        self.rank_column = Column(os.path.join(path, STRING_RANKS_FILE), "<I", "<u4")
+        # Strings covered by the string tables
+        self.num_sorted = min(len(self.rank_column), self.num_strings)
+        self.words = None
+        words_path = os.path.join(path, WORDS_FILE)
+        if os.path.exists(words_path) and os.path.getsize(words_path):
+            with open(words_path, "rb") as f:
+                self.words = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.word_offsets = Column(os.path.join(path, WORD_OFFSETS_FILE), "<Q", "<u8")
+        self.word_ids = Column(os.path.join(path, WORD_IDS_FILE), "<I", "<u4")
+        self.string_ranks = None
+
+    @classmethod
+    def open(cls, leveldb_path):
+        """Opens the header store of an index, returns None if the index has none"""
+        path = header_store_path(leveldb_path)
+        if not os.path.exists(os.path.join(path, STRING_OFFSETS_FILE)):
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return len(self.columns["offset"])
+
+    def string(self, string_id):
+        if self.strings is None:
+            return ""
+        start = self.string_offsets[string_id]
+        if string_id + 1 < self.num_strings:
+            return self.strings[start:self.string_offsets[string_id + 1]]
+        return self.strings[start:len(self.strings)]
+
+    def value(self, name, game_id):
+        """Header value of a game as the string shown in the database panel"""
+        value = self.columns[name][game_id]
+        if name in STRING_COLUMNS:
+            return self.string(value)
+        if name == "result":
+            return RESULT_CODES[value]
+        if name == "date":
+            return decode_date(value)
+        return str(value)
+
+    def fields(self, game_id):
+        """Header fields of a game in DB_HEADER_MAP order, the FEN is not stored and left as *"""
+        return [self.value(name, game_id) for name, fmt, dtype in HEADER_COLUMNS] + ["*"]
+
+    def record(self, game_id):
+        """Pipe delimited header record laid out like the game_N_data record in the index"""
+        return "|".join(self.fields(game_id))
+
+    def sorted_string(self, rank):
+        return self.string(self.sorted_ids[rank])
+
+    def word(self, i):
+        start = self.word_offsets[i]
+        end = self.word_offsets[i + 1] if i + 1 < len(self.word_offsets) else len(self.words)
+        return self.words[start:end]
+
+    def matching_strings(self, prefix):
+        """Ids of the interned strings with a word starting with prefix, see header_tokens"""
+        matches = set()
+        num_words = len(self.word_ids)
+        if num_words:
+            words = IndexedView(self.word)
+            start = bisect_left(words, prefix, 0, num_words)
+            end = bisect_left(words, prefix + "\xff", start, num_words)
+            matches.update(self.word_ids[i] for i in xrange(start, end))
+        for string_id in xrange(self.num_sorted, self.num_strings):
+            if any(word.startswith(prefix) for word in header_tokens(self.string(string_id))):
+                matches.add(string_id)
+        return matches
+
+    def filter(self, game_ids, filter_text, columns=("white", "black", "event", "site")):
+        """
+        Keeps the games where every word of the filter text starts a word
+        of one of the given columns, like the token index does.
+        """
+        for text in [word for text in filter_text for word in header_tokens(text)]:
+            matches = self.matching_strings(text)
+            if numpy is not None:
+                matches = numpy.fromiter(matches, dtype=numpy.uint32, count=len(matches))
+                mask = numpy.zeros(len(game_ids), dtype=bool)
+                for name in columns:
+                    mask |= numpy.in1d(self.columns[name].take(game_ids), matches)
+                game_ids = numpy.asarray(game_ids)[mask]
+            else:
+                game_ids = [g for g in game_ids
+                            if any(self.columns[name][g] in matches for name in columns)]
+        return game_ids
+
+    def ranks(self):
+        """
+        Sort key of every interned string, used to sort string columns: its
+        rank in the string tables, with the strings interned after the tables
+        were written fitted in between the ranks by bisecting the tables.
+        """
+        if self.string_ranks is not None:
+            return self.string_ranks
+        extra_ids = sorted(xrange(self.num_sorted, self.num_strings), key=self.string)
+        if not extra_ids and self.num_sorted:
+            if numpy is not None:
+                self.string_ranks = self.rank_column.values
+            else:
+                self.string_ranks = [self.rank_column[i] for i in xrange(self.num_sorted)]
+            return self.string_ranks
+        # Room for every extra string between two ranks
+        scale = len(extra_ids) + 1
+        ranks = [(self.rank_column[i] + 1) * scale for i in xrange(self.num_sorted)] + [0] * len(extra_ids)
+        table = IndexedView(self.sorted_string)
+        last_string = last_rank = gap = None
+        in_gap = 0
+        for string_id in extra_ids:
+            s = self.string(string_id)
+            if s == last_string:
+                ranks[string_id] = last_rank
+                continue
+            rank = bisect_left(table, s, 0, self.num_sorted)
+            if rank < self.num_sorted and table[rank] == s:
+                ranks[string_id] = (rank + 1) * scale
+            else:
+                in_gap = in_gap + 1 if rank == gap else 0
+                gap = rank
+                ranks[string_id] = rank * scale + 1 + in_gap
+            last_string, last_rank = s, ranks[string_id]
+        self.string_ranks = numpy.array(ranks, dtype=numpy.int64) if numpy is not None else ranks
+        return self.string_ranks
+
+    def sort_values(self, name, game_ids):
+        """Values of a column that sort the games the same way as the header strings"""
+        values = self.columns[name].take(game_ids)
+        if name in STRING_COLUMNS or name == "result":
+            ranks = self.ranks() if name != "result" else RESULT_SORT_RANKS
+            if numpy is not None:
+                ranks = numpy.asarray(ranks)
+                return ranks[values]
+            return [ranks[v] for v in values]
+        return values
+
+    def sort_keys(self, game_ids, criteria):
+        """
+        Integer sort keys of the games for a list of (column name, ascending)
+        criteria, one array or list per criterion. Descending keys are
+        negated, so every key sorts ascending.
+        """
+        keys = []
+        for name, asc in criteria:
+            if name == "id":
+                values = numpy.asarray(game_ids, dtype=numpy.int64) if numpy is not None else list(game_ids)
+            else:
+                values = self.sort_values(name, game_ids)
+            if numpy is not None:
+                values = numpy.asarray(values, dtype=numpy.int64)
+                keys.append(values if asc else -values)
+            else:
+                keys.append(values if asc else [-v for v in values])
+        return keys
+
+    def sort_multi(self, game_ids, criteria, limit=None):
+        """
+        Sorts game ids by several (column name, ascending) criteria, the
+        first criterion first, ties broken by game id. With limit only the
+        first limit games are sorted and returned: numpy selects the
+        candidates with argpartition on the first key, otherwise a heap
+        keeps the best limit games.
+        """
+        if not criteria or limit == 0:
+            return game_ids if limit is None else game_ids[:limit]
+        if numpy is None:
+            keys = zip(*self.sort_keys(game_ids, criteria) + [list(game_ids)])
+            if limit is not None and limit < len(keys):
+                return [k[-1] for k in heapq.nsmallest(limit, keys)]
+            return [k[-1] for k in sorted(keys)]
+
+        game_ids = numpy.asarray(game_ids)
+        keys = self.sort_keys(game_ids, criteria)
+        if limit is not None and limit < len(game_ids):
+            # Every game that can be in the first limit: the ones before the
+            # limit-th value of the first key, and every tie with it
+            kth = keys[0][numpy.argpartition(keys[0], limit - 1)[limit - 1]]
+            candidates = numpy.flatnonzero(keys[0] <= kth)
+            game_ids = game_ids[candidates]
+            keys = [k[candidates] for k in keys]
+        # lexsort sorts by the last key first
+        order = numpy.lexsort([game_ids] + keys[::-1])
+        return game_ids[order[:limit] if limit is not None else order]
+
+    def sort(self, game_ids, name, asc=True):
+        """Sorts game ids by a header column"""
+        if name == "id":
+            ordered = sorted(game_ids)
+            return ordered if asc else ordered[::-1]
+        values = self.sort_values(name, game_ids)
+        if numpy is not None:
+            order = numpy.argsort(values, kind="mergesort")
+            if not asc:
+                order = order[::-1]
+            return numpy.asarray(game_ids)[order]
+        return [g for v, g in sorted(zip(values, game_ids), reverse=not asc)]
+
+
+class GameOffsetsWriter(object):
+    """
+    Appends the start and end byte offsets of games to a game offsets file.
+
+    If num_games is given, games past it are dropped first, which is how an
+    interrupted index build discards the offsets written after its checkpoint.
+    """
+    def __init__(self, path, num_games=None):
+        self.path = path
+        self.file = open(path, "ab")
+        if num_games is not None:
+            self.file.truncate(min(num_games * GAME_OFFSETS.size, os.path.getsize(path)))
+            self.file.seek(0, os.SEEK_END)
+        self.num_games = self.file.tell() / GAME_OFFSETS.size
+        self.offsets = []
+
+    def add(self, start, end):
+        self.offsets.extend((start, end))
+        self.num_games += 1
+        if len(self.offsets) >= WRITE_BUFFER_ROWS * 2:
+            self.flush()
+
+    def extend(self, path):
+        """Appends every game of another game offsets file"""
+        self.flush()
+        with open(path, "rb") as f:
+            data = f.read()
+        self.file.write(data)
+        self.num_games += len(data) / GAME_OFFSETS.size
+
+    def flush(self):
+        if self.offsets:
+            self.file.write(struct.pack("<{0}Q".format(len(self.offsets)), *self.offsets))
+            self.offsets = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class GameStore(object):
+    """
+    Fetches the text of indexed games from a memory-mapped PGN file.
+
+    The PGN file is mapped once and the offsets of every game are read from
+    the game offsets file, so fetching a game is a slice of the mapping
+    instead of opening the file and reading it line by line. A file
+    appended to after the store was opened has to be opened again.
+
+    A gzip or bzip2 compressed file is read through a CompressedPgnReader
+    starting at the seek points of the index instead, and game_text
+    returns a string.
+    """
+    def __init__(self, pgn_path, offsets_path, seek_points=None):
+        self.pgn_path = pgn_path
+        self.offsets = Column(offsets_path, "<Q", "<u8")
+        self.data = None
+        self.reader = None
+        self.size = 0
+        if compression(pgn_path) is not None:
+            self.reader = CompressedPgnReader(pgn_path, seek_points)
+            self.size = pgn_size(pgn_path, seek_points)
+            # Exports run in another thread than the game list
+            self.reader_lock = threading.Lock()
+        elif os.path.getsize(pgn_path):
+            with open(pgn_path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.data)
+
+    @classmethod
+    def open(cls, leveldb_path, pgn_path):
+        """Opens the game store of an index, returns None if the index has no offsets or the PGN file is missing"""
+        offsets_path = game_offsets_path(leveldb_path)
+        if not os.path.exists(offsets_path) or not os.path.isfile(pgn_path):
+            return None
+        return cls(pgn_path, offsets_path, read_seek_points(leveldb_path))
+
+    def __len__(self):
+        return len(self.offsets) / 2
+
+    def game_range(self, game_id):
+        """Start and end byte offsets of a game, None if the game is not in the mapped file"""
+        if game_id >= len(self):
+            return None
+        start, end = self.offsets[game_id * 2], self.offsets[game_id * 2 + 1]
+        if end > self.size:
+            return None
+        return start, end
+
+    def game_text(self, game_id):
+        """Read-only buffer over the PGN text of a game, the file is not copied, a string if it is compressed"""
+        game_range = self.game_range(game_id)
+        if game_range is None:
+            return None
+        start, end = game_range
+        if self.reader is not None:
+            with self.reader_lock:
+                self.reader.seek(start)
+                return self.reader.read(end - start)
+        return buffer(self.data, start, end - start)
+
+    def copy_text(self, out, start=0, end=None):
+        """Writes the PGN text between two byte offsets to out in blocks, up to the end of the mapped file by default"""
+        if end is None or end > self.size:
+            end = self.size
+        if self.reader is not None:
+            with self.reader_lock:
+                self.reader.seek(start)
+                while start < end:
+                    data = self.reader.read(min(READ_BLOCK_SIZE, end - start))
+                    if not data:
+                        break
+                    out.write(data)
+                    start += len(data)
+            return
+        for block_start in xrange(start, end, READ_BLOCK_SIZE):
+            out.write(buffer(self.data, block_start, min(READ_BLOCK_SIZE, end - block_start)))
+
+    def game_file(self, game_id):
+        """File object reading the PGN text of a game straight from the mapping, for chess.pgn.read_game"""
+        text = self.game_text(game_id)
+        if text is None:
+            return None
+        return cStringIO.StringIO(text)
+
+    def file_order(self, game_ids):
+        """Game ids sorted by their offset in the PGN file, leaving out the games not in the mapped file"""
+        game_ids = [g for g in game_ids if self.game_range(g) is not None]
+        if self.offsets.values is not None:
+            starts = self.offsets.values[numpy.asarray(game_ids, dtype=numpy.intp) * 2]
+            return [game_ids[i] for i in numpy.argsort(starts, kind="mergesort")]
+        return sorted(game_ids, key=lambda g: self.offsets[g * 2])
+
+    def iter_texts(self, game_ids):
+        """
+        Yields the (game id, PGN text buffer) of every game in game_ids in
+        file order, so the mapped file is read sequentially instead of with a
+        seek per game, and a compressed file is decompressed once.
+        """
+        for game_id in self.file_order(game_ids):
+            yield game_id, self.game_text(game_id)
+
+    def iter_games(self, game_ids, parser=None):
+        """
+        Yields the (game id, parsed game) of every game in game_ids in file
+        order, parsed with parser, chess.pgn.read_game by default.
+        """
+        if parser is None:
+            parser = chess.pgn.read_game
+        for game_id, text in self.iter_texts(game_ids):
+            yield game_id, parser(cStringIO.StringIO(text))
+
+    def export(self, game_ids, out):
+        """Writes the PGN text of the games to the file out in file order, returns the number of games written"""
+        count = 0
+        for game_id, text in self.iter_texts(game_ids):
+            write_game_text(out, text)
+            count += 1
+        return count
+
+
+class GameExporter(object):
+    """
+    Copies the PGN text of a list of games into a PGN file, without parsing
+    or re-serialising them.
+
+    The games are written in the order of game_ids, such as the sorted
+    database list, or in file order with in_file_order=True, which reads the
+    source file sequentially. With append=True they are added to the end of
+    out_path instead of replacing it.
+
+    The export can run in a background thread, see start. Its progress is
+    polled with snapshot, and cancel stops it and restores out_path to what
+    it was before the export. An export that fails is done as well, with
+    the exception in error.
+    """
+    def __init__(self, store, game_ids, out_path, append=False, in_file_order=False):
+        self.store = store
+        self.game_ids = list(game_ids)
+        self.out_path = out_path
+        self.append = append
+        self.in_file_order = in_file_order
+        self.games = 0
+        self.bytes = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.start_time = time.time()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def export(self):
+        """Writes the games, returns the number written, 0 if the export was cancelled"""
+        self.start_time = time.time()
+        if self.in_file_order:
+            game_ids = self.store.file_order(self.game_ids)
+        else:
+            game_ids = [g for g in self.game_ids if self.store.game_range(g) is not None]
+        # A replaced file is only swapped in once every game is written
+        path = self.out_path if self.append else self.out_path + ".tmp"
+        try:
+            with open(path, "ab" if self.append else "wb") as out:
+                start_size = out.tell()
+                for game_id in game_ids:
+                    if self.cancel_event.is_set():
+                        self.cancelled = True
+                        self.games = 0
+                        out.truncate(start_size)
+                        break
+                    text = self.store.game_text(game_id)
+                    write_game_text(out, text)
+                    self.games += 1
+                    self.bytes += len(text)
+            if not self.append:
+                if self.cancelled:
+                    os.remove(path)
+                else:
+                    os.rename(path, self.out_path)
+        except Exception as e:
+            # Kept for the UI, which only sees the export through snapshot
+            self.error = e
+            if not self.append and os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            self.done = True
+        return self.games
+
+    def start(self):
+        """Exports in a background thread"""
+        thread = threading.Thread(target=self.export)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def snapshot(self):
+        """Returns the games and bytes written, the games per second and the estimated seconds left"""
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        games_per_sec = self.games / elapsed
+        eta = None
+        if self.done:
+            eta = 0
+        elif games_per_sec > 0:
+            eta = (len(self.game_ids) - self.games) / games_per_sec
+        return {"games": self.games, "total_games": len(self.game_ids), "bytes": self.bytes,
+                "elapsed": elapsed, "games_per_sec": games_per_sec, "eta": eta,
+                "done": self.done, "cancelled": self.cancelled, "error": self.error}
+
+    def __str__(self):
+        stats = self.snapshot()
+        if stats["error"] is not None:
+            return "export failed: {0}".format(stats["error"])
+        if stats["cancelled"]:
+            return "export cancelled"
+        eta = "?" if stats["eta"] is None else "{0:.0f}s".format(stats["eta"])
+        return "{0}/{1} games exported ({2:.0f} games/s), ETA {3}".format(
+            stats["games"], stats["total_games"], stats["games_per_sec"], eta)
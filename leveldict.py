@@ -1,7 +1,278 @@
 from UserDict import DictMixin
+from array import array
 import leveldb
 import json
 import logging
+import struct
+import sys
+
+from bloom_filter import BloomFilter, bloom_filter_path
+from game_store import GameStore, HeaderStore, header_tokens
+from compressed_pgn import read_seek_points
+from pattern_search import PatternStore
+from move_store import MoveStore
+
+# Binary posting lists start with this byte, legacy ones are comma separated decimal game ids
+POSTINGS_MARKER = "\x01"
+# Position posting lists that also hold the first ply each game reaches the position at
+PLY_POSTINGS_MARKER = "\x02"
+POSTINGS_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def encode_postings(game_ids):
+    """Encodes game ids as a sorted array of little endian uint32s"""
+    ids = array(POSTINGS_TYPECODE, sorted(set(game_ids)))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return POSTINGS_MARKER + ids.tostring()
+
+
+def decode_postings(value):
+    """Decodes a binary, ply or comma separated posting list into a sorted array of game ids"""
+    ids = array(POSTINGS_TYPECODE)
+    if value.startswith(PLY_POSTINGS_MARKER):
+        ids.fromstring(value[1:])
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        ids = ids[::2]
+    elif value.startswith(POSTINGS_MARKER):
+        ids.fromstring(value[1:])
+        if sys.byteorder == 'big':
+            ids.byteswap()
+    else:
+        ids.extend(sorted(set(int(g) for g in value.split(",") if g)))
+    return ids
+
+
+# Packed index layout: one record and one posting list per position and partition,
+# keyed by a prefix byte, the 8 byte big endian zobrist hash and the partition number.
+INDEX_FORMAT = "indexFormat"
+INDEX_FORMAT_PACKED = "2"
+RECORD_PREFIX = "\x02"
+POSTINGS_PREFIX = "\x03"
+PARTITION_KEY = struct.Struct('>QH')
+
+# Secondary indexes are keyed by a name instead of a zobrist hash: the prefix
+# byte, the name, a NUL separator and the 2 byte partition number.
+NAME_SEPARATOR = "\x00"
+NAME_PARTITION = struct.Struct('>H')
+
+# Inverted index of player, event and site name tokens, mapped to posting lists
+TOKEN_INDEX = "tokenIndex"
+TOKEN_PREFIX = "\x04"
+
+# Material signatures (KRPvKR) and pawn structures (white and black pawn
+# bitboards), mapped to the games reaching them and the first ply they do
+MATERIAL_PREFIX = "\x05"
+PAWN_STRUCTURE_PREFIX = "\x06"
+PAWN_STRUCTURE = struct.Struct('>QQ')
+STRUCTURE_PREFIXES = (MATERIAL_PREFIX, PAWN_STRUCTURE_PREFIX)
+
+# version, freq, white score, draws, posting list length, number of moves
+RECORD_HEADER = struct.Struct('<BIiIIH')
+# Version 1 records list bare moves, version 2 adds each move's results
+RECORD_VERSION = 2
+# move, white wins, draws, black wins
+MOVE_STATS = struct.Struct('<HIII')
+
+FILES = "abcdefgh"
+PROMOTIONS = "nbrq"
+# Polyglot encodes castling as the king capturing its own rook
+POLYGLOT_CASTLING = {"e1h1": "e1g1", "e1a1": "e1c1", "e8h8": "e8g8", "e8a8": "e8c8"}
+
+
+def position_key(prefix, zobrist_hash, partition=0):
+    return prefix + PARTITION_KEY.pack(int(zobrist_hash), partition)
+
+
+def named_key(prefix, name, partition=0):
+    # Names typed into the database filter are unicode
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return prefix + name + NAME_SEPARATOR + NAME_PARTITION.pack(partition)
+
+
+def split_named_key(key):
+    """Returns the prefix, name and partition of a named key"""
+    return key[0], key[1:-3], NAME_PARTITION.unpack(key[-2:])[0]
+
+
+def token_key(token, partition=0):
+    return named_key(TOKEN_PREFIX, token, partition)
+
+
+def pawn_structure_name(white_pawns, black_pawns):
+    """Name of a pawn structure in the pawn structure index, from the pawn bitboards of each side"""
+    return PAWN_STRUCTURE.pack(white_pawns, black_pawns)
+
+
+def encode_ply_postings(entries):
+    """Encodes (game id, ply) pairs as little endian uint32 pairs, keeping the first ply of each game"""
+    values = array(POSTINGS_TYPECODE)
+    last_game_id = None
+    for game_id, ply in sorted(entries):
+        if game_id != last_game_id:
+            values.append(game_id)
+            values.append(ply)
+            last_game_id = game_id
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def decode_ply_postings(value):
+    """Decodes (game id, ply) pairs sorted by game id"""
+    values = array(POSTINGS_TYPECODE)
+    values.fromstring(value)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return zip(values[::2], values[1::2])
+
+
+def find_game_ply(value, game_id):
+    """
+    Ply of a game in a list encoded by encode_ply_postings, None if the game
+    is not in it. Bisects the uint32 pairs instead of decoding them into
+    tuples, as the posting lists of common positions hold millions of games.
+    """
+    values = array(POSTINGS_TYPECODE)
+    values.fromstring(value)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    lo, hi = 0, len(values) / 2
+    while lo < hi:
+        mid = (lo + hi) / 2
+        if values[mid * 2] < game_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(values) / 2 and values[lo * 2] == game_id:
+        return values[lo * 2 + 1]
+    return None
+
+
+def encode_position_postings(entries):
+    """
+    Encodes the (game id, ply) pairs of a position as a ply posting list.
+    Falls back to a plain posting list when a ply is None, which is how
+    games from posting lists written without plies are merged.
+    """
+    entries = list(entries)
+    if any(ply is None for game_id, ply in entries):
+        return encode_postings(game_id for game_id, ply in entries)
+    return PLY_POSTINGS_MARKER + encode_ply_postings(entries)
+
+
+def decode_position_postings(value):
+    """Decodes any posting list into (game id, ply) pairs, the ply is None if the list has none"""
+    if value.startswith(PLY_POSTINGS_MARKER):
+        return decode_ply_postings(value[1:])
+    return [(game_id, None) for game_id in decode_postings(value)]
+
+
+def intersect_postings(first, second):
+    """Game ids found in both sorted posting lists, as a sorted array"""
+    if len(first) > len(second):
+        first, second = second, first
+    second = set(second)
+    return array(POSTINGS_TYPECODE, (g for g in first if g in second))
+
+
+def split_position_key(key):
+    """Returns the prefix, zobrist hash and partition of a packed position key"""
+    zobrist_hash, partition = PARTITION_KEY.unpack(key[1:])
+    return key[0], zobrist_hash, partition
+
+
+def encode_move(uci):
+    """Packs a UCI move into 16 bits: to square, from square << 6, promotion << 12"""
+    from_square = (int(uci[1]) - 1) * 8 + FILES.index(uci[0])
+    to_square = (int(uci[3]) - 1) * 8 + FILES.index(uci[2])
+    promotion = PROMOTIONS.index(uci[4]) + 1 if len(uci) > 4 else 0
+    return to_square | from_square << 6 | promotion << 12
+
+
+def decode_move(move):
+    """Unpacks a 16 bit move written by encode_move or polyglot into UCI"""
+    to_square = move & 077
+    from_square = (move >> 6) & 077
+    promotion = (move >> 12) & 0x7
+    uci = FILES[from_square & 7] + str((from_square >> 3) + 1) + FILES[to_square & 7] + str((to_square >> 3) + 1)
+    uci = POLYGLOT_CASTLING.get(uci, uci)
+    if promotion:
+        uci += PROMOTIONS[promotion - 1]
+    return uci
+
+
+class MoveStats(object):
+    """Results of the games that continued from a position with a move"""
+    def __init__(self, uci, wins=0, draws=0, losses=0):
+        self.uci = uci
+        self.wins = wins
+        self.draws = draws
+        self.losses = losses
+
+    @property
+    def freq(self):
+        return self.wins + self.draws + self.losses
+
+
+class PositionRecord(object):
+    """Frequency, results and moves played from a position"""
+    def __init__(self, freq=0, white_score=0, draws=0, moves=None, num_games=0):
+        self.freq = freq
+        self.white_score = white_score
+        self.draws = draws
+        self.moves = moves or []
+        self.num_games = num_games
+        # Per move results, empty for indexes that only list the moves
+        self.move_stats = {}
+
+    def add_move(self, uci, wins=0, draws=0, losses=0):
+        if uci not in self.moves:
+            self.moves.append(uci)
+        stats = self.move_stats.get(uci)
+        if stats is None:
+            stats = self.move_stats[uci] = MoveStats(uci)
+        stats.wins += wins
+        stats.draws += draws
+        stats.losses += losses
+
+    def merge(self, other):
+        self.freq += other.freq
+        self.white_score += other.white_score
+        self.draws += other.draws
+        self.num_games += other.num_games
+        for m in other.moves:
+            stats = other.move_stats.get(m)
+            if stats:
+                self.add_move(m, stats.wins, stats.draws, stats.losses)
+            elif m not in self.moves:
+                self.moves.append(m)
+        return self
+
+
+def encode_record(record):
+    value = [RECORD_HEADER.pack(RECORD_VERSION, record.freq, record.white_score, record.draws,
+                                record.num_games, len(record.moves))]
+    for m in record.moves:
+        stats = record.move_stats.get(m) or MoveStats(m)
+        value.append(MOVE_STATS.pack(encode_move(m), stats.wins, stats.draws, stats.losses))
+    return "".join(value)
+
+
+def decode_record(value):
+    version, freq, white_score, draws, num_games, num_moves = RECORD_HEADER.unpack_from(value)
+    record = PositionRecord(freq, white_score, draws, num_games=num_games)
+    if version == 1:
+        moves = struct.unpack_from('<{0}H'.format(num_moves), value, RECORD_HEADER.size)
+        record.moves = [decode_move(m) for m in moves]
+        return record
+    for i in xrange(num_moves):
+        move, wins, draws, losses = MOVE_STATS.unpack_from(value, RECORD_HEADER.size + i * MOVE_STATS.size)
+        record.add_move(decode_move(move), wins, draws, losses)
+    return record
+
 
 class LevelDict(object, DictMixin):
     """Dict Wrapper around the Google LevelDB Database"""
@@ -66,6 +337,46 @@ class PartitionedLevelDB(object):
             self.num_passes = self.db.Get('numPasses')
         except KeyError:
             self.num_passes = 0
+        try:
+            self.packed = self.db.Get(INDEX_FORMAT) == INDEX_FORMAT_PACKED
+        except KeyError:
+            self.packed = False
+        try:
+            self.has_token_index = self.db.Get(TOKEN_INDEX) == "1"
+        except KeyError:
+            self.has_token_index = False
+        self.reload_files()
+
+    def reload_files(self):
+        """
+        (Re)loads the Bloom filter and seek points kept next to LevelDB and
+        opens the stores, see reopen_stores.
+        """
+        self.bloom_filter = BloomFilter.load(bloom_filter_path(self.path))
+        # Only indexes of compressed PGN files have seek points
+        self.seek_points = read_seek_points(self.path)
+        self.reopen_stores()
+
+    def reopen_stores(self):
+        """
+        Maps the header store, pattern store and game store kept next to
+        LevelDB again, needed after games are appended to them. The move
+        store is mapped again on its next use.
+        """
+        self.header_store = HeaderStore.open(self.path)
+        self.pattern_store = PatternStore.open(self.path)
+        self.opened_move_store = None
+        try:
+            self.game_store = GameStore.open(self.path, self.db.Get("pgn_filename"))
+        except KeyError:
+            self.game_store = None
+
+    @property
+    def move_store(self):
+        """The move store, opened on first use, as the app itself does not replay games from it"""
+        if self.opened_move_store is None:
+            self.opened_move_store = MoveStore.open(self.path)
+        return self.opened_move_store
 
     def Get(self, key, regular=False, *args, **kwargs):
         if regular:
@@ -76,6 +387,8 @@ class PartitionedLevelDB(object):
     def extract_games(self, num, out, v):
         if num:
             out += int(v)
+        elif v.startswith(POSTINGS_MARKER) or v.startswith(PLY_POSTINGS_MARKER):
+            out.update(str(g) for g in decode_postings(v))
         else:
             for e in v.split(","):
                 if e:
@@ -91,7 +404,9 @@ class PartitionedLevelDB(object):
         # print key
 
         if self.num_passes:
-            for k,v in self.db.RangeIter(key_from=key+'_p_0', key_to=key+'_p_{0}'.format(self.num_passes)):
+            # Partition suffixes sort lexicographically (_p_10 before _p_2), so
+            # scan every _p_ key of this position instead of _p_0.._p_N.
+            for k,v in self.db.RangeIter(key_from=key+'_p_0', key_to=key+'_p_:'):
                 out = self.extract_games(num, out, v)
         else:
             for k,v in self.db.RangeIter(key_from=key, key_to=key):
@@ -99,3 +414,128 @@ class PartitionedLevelDB(object):
 
         # print out
         return out
+
+    def get_packed(self, prefix, key):
+        """Returns the (partition, value) fragments stored for a position in a packed index"""
+        # Most positions reached while analysing are not in the index
+        if self.bloom_filter is not None and int(key) not in self.bloom_filter:
+            return []
+        if not self.num_passes or self.num_passes == "0":
+            try:
+                return [(0, self.db.Get(position_key(prefix, key)))]
+            except KeyError:
+                return []
+        return [(split_position_key(k)[2], v) for k, v in
+                self.db.RangeIter(key_from=position_key(prefix, key), key_to=position_key(prefix, key, 0xffff))]
+
+    def get_position(self, key):
+        """Returns the PositionRecord of a position, or None if it is not in the index"""
+        if self.packed:
+            fragments = self.get_packed(RECORD_PREFIX, key)
+            if not fragments:
+                return None
+            record = decode_record(fragments[0][1])
+            for partition, v in fragments[1:]:
+                record.merge(decode_record(v))
+            return record
+
+        freq = self.get_partitioned(key + "_freq", num=True)
+        moves = self.get_partitioned(key + "_moves")
+        if not freq and not moves:
+            return None
+        record = PositionRecord(freq, self.get_partitioned(key + "_white_score", num=True),
+                                self.get_partitioned(key + "_draws", num=True))
+        for m in moves:
+            if m.isdigit():
+                if m == "0":
+                    continue
+                m = decode_move(int(m))
+            if m not in record.moves:
+                record.moves.append(m)
+        return record
+
+    def get_game_ids(self, key):
+        """Returns the ids of the games reaching a position as a sorted array"""
+        fragments = []
+        if self.packed:
+            fragments = self.get_packed(POSTINGS_PREFIX, key)
+        elif self.num_passes:
+            for k, v in self.db.RangeIter(key_from=key+'_p_0', key_to=key+'_p_:'):
+                fragments.append((int(k.rpartition('_p_')[2]), v))
+        else:
+            for k, v in self.db.RangeIter(key_from=key, key_to=key):
+                fragments.append((0, v))
+        if len(fragments) == 1:
+            return decode_postings(fragments[0][1])
+
+        # Partitions hold consecutive game ranges, so binary posting lists
+        # only need to be concatenated in partition order.
+        ids = array(POSTINGS_TYPECODE)
+        legacy = False
+        for partition, v in sorted(fragments):
+            ids.extend(decode_postings(v))
+            legacy = legacy or not v.startswith((POSTINGS_MARKER, PLY_POSTINGS_MARKER))
+        if legacy:
+            ids = array(POSTINGS_TYPECODE, sorted(set(ids)))
+        return ids
+
+    def get_game_plies(self, key):
+        """
+        Returns the (game id, ply) pairs of the games reaching a position,
+        sorted by game id, with the first ply each game reaches it at. The
+        ply is None for games indexed before plies were stored.
+        """
+        if not self.packed:
+            return [(game_id, None) for game_id in self.get_game_ids(key)]
+        entries = []
+        for partition, v in sorted(self.get_packed(POSTINGS_PREFIX, key)):
+            entries.extend(decode_position_postings(v))
+        return entries
+
+    def get_game_ply(self, key, game_id):
+        """First ply at which a game reaches a position, None if unknown"""
+        if not self.packed:
+            return None
+        for partition, v in self.get_packed(POSTINGS_PREFIX, key):
+            if v.startswith(PLY_POSTINGS_MARKER):
+                ply = find_game_ply(v[1:], game_id)
+                if ply is not None:
+                    return ply
+        return None
+
+    def get_structure_games(self, prefix, name):
+        """Returns the (game id, first ply) pairs of the games reaching a material signature or pawn structure"""
+        entries = []
+        # Partitions hold consecutive game ranges and sort in order
+        for k, v in self.db.RangeIter(key_from=named_key(prefix, name), key_to=named_key(prefix, name, 0xffff)):
+            entries.extend(decode_ply_postings(v))
+        return entries
+
+    def get_material_games(self, signature):
+        """Games reaching a material signature such as KRPvKR, see get_structure_games"""
+        return self.get_structure_games(MATERIAL_PREFIX, signature)
+
+    def get_pawn_structure_games(self, white_pawns, black_pawns):
+        """Games reaching the pawn structure given by each side's pawn bitboard, see get_structure_games"""
+        return self.get_structure_games(PAWN_STRUCTURE_PREFIX, pawn_structure_name(white_pawns, black_pawns))
+
+    def get_token_game_ids(self, text):
+        """
+        Returns the ids of the games whose players, event or site contain a
+        word starting with each word of text, as a sorted array. Returns None
+        when the index was built without the token index or text has no words.
+        """
+        tokens = header_tokens(text)
+        if not self.has_token_index or not tokens:
+            return None
+        ids = None
+        for token in tokens:
+            matches = set()
+            # Every token with this prefix, in every partition
+            for k, v in self.db.RangeIter(key_from=TOKEN_PREFIX + token, key_to=TOKEN_PREFIX + token + "\xff"):
+                matches.update(decode_postings(v))
+            token_ids = array(POSTINGS_TYPECODE, sorted(matches))
+            ids = token_ids if ids is None else intersect_postings(ids, token_ids)
+            if not ids:
+                break
+        return ids
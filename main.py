@@ -1,8 +1,14 @@
 import threading
+import multiprocessing
 
 from kivy.graphics.instructions import InstructionGroup
 
 import leveldict
+import pgn_index
+from game_cache import GameCache, copy_game
+from game_store import GameExporter
+from game_list import GameListPager
+from compressed_pgn import open_pgn, compression, compress_pgn, append_pgn_text, pgn_size
 
 try:
     from StringIO import StringIO
@@ -233,6 +239,8 @@ MERIDA = "img/pieces/Merida-shadow/"
 INITIAL_BOARD_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 INDEX_FILE_POS = "last_pos"
 
+DB_MATERIAL_FILTER = "material:"
+DB_PATTERN_FILTER = "pattern:"
 DB_HEADER_MAP = {"White": 0, "WhiteElo": 1, "Black": 2,
                  "BlackElo": 3, "Result": 4, "Date": 5, "Event": 6, "Site": 7,
                  "ECO": 8, INDEX_FILE_POS:9, "FEN":10}
@@ -1778,130 +1786,97 @@ class ChessProgram_app(App):
             return False
         return True
 
-    def open_create_index(self, f):
+    def open_create_index(self, f, on_ready):
+        """
+        Returns the index folder of the selected PGN file or index and calls
+        on_ready with it, once the index is built if it has to be.
+        """
         folder_tokens = f[0].split('/')
         leveldb_path = None
         if '.db' in folder_tokens[-2]:
             leveldb_path = folder_tokens[:-1]
             if leveldb_path:
                 leveldb_path = '/'.join(leveldb_path)
+                on_ready(leveldb_path)
 
         elif '.pgn' in folder_tokens[-1]:
             pgn_path = f[0]
             leveldb_path = self.gen_leveldb_path(pgn_path)
-            if not os.path.exists(leveldb_path):
-                position_index = {}
-                game_index = {}
-                pgn = open(pgn_path)
-                offsets = chess.pgn.scan_offsets(pgn)
-                offset_list = [o for o in offsets]
+            # An index whose build was interrupted resumes from its checkpoint
+            if not os.path.exists(leveldb_path) or not pgn_index.index_is_complete(leveldb_path):
+                if not self.create_index(pgn_path, leveldb_path, partial(on_ready, leveldb_path)):
+                    return None
+            else:
+                on_ready(leveldb_path)
+        return leveldb_path
 
-                pgn = open(pgn_path)
+    def create_index(self, pgn_path, leveldb_path, on_done=None):
+        """
+        Builds the index in a background thread, so the window keeps
+        responding, and calls on_done on the UI thread once it is complete.
+        Returns False if another index is still being built.
+        """
+        if self.index_build_running():
+            return False
+        # Game numbers of a rebuilt index may point at other games
+        self.game_cache.invalidate(leveldb_path)
+        indexer = pgn_index.create_indexer(pgn_path, leveldb_path, self.index_processes,
+                                           memory_budget=self.index_memory_budget, max_ply=self.index_max_ply,
+                                           min_frequency=self.index_min_frequency, patterns=self.index_patterns,
+                                           duplicates=self.index_duplicates)
+        # Polled for games/s, positions/s, bytes/s and ETA while the index is built
+        self.index_progress = indexer.progress
+        self.index_path = leveldb_path
+        self.index_done = on_done
+        self.index_thread = Thread(target=indexer.index)
+        self.index_thread.daemon = True
+        self.index_thread.start()
+        Clock.schedule_interval(self.poll_index_progress, 1)
+        return True
 
-                # for i, node in enumerate(chess.pgn.read_game(pgn)):
-                i = 0
-                while 1:
-                    node = chess.pgn.read_game(pgn)
-                    if not node:
-                        break
-                # node = chess.pgn.read_game(pgn)
-                # print(node)
-                    result = node.headers["Result"]
-                    draw = False
-                    if result == '1/2-1/2':
-                        result = 0
-                        draw = True
-                    elif result == '1-0':
-                        result = 1
-                    elif result == '0-1':
-                        result = -1
-                    else:
-                        result = 0
-                    # print(node.headers)
+    def index_build_running(self):
+        """Tells the user to wait and returns True if an index is being built, create_index would not start"""
+        if self.index_thread is not None and self.index_thread.is_alive():
+            self.db_stat_label.text = "Wait for the index being built"
+            return True
+        return False
 
-                    # for i, h in enumerate(headers):
-                    headers = node.headers
-                    game_num = i
-                    try:
-                        white_elo = int(headers['WhiteElo'])
-                    except:
-                        white_elo = 2400
-                    try:
-                        black_elo = int(headers['BlackElo'])
-                    except:
-                        black_elo = 2400
-                    if 'ECO' in headers:
-                        eco = headers['ECO']
-                    else:
-                        eco = '*'
-                    if 'FEN' in headers:
-                        fen = headers['FEN']
-                    else:
-                        fen = '*'
-                    game_info = "{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}|{8}|{9}|{10}".format(headers['White'],white_elo,
-                    headers['Black'], black_elo, headers['Result'], headers['Date'], headers['Event'], headers['Site'], eco, offset_list[i], fen)
-                    game_index[game_num] = game_info
-                    # print(game_info)
-
-                    while node.variations:
-                        # print(node.move)
-                        board = node.board()
-                        position_hash = str(board.zobrist_hash())
-                        # print(board.zobrist_hash())
-                        node = node.variation(0)
-
-                        if position_hash in position_index:
-                            position_index[position_hash]['n']+=1
-                            position_index[position_hash]['white_score'] += result
-                            if draw:
-                                position_index[position_hash]['draws'] += 1
-                            position_index[position_hash]['moves'].add(node.move.uci())
-                            position_index[position_hash]['game_ids'].append(str(i))
-                        else:
-                            position_index[position_hash] = {'n': 1, 'white_score': result, 'draws': 0, 'moves':set(), 'game_ids':[str(i)]}
-                            position_index[position_hash]['moves'].add(node.move.uci())
-
-                            if draw:
-                                position_index[position_hash]['draws'] += 1
-                    i+=1
-                db = leveldict.LevelDict(leveldb_path)
-                for k,v in game_index.items():
-                    db["game_{0}_data".format(k)] = v
-                db["total_game_count"] = str(i)
-                db["pgn_filename"] = pgn_path
-                db["numPasses"] = "0"
-
-                for k,v in position_index.items():
-                    # print (v['game_ids'])
-                    db[k+"_p_0"] = ",".join(v['game_ids'])
-                    db["{0}_moves_p_0".format(k)] = ",".join(v['moves'])
-                    db["{0}_white_score_p_0".format(k)] = str(v['white_score'])
-                    db["{0}_draws_p_0".format(k)] = str(v['draws'])
-
-                # print(position_index)
-                # print(game)
-                # command = "polyglot make-book -pgn '{0}' -leveldb '{1}' -min-game 1".format(pgn_path, leveldb_path)
-                # print command
-                # os.system(command)
-        return leveldb_path
+    def poll_index_progress(self, dt):
+        if self.index_thread.is_alive():
+            self.db_stat_label.text = "Indexing: {0}".format(self.index_progress)
+            return True
+        self.index_thread = None
+        on_done, self.index_done = self.index_done, None
+        # A build that raised leaves its checkpoint behind
+        if not pgn_index.index_is_complete(self.index_path):
+            self.db_stat_label.text = "Index build failed"
+        else:
+            self.db_stat_label.text = "{0} games indexed".format(self.index_progress.snapshot()["games"])
+            if on_done is not None:
+                on_done()
+        return False
 
     def gen_leveldb_path(self, fname):
         return fname + '.db'
 
     def process_database(self, obj, f, mevent):
-        leveldb_path = self.open_create_index(f)
+        leveldb_path = self.open_create_index(f, self.open_db_index)
         if leveldb_path:
             self.db_popup.dismiss()
-            # self.db_index_book = leveldb.LevelDB(leveldb_path)
-            self.db_index_book = leveldict.PartitionedLevelDB(leveldb_path)
+
+    def open_db_index(self, leveldb_path):
+        # self.db_index_book = leveldb.LevelDB(leveldb_path)
+        self.db_index_book = leveldict.PartitionedLevelDB(leveldb_path)
 
     def process_ref_database(self, obj, f, mevent):
-        leveldb_path = self.open_create_index(f)
+        leveldb_path = self.open_create_index(f, self.open_ref_db_index)
 
         if leveldb_path:
             self.db_popup.dismiss()
-            self.ref_db_index_book = leveldict.PartitionedLevelDB(leveldb_path)
-            # self.ref_db_index_book = leveldb.LevelDB(leveldb_path)
+
+    def open_ref_db_index(self, leveldb_path):
+        self.ref_db_index_book = leveldict.PartitionedLevelDB(leveldb_path)
+        # self.ref_db_index_book = leveldb.LevelDB(leveldb_path)
 
     def start_uci_engine_thread(self):
         self.uci_engine_thread = Thread(target=self.update_external_engine_output, args=(None,))
@@ -2904,6 +2879,7 @@ class ChessProgram_app(App):
             if not self.database_display:
                 self.db_stat_label.text = "No Games"
                 self.db_adapter.data = {}
+                self.db_pager = None
             if game == SHOW_REF_GAMES:
                 self.use_ref_db = True
                 self.update_database_panel()
@@ -2936,8 +2912,15 @@ class ChessProgram_app(App):
             # if self.use_ref_db:
             #     db_index = self.ref_db_index_book
             # print "game_index: {0}".format(game_index)
-            self.load_game_from_index(int(game_index))
-            self.go_to_move(None, str(current_pos_hash))
+            # The posting list knows the ply the game reaches the position at,
+            # so the game view jumps there instead of searching every node
+            db_index = self.ref_db_index_book if self.use_ref_db else self.db_index_book
+            ply = None
+            if db_index is not None:
+                ply = db_index.get_game_ply(str(current_pos_hash), int(game_index))
+            self.load_game_from_index(int(game_index), ply=ply)
+            if ply is None:
+                self.go_to_move(None, str(current_pos_hash))
 
             # self.db_sort_criteria = db_sort_criteria
             # print args[0].selection[0].text
@@ -2952,17 +2935,21 @@ class ChessProgram_app(App):
                 bt.text = bt.text[:-2]
 
     def update_db_sort_criteria(self, label):
+        # Each column clicked is added as the next sort key, and cycles through
+        # descending, ascending and off, e.g. Elo descending then Date descending
         # print label.field
+        criteria = [c for c in self.db_sort_criteria if c.key == label.field]
         if label.text.endswith(DB_SORT_DESC):
             label.text = label.text[:-2]+ ' ' +DB_SORT_ASC
-            self.db_sort_criteria[0].asc = True
+            criteria[0].asc = True
         elif label.text.endswith(DB_SORT_ASC):
-            self.db_sort_criteria = []
+            self.db_sort_criteria = [c for c in self.db_sort_criteria if c.key != label.field]
             label.text = label.text[:-2]
         else:
-            self.db_sort_criteria = [DBSortCriteria(label.field, 1, True)]
+            self.db_sort_criteria.append(DBSortCriteria(label.field, len(self.db_sort_criteria) + 1, False))
             label.text += ' ' +DB_SORT_DESC
-            self.db_sort_criteria[0].asc = False
+        for rank, c in enumerate(self.db_sort_criteria):
+            c.rank = rank + 1
 
         self.update_database_panel()
 
@@ -3022,7 +3009,11 @@ class ChessProgram_app(App):
         if not self.database_display:
             return self.generate_empty_rows(rec)
 
-        record = self.get_game_header(rec.id, "ALL")
+        record = None
+        if self.db_pager is not None:
+            record = self.db_pager.header(rec.id)
+        if record is None:
+            record = self.get_game_header(rec.id, "ALL")
         return self.generate_rows(rec, record)
 
     def to_window(self, x, y):
@@ -3144,6 +3135,27 @@ class ChessProgram_app(App):
         self.last_touch_down_setup = None
         self.last_touch_up_setup = None
         self.loaded_game_num = None
+        self.index_memory_budget = pgn_index.DEFAULT_MEMORY_BUDGET
+        self.index_processes = multiprocessing.cpu_count()
+        # None indexes every ply, 1 keeps positions seen only once
+        self.index_max_ply = None
+        self.index_min_frequency = 1
+        # Bitboards for pattern search take 96 bytes per position, so they are opt-in
+        self.index_patterns = False
+        # DUPLICATES_SKIP keeps repeated games of merged collections out of the book stats, but
+        # holds every game fingerprint in memory outside the memory budget, so it is opt-in
+        self.index_duplicates = None
+        self.index_progress = None
+        # Background index build started by create_index, see poll_index_progress
+        self.index_thread = None
+        self.index_path = None
+        self.index_done = None
+        # Parsed games fetched from the databases, see get_game_from_index
+        self.game_cache = GameCache()
+        # Export of the database list started by save_games, polled for progress and cancellable
+        self.game_export = None
+        # Pages of the database list, see update_database_panel
+        self.db_pager = None
         # self.book = polyglot_opening_book.PolyglotOpeningBook('book.bin')
         # self.book = chess.polyglot.open_reader("book.bin")
 
@@ -3342,13 +3354,20 @@ class ChessProgram_app(App):
         self.db_random_game_btn = Button(text="Load Random Game", on_press=self.load_random_game)
 
         self.db_stat_label = Label(text="No Games")
+        db_previous_page_btn = Button(text="<", size_hint=(0.3, 1), on_press=self.show_previous_db_page)
+        db_next_page_btn = Button(text=">", size_hint=(0.3, 1), on_press=self.show_next_db_page)
+        # Cancels the export of the database list, see save_games
+        self.db_stop_btn = Button(text="Stop", size_hint=(0.3, 1), disabled=True, on_press=self.stop_game_export)
 
         database_controls.add_widget(ref_db_label)
         database_controls.add_widget(db_label)
         database_controls.add_widget(self.db_filter_field)
         database_controls.add_widget(self.db_random_game_btn)
 
+        database_controls.add_widget(db_previous_page_btn)
         database_controls.add_widget(self.db_stat_label)
+        database_controls.add_widget(db_next_page_btn)
+        database_controls.add_widget(self.db_stop_btn)
 
         database_header = BoxLayout(size_hint=(1, 0.15))
         self.db_header_buttons = []
@@ -3669,13 +3688,14 @@ class ChessProgram_app(App):
         if self.use_ref_db:
             db_index = self.ref_db_index_book
 
-        total_games = int(db_index.Get(INDEX_TOTAL_GAME_COUNT))
+        total_games = int(db_index.Get(INDEX_TOTAL_GAME_COUNT, regular=True))
 
         rand_game_num = random.randint(0, total_games)
         self.load_game_from_index(rand_game_num)
 
-    def get_file_seek_segment(self, file_name, first, second):
-        with open(file_name) as f:
+    def get_file_seek_segment(self, file_name, first, second, seek_points=None):
+        # Offsets of a compressed file are uncompressed offsets, read from the closest seek point
+        with open_pgn(file_name, seek_points) as f:
             first = int(first)
             if first<0:
                 first = 0
@@ -3722,7 +3742,7 @@ class ChessProgram_app(App):
         if not os.path.isfile(file_name):
             file_name = file_name.replace("home", "Users")
 
-        return self.get_file_seek_segment(file_name, first, second)
+        return self.get_file_seek_segment(file_name, first, second, db_index.seek_points)
 
     # def get_game(self, db_index, game_num):
     #     if self.use_ref_db:
@@ -3768,14 +3788,27 @@ class ChessProgram_app(App):
     #     return games
 
     def get_game_from_index(self, db_index, game_num):
-        game_text = "\n".join(self.get_game(db_index, game_num))
-        # g = chess.pgn.read_game(game_text)
-        # print g
-        pgn = StringIO(textwrap.dedent(game_text))
-        g = read_game(pgn)
+        if self.use_ref_db:
+            db_index = self.ref_db_index_book
+        # The positions of a game are kept with it, go_to_move looks them up. The loaded
+        # game is edited in place, so only copies of the cached game are handed out.
+        cached = self.game_cache.get(db_index.path, game_num)
+        if cached is None:
+            # Sliced straight out of the memory-mapped PGN file
+            pgn = None
+            if db_index.game_store is not None:
+                pgn = db_index.game_store.game_file(game_num)
+            if pgn is None:
+                game_text = "\n".join(self.get_game(db_index, game_num))
+                # g = chess.pgn.read_game(game_text)
+                # print g
+                pgn = StringIO(textwrap.dedent(game_text))
+            cached = read_game(pgn), ExtendedGame.positions
+            self.game_cache.put(db_index.path, game_num, cached)
+        g, ExtendedGame.positions = copy_game(*cached)
         return g
 
-    def load_game_from_index(self, game_num):
+    def load_game_from_index(self, game_num, ply=None):
         db_index = self.db_index_book
         # games = self.get_game(db_index, game_num)
 
@@ -3795,11 +3828,22 @@ class ChessProgram_app(App):
         except AttributeError:
             self.custom_fen = 'startpos' # No attribute headers in chessboard_root
 
+        if ply:
+            self.chessboard = self.main_line_node(g, ply)
         self.refresh_board()
         self.loaded_game_num = game_num
 
         # self.game_score = games[0]
 
+    def main_line_node(self, game, ply):
+        """Node of the game's main line after ply moves, or its last node if the game is shorter"""
+        node = game
+        for i in range(ply):
+            if not node.variations:
+                break
+            node = node.variation(0)
+        return node
+
     def add_book_moves_white(self, mv, ref_move = None):
         self.add_book_moves(mv, ref_move=ref_move, color="white")
 
@@ -4467,6 +4511,23 @@ class ChessProgram_app(App):
 
     def save_games(self, obj):
         print "saving games"
+        db_index = self.ref_db_index_book if self.use_ref_db else self.db_index_book
+        store = db_index.game_store if db_index is not None else None
+        if store is not None:
+            # Copied straight from the PGN file in the background, in the order of the list
+            if self.db_pager is not None:
+                game_ids = self.db_pager.sorted_ids()
+            else:
+                game_ids = [int(g.id) for g in self.db_adapter.data if hasattr(g, "id")]
+            if self.game_export is not None and not self.game_export.done:
+                self.db_stat_label.text = str(self.game_export)
+                return
+            self.game_export = GameExporter(store, game_ids, 'games.pgn', append=True)
+            self.game_export.start()
+            self.db_stop_btn.disabled = False
+            Clock.schedule_interval(self.poll_game_export, 0.5)
+            return
+
         current_pos_hash = self.chessboard.board().zobrist_hash()
 
         if len(self.db_adapter.data) < 1000:
@@ -4479,62 +4540,96 @@ class ChessProgram_app(App):
                     pass
         self.go_to_move(None, str(current_pos_hash))
 
+    def poll_game_export(self, dt):
+        """Shows the progress of the export in the database panel until it is done"""
+        self.db_stat_label.text = str(self.game_export)
+        if self.game_export.done:
+            self.db_stop_btn.disabled = True
+            return False
+        return True
+
+    def stop_game_export(self, *args):
+        if self.game_export is not None and not self.game_export.done:
+            self.game_export.cancel()
+
     def save(self, obj, filename='game.pgn', replace=False):
         use_db = False
         pgn_file = None
         if self.db_index_book is not None:
             # use_db = True
             # Write to the open database
-            pgn_file = self.db_index_book.Get("pgn_filename")
+            pgn_file = self.db_index_book.Get("pgn_filename", regular=True)
+            db_folder_path = self.db_index_book.path
             if replace:
+                # The index is deleted and rebuilt below, which needs create_index to be able to start
+                if self.index_build_running():
+                    return
                 print "replacing game_num: {0}".format(self.loaded_game_num)
                     # offsets = list(chess.pgn.scan_offsets(pgn))
                     # self.assertEqual(len(offsets), 6)
+                store = self.db_index_book.game_store
+                game_range = store.game_range(self.loaded_game_num) if store is not None else None
                 with open(pgn_file+".tmp", "wb") as tmp_pgn_file:
-                    first, second = self.get_game_seek_positions(self.db_index_book, self.loaded_game_num)
-                    # print "first: {0}".format(first)
-                    if first:
-                        first = int(first)
-
-                    if first and first>1:
-                        # print "writing pre"
-                        before_replace_game = self.get_file_seek_segment(pgn_file, 0, first)
-                        tmp_pgn_file.write("\n".join(before_replace_game))
-                        tmp_pgn_file.write("\n")
-                        # print "\n".join(before_replace_game)
-                    exporter = chess.pgn.FileExporter(tmp_pgn_file)
-                    self.chessboard_root.export(exporter)
-                    # print "second: {0}".format(second)
-
-                    if second:
-                        second = int(second)
-                        # print "writing post"
-                        after_replace_game = self.get_file_seek_segment(pgn_file, second, None)
-                        tmp_pgn_file.write("\n".join(after_replace_game))
+                    if game_range is not None:
+                        # The text around the game is copied as is. Skipped duplicates are not
+                        # in the index, so the next indexed game can start well after this one ends
+                        start, end = game_range
+                        store.copy_text(tmp_pgn_file, 0, start)
+                        exporter = chess.pgn.FileExporter(tmp_pgn_file)
+                        self.chessboard_root.export(exporter)
                         tmp_pgn_file.write("\n")
-
-                shutil.copyfile(pgn_file+".tmp", pgn_file)
+                        store.copy_text(tmp_pgn_file, end)
+                    else:
+                        first, second = self.get_game_seek_positions(self.db_index_book, self.loaded_game_num)
+                        # print "first: {0}".format(first)
+                        if first:
+                            first = int(first)
+
+                        if first and first>1:
+                            # print "writing pre"
+                            before_replace_game = self.get_file_seek_segment(pgn_file, 0, first,
+                                                                             self.db_index_book.seek_points)
+                            tmp_pgn_file.write("\n".join(before_replace_game))
+                            tmp_pgn_file.write("\n")
+                            # print "\n".join(before_replace_game)
+                        exporter = chess.pgn.FileExporter(tmp_pgn_file)
+                        self.chessboard_root.export(exporter)
+                        # print "second: {0}".format(second)
+
+                        if second:
+                            second = int(second)
+                            # print "writing post"
+                            after_replace_game = self.get_file_seek_segment(pgn_file, second, None,
+                                                                            self.db_index_book.seek_points)
+                            tmp_pgn_file.write("\n".join(after_replace_game))
+                            tmp_pgn_file.write("\n")
+
+                kind = compression(pgn_file)
+                if kind is not None:
+                    compress_pgn(pgn_file+".tmp", pgn_file, kind)
+                else:
+                    shutil.copyfile(pgn_file+".tmp", pgn_file)
                 if os.path.exists(pgn_file+".tmp"):
                     os.remove(pgn_file+".tmp")
+                self.game_cache.invalidate(db_folder_path)
+
+                # The offsets of every later game moved, rebuild the index
+                del self.db_index_book
+                self.db_index_book = None
+                shutil.rmtree(db_folder_path)
+                self.create_index(pgn_file, db_folder_path, partial(self.open_db_index, db_folder_path))
             else:
-                with open(pgn_file, "a") as pgn_f:
-                    exporter = chess.pgn.FileExporter(pgn_f)
-                    self.chessboard_root.export(exporter)
-
-                    # pgn.seek(offsets[self.loaded_game_num])
-                # return
-            # if pgn_file:
-            #     f = open(pgn_file, 'ab')
-             # Rebuild index
-            # db_folder_path = os.path.abspath(os.path.join(pgn_file, os.pardir))
-            db_folder_path = self.gen_leveldb_path(pgn_file)
-            del self.db_index_book
-            self.db_index_book = None
-            # shutil.rmtree(db_folder_path)
-            command = "polyglot make-book -pgn '{0}' -leveldb '{1}' -min-game 1".format(pgn_file, db_folder_path)
-            # print command
-            os.system(command)
-            self.db_index_book = leveldb.LevelDB(db_folder_path)
+                offset = pgn_size(pgn_file, self.db_index_book.seek_points)
+                # A compressed file gets the game as a new gzip member or bzip2 stream
+                game_text = StringIO()
+                exporter = chess.pgn.FileExporter(game_text)
+                self.chessboard_root.export(exporter)
+                append_pgn_text(pgn_file, game_text.getvalue())
+
+                # Only index the appended game
+                indexer = pgn_index.PgnIndexer(pgn_file, db_folder_path)
+                self.loaded_game_num = indexer.append_game(self.db_index_book.db, self.chessboard_root, offset + 1,
+                                                           self.db_index_book)
 
         else:
             pgn_file = filename
@@ -4775,9 +4870,15 @@ class ChessProgram_app(App):
         try:
             ref_db = self.use_ref_db
             if ref_db:
-                record = self.ref_db_index_book.Get("game_{0}_data".format(g), regular=True)
+                db_index = self.ref_db_index_book
+            else:
+                db_index = self.db_index_book
+            store = db_index.header_store
+            # The header store leaves out the FEN, which stays in the LevelDB record
+            if store is not None and int(g) < len(store) and header != "FEN":
+                record = store.record(int(g))
             else:
-                record = self.db_index_book.Get("game_{0}_data".format(g), regular=True)
+                record = db_index.Get("game_{0}_data".format(g), regular=True)
             # print "Reocrd: {0}".format(record)
             if header == "ALL":
                 return record
@@ -4803,17 +4904,8 @@ class ChessProgram_app(App):
         except KeyError:
             return "Unknown"
 
-    def get_game_headers(self, db_index, pos_hash, create_headers = False):
-        try:
-            game_ids = db_index.Get(pos_hash)
-            # print "frequency: {0}".format(db_index.Get(pos_hash+"_freq"))
-            # print "score: {0}".format(db_index.Get(pos_hash+"_score"))
-            # print "draws: {0}".format(db_index.Get(pos_hash+"_draws"))
-            # print "moves: {0}".format(db_index.Get(pos_hash+"_white_score"))
-
-        except KeyError, e:
-            print "key not found!"
-            game_ids = []
+    def get_game_headers(self, db_index, pos_hash, create_headers = False, ids_only = False):
+        position_game_ids = game_ids = db_index.get_game_ids(pos_hash)
         db_game_list = []
         filter_text = []
         db_operator = ["-", " "]
@@ -4830,8 +4922,39 @@ class ChessProgram_app(App):
                     break
             if not operator_match:
                 filter_text = [db_text]
+        for f in list(filter_text):
+            # material:KRPvKR keeps the games that reach that material balance later on
+            if f.startswith(DB_MATERIAL_FILTER) and db_index.packed:
+                material_games = db_index.get_material_games(f[len(DB_MATERIAL_FILTER):])
+                game_ids = leveldict.intersect_postings(game_ids, [g for g, ply in material_games])
+                filter_text.remove(f)
+            # pattern:Nd5,pd6,!b@light keeps the games that reach a matching position
+            elif f.startswith(DB_PATTERN_FILTER) and db_index.pattern_store is not None:
+                try:
+                    pattern_games = db_index.pattern_store.search(f[len(DB_PATTERN_FILTER):])
+                except ValueError, e:
+                    print "Invalid pattern: {0}".format(e)
+                    pattern_games = []
+                game_ids = leveldict.intersect_postings(game_ids, [g for g, ply in pattern_games])
+                filter_text.remove(f)
+        if filter_text:
+            # Look the filter words up in the token index instead of scanning every header
+            filter_ids = db_index.get_token_game_ids(" ".join(filter_text))
+            if filter_ids is not None:
+                game_ids = leveldict.intersect_postings(game_ids, filter_ids)
+                filter_text = []
+        store = db_index.header_store
+        if store is not None and len(game_ids) and game_ids[-1] < len(store) and not create_headers:
+            ids = self.get_stored_game_ids(store, game_ids, filter_text)
+            if ids_only:
+                # Left to the caller to sort as far as it needs
+                return ids, position_game_ids, self.get_stored_game_order(store)
+            order = self.get_stored_game_order(store)
+            if order is not None:
+                ids = order(ids, None)
+            return [DBGame(str(i)) for i in ids], position_game_ids
         for i in game_ids:
-            db_game = DBGame(i)
+            db_game = DBGame(str(i))
             if self.db_sort_criteria or len(filter_text) > 0 or create_headers:
                 record = self.get_game_header(i, "ALL")
                 tokens = record.split("|")
@@ -4857,14 +4980,49 @@ class ChessProgram_app(App):
                     # db_game_list.append(db_game)
             else:
                 db_game_list.append(db_game)
-        if self.db_sort_criteria:
-            # print self.db_sort_criteria[0].key
-            sort_key = attrgetter(self.db_sort_criteria[0].key)
-            if self.db_sort_criteria[0].key == 'id':
+        # Stable sorts from the last sort key to the first
+        for criteria in reversed(self.db_sort_criteria):
+            # print criteria.key
+            sort_key = attrgetter(criteria.key)
+            if criteria.key == 'id':
                 sort_key = lambda v: int(v.id)
 
-            db_game_list = sorted(db_game_list, reverse=not self.db_sort_criteria[0].asc, key=sort_key)
-        return db_game_list, game_ids
+            db_game_list = sorted(db_game_list, reverse=not criteria.asc, key=sort_key)
+        if ids_only:
+            return [int(g.id) for g in db_game_list], position_game_ids, None
+        return db_game_list, position_game_ids
+
+    def get_stored_game_ids(self, store, game_ids, filter_text):
+        """Filters the games of a position on the header store columns"""
+        ids = game_ids
+        if filter_text:
+            ids = store.filter(ids, filter_text)
+        return ids
+
+    def get_stored_game_order(self, store):
+        """
+        Function sorting game ids by the sort criteria on the header store
+        columns, given the ids and how many of the first ones are needed, or
+        None if the list is not sorted
+        """
+        if not self.db_sort_criteria:
+            return None
+        criteria = [(c.key, c.asc) for c in self.db_sort_criteria]
+        return lambda ids, limit: store.sort_multi(ids, criteria, limit)
+
+    def fetch_game_headers(self, db_index, game_ids):
+        """Header records of a batch of games, read from the header store when the index has one"""
+        store = db_index.header_store
+        headers = {}
+        for g in game_ids:
+            if store is not None and g < len(store):
+                headers[g] = store.record(g)
+            else:
+                try:
+                    headers[g] = db_index.Get("game_{0}_data".format(g), regular=True)
+                except KeyError:
+                    pass
+        return headers
 
     def update_database_panel(self):
         # pos_hash = str(self.chessboard.position.__hash__())
@@ -4877,11 +5035,28 @@ class ChessProgram_app(App):
             db_index = self.db_index_book
         # print("db_index_book: {0}".format(self.db_index_book))
         if db_index is not None and self.database_display:
-            db_game_list, game_ids = self.get_game_headers(db_index, pos_hash)
-
-            self.db_stat_label.text = "{0} games".format(len(game_ids))
-            self.db_adapter.data = db_game_list
-            self.database_list_view.scroll_to(0)
+            # Only the rows of one page are created, the headers are fetched a window at a time
+            list_ids, game_ids, order = self.get_game_headers(db_index, pos_hash, ids_only=True)
+            self.db_pager = GameListPager(list_ids, partial(self.fetch_game_headers, db_index), order=order)
+            self.db_position_game_count = len(game_ids)
+            self.show_db_page()
+
+    def show_db_page(self):
+        pager = self.db_pager
+        self.db_stat_label.text = "{0} games ({1}/{2}), {3}".format(self.db_position_game_count, pager.page + 1,
+                                                                   pager.num_pages, self.game_cache)
+        self.db_adapter.data = [DBGame(str(i)) for i in pager.page_ids()]
+        self.database_list_view.scroll_to(0)
+
+    def show_next_db_page(self, *args):
+        if self.db_pager is not None:
+            self.db_pager.next_page()
+            self.show_db_page()
+
+    def show_previous_db_page(self, *args):
+        if self.db_pager is not None:
+            self.db_pager.previous_page()
+            self.show_db_page()
 
     def get_move_from_int(self, move):
         source_x = ((move >> 6) & 077) & 0x7
@@ -4964,61 +5139,36 @@ class ChessProgram_app(App):
         results = {}
         records = []
         move_list = []
+        record = db_index.get_position(pos_hash)
+        if record is None:
+            return {"records": []}
         try:
-            # print "book_pos_hash: {0}".format(pos_hash)
-            moves = db_index.Get(pos_hash + "_moves")
-            # print moves
-            for m in moves:
-                mv = int(m)
-                if mv:
-                    move = self.get_move_from_int(mv)
-                    # print move
-                    if move == "e1h1":
-                        move = "e1g1"
-                    elif move == "e1a1":
-                        move = "e1c1"
-                    elif move == "e8a8":
-                        move = "e8c8"
-                    elif move == "e8h8":
-                        move = "e8g8"
-                    try:
-                        bit_board = chess.Board(fen)
-                        san = bit_board.san(chess.Move.from_uci(move))
-                        move_list.append(ChessMove(move, san))
-                    except ValueError:
-                        continue
-                        # print "frequency: {0}".format(db_index.Get(pos_hash+"_freq"))
-                        # print "score: {0}".format(db_index.Get(pos_hash+"_white_score"))
-                        # print "draws: {0}".format(db_index.Get(pos_hash+"_draws"))
-                        # print "moves: {0}".format(db_index.Get(pos_hash+"_moves"))
-
-            for i, m in enumerate(move_list):
-                pos_hash = str(self.get_polyglot_stats(fen, move=m.uci)['hash'])
-
+            for move in record.moves:
                 try:
-                    move_list[i].freq = int(db_index.Get(pos_hash + "_freq", num=True))
-                except KeyError:
-                    move_list[i].freq = 1
+                    san = _board.san(chess.Move.from_uci(move))
+                    move_list.append(ChessMove(move, san))
+                except ValueError:
+                    continue
+
+            for m in move_list:
+                stats = record.move_stats.get(m.uci)
+                if stats:
+                    m.freq, m.wins, m.draws, m.losses = stats.freq, stats.wins, stats.draws, stats.losses
+                    continue
+                # Indexes without per move results, use the stats of the child position
+                child = db_index.get_position(str(self.get_polyglot_stats(fen, move=m.uci)['hash']))
+                if child:
+                    m.freq, m.draws = child.freq, child.draws
+                    m.losses = (child.freq - child.draws - child.white_score) / 2
+                    m.wins = m.losses + child.white_score
+                else:
+                    m.freq, m.wins, m.draws, m.losses = 1, 0, 0, 0
             if format:
                 move_list = sorted(move_list, key=lambda m: m.freq, reverse=True)[:5]
             else:
                 move_list = sorted(move_list, key=lambda m: m.freq, reverse=True)
 
             for m in move_list:
-                result = self.get_polyglot_stats(fen, move=m.uci)
-                pos_hash = str(result['hash'])
-
-                try:
-                    m.white_score = int(db_index.Get(pos_hash + "_white_score", num=True))
-                except KeyError:
-                    m.white_score = 0
-                try:
-                    m.draws = int(db_index.Get(pos_hash + "_draws", num=True))
-                except KeyError:
-                    m.draws = 0
-
-                m.losses = (m.freq - m.draws - m.white_score) / 2
-                m.wins = m.losses + m.white_score
                 if m.freq:
                     pct = (m.wins * 1.0 + 0.5 * m.draws) / m.freq * 100.0
                 else:
@@ -0,0 +1,185 @@
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+import chess
+
+from game_store import Column
+
+MOVE_STORE_DIR = "moves"
+MOVES_FILE = "moves"
+GAME_MOVES_FILE = "game_moves"
+
+GAME_MOVES = struct.Struct('<Q')
+MOVE_TYPECODE = 'H'
+
+# Moves buffered before they are written out
+WRITE_BUFFER_MOVES = 100000
+
+
+def move_store_path(leveldb_path):
+    return os.path.join(leveldb_path, MOVE_STORE_DIR)
+
+
+def encode_move(move):
+    """
+    Packs a chess.Move into 16 bits: to square, from square << 6, promotion
+    << 12, the packing of leveldict.encode_move and polyglot books
+    """
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.to_square | move.from_square << 6 | promotion << 12
+
+
+def decode_move(value):
+    """
+    Unpacks a move written by encode_move. Unlike leveldict.decode_move,
+    king moves to the rook squares are not read as polyglot castling.
+    """
+    promotion = (value >> 12) & 0x7
+    return chess.Move((value >> 6) & 077, value & 077, promotion + 1 if promotion else None)
+
+
+class MoveStoreWriter(object):
+    """
+    Appends the main line of every indexed game to a move store.
+
+    moves holds the 16 bit moves of every game, one game after the other.
+    game_moves holds the first move of every game followed by the move
+    count, so game N covers moves game_moves[N] to game_moves[N + 1].
+
+    If num_games is given, games past it are dropped first, which is how an
+    interrupted index build discards the moves written after its checkpoint.
+    """
+    def __init__(self, path, num_games=None):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        game_moves_path = os.path.join(path, GAME_MOVES_FILE)
+        moves_path = os.path.join(path, MOVES_FILE)
+        self.game_moves_file = open(game_moves_path, "ab")
+        self.moves_file = open(moves_path, "ab")
+        size = os.path.getsize(game_moves_path)
+        if num_games is not None and size > (num_games + 1) * GAME_MOVES.size:
+            self.game_moves_file.truncate((num_games + 1) * GAME_MOVES.size)
+            self.game_moves_file.seek(0, os.SEEK_END)
+            size = (num_games + 1) * GAME_MOVES.size
+        if size:
+            with open(game_moves_path, "rb") as f:
+                f.seek(size - GAME_MOVES.size)
+                self.num_moves = GAME_MOVES.unpack(f.read(GAME_MOVES.size))[0]
+            self.num_games = size / GAME_MOVES.size - 1
+        else:
+            self.num_moves = 0
+            self.num_games = 0
+            self.game_moves_file.write(GAME_MOVES.pack(0))
+        self.moves_file.truncate(self.num_moves * 2)
+        self.moves_file.seek(0, os.SEEK_END)
+        self.game_moves = []
+        self.moves = array(MOVE_TYPECODE)
+
+    def add_game(self, moves):
+        """Adds a game from the chess.Move objects of its main line"""
+        count = len(self.moves)
+        self.moves.extend(encode_move(move) for move in moves)
+        self.num_moves += len(self.moves) - count
+        self.num_games += 1
+        self.game_moves.append(self.num_moves)
+        if len(self.moves) >= WRITE_BUFFER_MOVES:
+            self.flush()
+
+    def extend(self, store):
+        """Appends every game of another MoveStore"""
+        move_offset = self.num_moves
+        self.flush()
+        with open(os.path.join(store.path, MOVES_FILE), "rb") as f:
+            while True:
+                block = f.read(WRITE_BUFFER_MOVES * 2)
+                if not block:
+                    break
+                self.moves_file.write(block)
+        for game in xrange(store.num_games):
+            self.game_moves.append(store.game_end(game) + move_offset)
+        self.num_moves += store.num_moves
+        self.num_games += store.num_games
+        self.flush()
+
+    def flush(self):
+        # Moves before the game_moves entries that point at them
+        if self.moves:
+            if sys.byteorder == 'big':
+                self.moves.byteswap()
+            self.moves_file.write(self.moves.tostring())
+            self.moves = array(MOVE_TYPECODE)
+        if self.game_moves:
+            self.game_moves_file.write(struct.pack("<{0}Q".format(len(self.game_moves)), *self.game_moves))
+            self.game_moves = []
+        self.moves_file.flush()
+        self.game_moves_file.flush()
+
+    def close(self):
+        self.flush()
+        self.moves_file.close()
+        self.game_moves_file.close()
+
+
+class MoveStore(object):
+    """
+    Replays indexed games from their 16 bit moves instead of their PGN text.
+
+    The moves file and the game_moves index are memory-mapped, so opening
+    the store reads neither of them, reading a game is a slice of the
+    mapping and replaying it needs no SAN parsing. Indexes built with a max
+    ply only keep the moves up to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.game_moves = Column(os.path.join(path, GAME_MOVES_FILE), "<Q", "<u8")
+        self.num_games = max(len(self.game_moves) - 1, 0)
+        self.num_moves = self.game_moves[self.num_games] if len(self.game_moves) else 0
+        self.data = None
+        moves_path = os.path.join(path, MOVES_FILE)
+        if os.path.getsize(moves_path):
+            with open(moves_path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, leveldb_path):
+        """Opens the move store of an index, returns None if the index has none"""
+        path = move_store_path(leveldb_path)
+        if not os.path.exists(os.path.join(path, GAME_MOVES_FILE)):
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return self.num_games
+
+    def game_end(self, game_id):
+        return self.game_moves[game_id + 1]
+
+    def encoded_moves(self, game_id):
+        """The 16 bit moves of a game's main line as an array"""
+        moves = array(MOVE_TYPECODE)
+        start, end = self.game_moves[game_id], self.game_moves[game_id + 1]
+        if end > start:
+            moves.fromstring(self.data[start * 2:end * 2])
+            if sys.byteorder == 'big':
+                moves.byteswap()
+        return moves
+
+    def moves(self, game_id):
+        """The chess.Move objects of a game's main line"""
+        return [decode_move(m) for m in self.encoded_moves(game_id)]
+
+    def replay(self, game_id, board=None):
+        """
+        Plays the main line of a game on board, a new board at the starting
+        position by default, yielding the ply and move before each move is
+        pushed. Games with a FEN header need a board set up at their FEN.
+        """
+        if board is None:
+            board = chess.Board()
+        for ply, move in enumerate(self.moves(game_id)):
+            yield ply, move
+            board.push(move)
@@ -0,0 +1,253 @@
+import multiprocessing
+import os
+import re
+import struct
+
+from game_store import Column
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PATTERN_STORE_DIR = "patterns"
+BITBOARDS_FILE = "bitboards"
+GAME_ROWS_FILE = "game_rows"
+
+# One occupancy bitboard per piece, white pieces in upper case, a1 is bit 0
+PIECES = "PNBRQKpnbrqk"
+BITBOARD_ROW = struct.Struct('<12Q')
+GAME_ROW = struct.Struct('<Q')
+BB_ALL = 0xffffffffffffffff
+BB_DARK_SQUARES = 0xaa55aa55aa55aa55
+BB_LIGHT_SQUARES = 0x55aa55aa55aa55aa
+SQUARE_SETS = {"light": BB_LIGHT_SQUARES, "dark": BB_DARK_SQUARES, "*": BB_ALL}
+
+# Rows buffered before they are written out
+WRITE_BUFFER_ROWS = 10000
+# Stores smaller than this are scanned in the calling process
+PARALLEL_SCAN_ROWS = 1000000
+
+PATTERN_TERM_REGEX = re.compile(r"^(!?)([PNBRQKpnbrqk])@?([a-h][1-8]|light|dark|\*)$")
+
+
+def pattern_store_path(leveldb_path):
+    return os.path.join(leveldb_path, PATTERN_STORE_DIR)
+
+
+def board_bitboards(board):
+    """The 12 piece occupancy bitboards of a position, in PIECES order"""
+    rows = []
+    for color in [True, False]:
+        occupied = board.occupied_co[color]
+        rows.extend([board.pawns & occupied, board.knights & occupied, board.bishops & occupied,
+                     board.rooks & occupied, board.queens & occupied, board.kings & occupied])
+    return rows
+
+
+def parse_pattern(text):
+    """
+    Parses a pattern such as "Nd5,pd6,!b@light" into (piece, square mask,
+    present) terms. Each term is a piece letter, upper case for white, and a
+    square, light, dark or *. A leading ! asks for no such piece there.
+    Raises ValueError for a malformed pattern.
+    """
+    terms = []
+    for term in re.split(r"[,\s]+", text.strip()):
+        if not term:
+            continue
+        match = PATTERN_TERM_REGEX.match(term)
+        if not match:
+            raise ValueError("invalid pattern term: {0}".format(term))
+        absent, piece, squares = match.groups()
+        if squares in SQUARE_SETS:
+            mask = SQUARE_SETS[squares]
+        else:
+            mask = 1 << ((int(squares[1]) - 1) * 8 + "abcdefgh".index(squares[0]))
+        terms.append((PIECES.index(piece), mask, not absent))
+    if not terms:
+        raise ValueError("empty pattern")
+    return terms
+
+
+def match_rows(bitboards, terms):
+    """Boolean mask of the rows of an (n, 12) bitboard array matching every term"""
+    matches = numpy.ones(len(bitboards), dtype=bool)
+    for piece, mask, present in terms:
+        hits = (bitboards[:, piece] & numpy.uint64(mask)) != 0
+        matches &= hits if present else ~hits
+    return matches
+
+
+def scan_rows(args):
+    """Pool worker, returns the matching rows of [start, end) of a bitboard file"""
+    path, start, end, terms = args
+    bitboards = numpy.memmap(path, dtype='<u8', mode='r', offset=start * BITBOARD_ROW.size,
+                             shape=(end - start, len(PIECES)))
+    return numpy.flatnonzero(match_rows(bitboards, terms)) + start
+
+
+class PatternStoreWriter(object):
+    """
+    Appends the bitboards of every indexed position to a pattern store.
+
+    bitboards holds one row of 12 little endian uint64 occupancy bitboards
+    per position, game after game and ply after ply. game_rows holds the
+    first row of every game followed by the row count, so game N covers
+    rows game_rows[N] to game_rows[N + 1].
+
+    If num_games is given, games past it are dropped first, which is how an
+    interrupted index build discards the rows written after its checkpoint.
+    """
+    def __init__(self, path, num_games=None):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        game_rows_path = os.path.join(path, GAME_ROWS_FILE)
+        bitboards_path = os.path.join(path, BITBOARDS_FILE)
+        self.game_rows_file = open(game_rows_path, "ab")
+        self.bitboards_file = open(bitboards_path, "ab")
+        size = os.path.getsize(game_rows_path)
+        if num_games is not None and size > (num_games + 1) * GAME_ROW.size:
+            self.game_rows_file.truncate((num_games + 1) * GAME_ROW.size)
+            self.game_rows_file.seek(0, os.SEEK_END)
+            size = (num_games + 1) * GAME_ROW.size
+        if size:
+            with open(game_rows_path, "rb") as f:
+                f.seek(size - GAME_ROW.size)
+                self.num_rows = GAME_ROW.unpack(f.read(GAME_ROW.size))[0]
+            self.num_games = size / GAME_ROW.size - 1
+        else:
+            self.num_rows = 0
+            self.num_games = 0
+            self.game_rows_file.write(GAME_ROW.pack(0))
+        self.bitboards_file.truncate(self.num_rows * BITBOARD_ROW.size)
+        self.bitboards_file.seek(0, os.SEEK_END)
+        self.game_rows = []
+        self.rows = []
+
+    def add_game(self, rows):
+        """Adds a game from the bitboards of each of its positions, see board_bitboards"""
+        for row in rows:
+            self.rows.extend(row)
+        self.num_rows += len(rows)
+        self.num_games += 1
+        self.game_rows.append(self.num_rows)
+        if len(self.rows) >= WRITE_BUFFER_ROWS * len(PIECES):
+            self.flush()
+
+    def extend(self, store):
+        """Appends every game of another PatternStore"""
+        row_offset = self.num_rows
+        self.flush()
+        with open(os.path.join(store.path, BITBOARDS_FILE), "rb") as f:
+            while True:
+                block = f.read(BITBOARD_ROW.size * WRITE_BUFFER_ROWS)
+                if not block:
+                    break
+                self.bitboards_file.write(block)
+        for game in xrange(store.num_games):
+            self.game_rows.append(store.game_end(game) + row_offset)
+        self.num_rows += store.num_rows
+        self.num_games += store.num_games
+        self.flush()
+
+    def flush(self):
+        # Rows before the game_rows entries that point at them
+        if self.rows:
+            self.bitboards_file.write(struct.pack("<{0}Q".format(len(self.rows)), *self.rows))
+            self.rows = []
+        if self.game_rows:
+            self.game_rows_file.write(struct.pack("<{0}Q".format(len(self.game_rows)), *self.game_rows))
+            self.game_rows = []
+        self.bitboards_file.flush()
+        self.game_rows_file.flush()
+
+    def close(self):
+        self.flush()
+        self.bitboards_file.close()
+        self.game_rows_file.close()
+
+
+class PatternStore(object):
+    """
+    Searches the positions of an index for partial board patterns.
+
+    The bitboard file is memory-mapped as an (n, 12) numpy array and each
+    pattern term is one vectorised AND and compare over a column. Large
+    stores are split into row ranges scanned by a pool of processes. The
+    game_rows index is memory-mapped too, so opening the store reads
+    neither file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bitboards_path = os.path.join(path, BITBOARDS_FILE)
+        self.game_rows = Column(os.path.join(path, GAME_ROWS_FILE), "<Q", "<u8")
+        self.num_games = max(len(self.game_rows) - 1, 0)
+        self.num_rows = self.game_rows[self.num_games] if len(self.game_rows) else 0
+
+    @classmethod
+    def open(cls, leveldb_path):
+        """Opens the pattern store of an index, returns None if the index has none"""
+        path = pattern_store_path(leveldb_path)
+        if not os.path.exists(os.path.join(path, GAME_ROWS_FILE)):
+            return None
+        return cls(path)
+
+    def game_end(self, game_id):
+        return self.game_rows[game_id + 1]
+
+    def bitboards(self, game_id, ply):
+        """The 12 bitboards of a position of a game"""
+        with open(self.bitboards_path, "rb") as f:
+            f.seek((self.game_rows[game_id] + ply) * BITBOARD_ROW.size)
+            return BITBOARD_ROW.unpack(f.read(BITBOARD_ROW.size))
+
+    def matching_rows(self, terms, processes=None):
+        if not self.num_rows:
+            return []
+        if numpy is None:
+            return self.matching_rows_unvectorised(terms)
+        processes = processes or multiprocessing.cpu_count()
+        if processes <= 1 or self.num_rows < PARALLEL_SCAN_ROWS:
+            return scan_rows((self.bitboards_path, 0, self.num_rows, terms))
+        step = self.num_rows / processes + 1
+        tasks = [(self.bitboards_path, start, min(start + step, self.num_rows), terms)
+                 for start in xrange(0, self.num_rows, step)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            return numpy.concatenate(pool.map(scan_rows, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    def matching_rows_unvectorised(self, terms):
+        rows = []
+        with open(self.bitboards_path, "rb") as f:
+            for row in xrange(self.num_rows):
+                bitboards = BITBOARD_ROW.unpack(f.read(BITBOARD_ROW.size))
+                if all(bool(bitboards[piece] & mask) == present for piece, mask, present in terms):
+                    rows.append(row)
+        return rows
+
+    def search(self, pattern, processes=None):
+        """
+        Returns the (game id, ply) pairs of the games reaching a position
+        that matches the pattern, see parse_pattern, with the first ply each
+        game does.
+        """
+        terms = parse_pattern(pattern) if isinstance(pattern, basestring) else pattern
+        rows = self.matching_rows(terms, processes)
+        if numpy is not None:
+            game_rows = self.game_rows.values
+            games = numpy.searchsorted(game_rows, numpy.asarray(rows, dtype=numpy.uint64), side="right") - 1
+            games, first = numpy.unique(games, return_index=True)
+            return [(int(g), int(rows[i]) - int(game_rows[g])) for g, i in zip(games, first)]
+        results = []
+        game = 0
+        for row in rows:
+            while self.game_rows[game + 1] <= row:
+                game += 1
+            if not results or results[-1][0] != game:
+                results.append((game, row - self.game_rows[game]))
+        return results
@@ -0,0 +1,1479 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+from itertools import groupby
+import leveldb
+import chess
+import chess.pgn
+
+from leveldict import INDEX_FORMAT, INDEX_FORMAT_PACKED, RECORD_PREFIX, POSTINGS_PREFIX, RECORD_HEADER
+from leveldict import PositionRecord, encode_record, decode_record, encode_postings, decode_postings
+from leveldict import position_key, split_position_key, PartitionedLevelDB
+from leveldict import TOKEN_INDEX, TOKEN_PREFIX, header_tokens, token_key, named_key, split_named_key
+from leveldict import MATERIAL_PREFIX, PAWN_STRUCTURE_PREFIX, STRUCTURE_PREFIXES, pawn_structure_name
+from leveldict import encode_ply_postings, decode_ply_postings, encode_position_postings, decode_position_postings
+from game_store import HeaderStore, HeaderStoreWriter, header_store_path, write_string_tables, STRING_OFFSETS_FILE
+from game_store import GameOffsetsWriter, GAME_OFFSETS, game_offsets_path
+from bloom_filter import BloomFilter, bloom_filter_path
+from pattern_search import PatternStore, PatternStoreWriter, board_bitboards, pattern_store_path, GAME_ROWS_FILE
+from move_store import MoveStore, MoveStoreWriter, move_store_path, GAME_MOVES_FILE
+from duplicates import DuplicateTracker, DUPLICATES_SKIP, DUPLICATES_FLAG, FINGERPRINTS_FILE, FINGERPRINT
+from duplicates import append_fingerprint
+from compressed_pgn import CompressedPgnReader, open_pgn, compression, pgn_size, compress_pgn, GZIP, BZIP2
+from compressed_pgn import read_seek_points, write_seek_points, seek_points_path
+from compressed_pgn import read_last_seek_point, append_seek_point
+
+INDEX_TOTAL_GAME_COUNT = "total_game_count"
+INDEX_PGN_FILENAME = "pgn_filename"
+INDEX_NUM_PASSES = "numPasses"
+# Present while a build is unfinished, holds what is needed to resume it
+INDEX_CHECKPOINT = "indexCheckpoint"
+# Indexing limits, 0 when positions at every ply were indexed
+INDEX_MAX_PLY = "maxPly"
+INDEX_MIN_FREQUENCY = "minFrequency"
+# Number of duplicate games skipped or flagged, only written when duplicates were looked for
+INDEX_DUPLICATE_GAMES = "duplicateGames"
+
+# Flush the pending partition to LevelDB once its estimated size passes this
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Number of puts per LevelDB write batch
+WRITE_BATCH_SIZE = 10000
+
+# Rough CPython costs used to estimate the size of the pending partition
+POSITION_OVERHEAD = 600
+GAME_ID_OVERHEAD = 48
+MOVE_OVERHEAD = 80
+GAME_HEADER_OVERHEAD = 200
+TOKEN_OVERHEAD = 150
+STRUCTURE_OVERHEAD = 150
+STRUCTURE_ENTRY_OVERHEAD = 80
+
+# Headers whose words go into the token index used by the database filter
+TOKEN_HEADERS = ["White", "Black", "Event", "Site"]
+
+TAG_REGEX = re.compile(r"\[([A-Za-z0-9]+)\s+\"(.*)\"\]")
+
+MOVETEXT_REGEX = re.compile(r"""
+    (\()
+    |(\))
+    |(\*|1-0|0-1|1/2-1/2)
+    |(
+        [NBKRQ]?[a-h]?[1-8]?[\-x]?[a-h][1-8](?:=?[nbrqNBRQ])?
+        |--
+        |O-O(?:-O)?
+        |0-0(?:-0)?
+    )
+    """, re.VERBOSE)
+
+
+# Piece order of material signatures
+MATERIAL_ORDER = [chess.KING, chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN]
+
+
+def material_signature(board):
+    """Material signature of a position, such as KRPvKR"""
+    sides = []
+    for color in [chess.WHITE, chess.BLACK]:
+        sides.append("".join(chess.PIECE_SYMBOLS[piece_type].upper() *
+                             bin(board.pieces_mask(piece_type, color)).count("1") for piece_type in MATERIAL_ORDER))
+    return "v".join(sides)
+
+
+def pawn_structure(board):
+    """Name of the pawn structure of a position in the pawn structure index"""
+    return pawn_structure_name(board.pawns & board.occupied_co[chess.WHITE],
+                               board.pawns & board.occupied_co[chess.BLACK])
+
+
+def add_structures(structures, board, ply, material):
+    """Records the material signature and pawn structure of a position unless the game reached them before"""
+    structures.setdefault((MATERIAL_PREFIX, material), ply)
+    structures.setdefault((PAWN_STRUCTURE_PREFIX, pawn_structure(board)), ply)
+
+
+class IndexedGame(object):
+    """Headers, main line positions and byte range of a game read by read_indexed_game"""
+    def __init__(self, start_offset):
+        self.headers = {}
+        self.positions = []
+        # (prefix, name) of every material signature and pawn structure reached -> first ply
+        self.structures = {}
+        # Piece bitboards of every position, when read with bitboards=True
+        self.bitboards = []
+        # Every main line move as written, see fingerprint_move, including the ones past max_ply
+        self.moves = []
+        self.start_offset = start_offset
+        self.end_offset = start_offset
+
+
+def strip_comments(line, in_comment):
+    """Removes {} and ; comments from a movetext line, returns the rest and whether a {} comment is still open"""
+    text = []
+    i = 0
+    while i < len(line):
+        if in_comment:
+            end = line.find("}", i)
+            if end < 0:
+                return "".join(text), True
+            i = end + 1
+            in_comment = False
+        else:
+            start = line.find("{", i)
+            semicolon = line.find(";", i)
+            if semicolon >= 0 and (start < 0 or semicolon < start):
+                text.append(line[i:semicolon])
+                return "".join(text), False
+            if start < 0:
+                text.append(line[i:])
+                break
+            text.append(line[i:start])
+            i = start + 1
+            in_comment = True
+    return "".join(text), in_comment
+
+
+def read_indexed_game(handle, max_ply=None, bitboards=False):
+    """
+    Reads the next game from a PGN file for indexing.
+
+    Unlike read_game no game tree is built: comments, NAGs and variations
+    are skipped and only the main line is replayed. The returned game lists
+    the (zobrist hash, move) pair of every main line move in positions, and
+    records the byte offsets where the game starts and ends, so a single
+    sequential pass over the file yields both the offset table and the
+    position index. The material signatures and pawn structures reached are
+    collected in structures, and with bitboards=True the piece bitboards of
+    every position in bitboards. With max_ply, moves past that ply are not
+    replayed, but are still listed in moves for game_fingerprint.
+
+    Returns None at the end of the file.
+    """
+    game = None
+    board = None
+    material = None
+    found_content = False
+    in_comment = False
+    depth = 0
+
+    while True:
+        line_start = handle.tell()
+        line = handle.readline()
+        if not line:
+            break
+        stripped = line.strip()
+
+        if board is None:
+            # Header section
+            if not stripped or stripped.startswith("%"):
+                continue
+            tag_match = TAG_REGEX.match(stripped)
+            if game is None:
+                game = IndexedGame(line_start)
+            if tag_match:
+                game.headers[tag_match.group(1)] = tag_match.group(2)
+                game.end_offset = handle.tell()
+                continue
+            try:
+                board = chess.Board(game.headers.get("FEN", chess.STARTING_FEN))
+            except ValueError:
+                board = chess.Board()
+            material = material_signature(board)
+            add_structures(game.structures, board, 0, material)
+            if bitboards:
+                game.bitboards.append(board_bitboards(board))
+        elif not in_comment:
+            if not stripped and found_content:
+                game.end_offset = handle.tell()
+                return game
+            if not depth and stripped.startswith("[") and TAG_REGEX.match(stripped):
+                # The next game starts without a blank line in between
+                handle.seek(line_start)
+                return game
+            if stripped.startswith("%"):
+                continue
+
+        text, in_comment = strip_comments(line, in_comment)
+        for match in MOVETEXT_REGEX.finditer(text):
+            token = match.group(0)
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif depth:
+                continue
+            elif token in ["1-0", "0-1", "1/2-1/2", "*"]:
+                found_content = True
+            else:
+                found_content = True
+                if token == "0-0":
+                    token = "O-O"
+                elif token == "0-0-0":
+                    token = "O-O-O"
+                game.moves.append(fingerprint_move(token))
+                if max_ply is not None and len(game.positions) >= max_ply:
+                    continue
+                try:
+                    move = board.parse_san(token)
+                except ValueError:
+                    continue
+                if move:
+                    game.positions.append((board.zobrist_hash(), move))
+                    # Material only changes on captures and promotions
+                    changes_material = move.promotion or board.is_capture(move)
+                    board.push(move)
+                    if changes_material:
+                        material = material_signature(board)
+                    add_structures(game.structures, board, len(game.positions), material)
+                    if bitboards:
+                        game.bitboards.append(board_bitboards(board))
+                else:
+                    board.push(move)
+        game.end_offset = handle.tell()
+
+    return game
+
+
+def fingerprint_move(san):
+    """A SAN move without check marks and the = of promotions, as compared by game_fingerprint"""
+    san = san.rstrip("+#!?").replace("=", "")
+    if san[-1] in "nbrq" and san[-2].isdigit():
+        san = san[:-1] + san[-1].upper()
+    return san
+
+
+def game_fingerprint(game):
+    """
+    Returns a 64 bit hash of a game's players, year, result and main line
+    moves, used to find duplicate games. The event, site and round are left
+    out and only the year of the date is used, as they are often written
+    differently when the same game appears in several collections.
+    """
+    headers = game.headers
+    if isinstance(game, IndexedGame):
+        moves = game.moves
+    else:
+        moves = []
+        board = game.board()
+        node = game
+        while node.variations:
+            node = node.variation(0)
+            moves.append(fingerprint_move(board.san(node.move)))
+            board.push(node.move)
+    digest = hashlib.md5()
+    for header in ["White", "Black"]:
+        digest.update(" ".join(header_tokens(headers.get(header, ""))) + "|")
+    digest.update(headers.get("Date", "")[:4] + "|" + headers.get("Result", "*") + "|")
+    digest.update(" ".join(moves))
+    return struct.unpack("<Q", digest.digest()[:8])[0]
+
+
+def game_positions(game, max_ply=None):
+    """Returns the (zobrist hash, move) pairs of a game's main line, up to max_ply moves"""
+    if isinstance(game, IndexedGame):
+        return game.positions[:max_ply]
+    positions = []
+    board = game.board()
+    node = game
+    while node.variations and (max_ply is None or len(positions) < max_ply):
+        node = node.variation(0)
+        positions.append((board.zobrist_hash(), node.move))
+        board.push(node.move)
+    return positions
+
+
+def game_structures(game, max_ply=None):
+    """Returns the material signatures and pawn structures reached by a game's main line, see IndexedGame"""
+    if isinstance(game, IndexedGame):
+        return game.structures
+    structures = {}
+    board = game.board()
+    add_structures(structures, board, 0, material_signature(board))
+    for ply, (zobrist_hash, move) in enumerate(game_positions(game, max_ply)):
+        board.push(move)
+        add_structures(structures, board, ply + 1, material_signature(board))
+    return structures
+
+
+def game_bitboards(game, max_ply=None):
+    """Returns the piece bitboards of every position of a game's main line, see pattern_search.board_bitboards"""
+    if isinstance(game, IndexedGame):
+        return game.bitboards
+    board = game.board()
+    rows = [board_bitboards(board)]
+    for zobrist_hash, move in game_positions(game, max_ply):
+        board.push(move)
+        rows.append(board_bitboards(board))
+    return rows
+
+
+def game_result(headers):
+    """Returns the white score (1, 0, -1) and whether the game was drawn"""
+    result = headers.get("Result", "*")
+    if result == '1-0':
+        return 1, False
+    elif result == '0-1':
+        return -1, False
+    elif result == '1/2-1/2':
+        return 0, True
+    return 0, False
+
+
+def game_header_fields(headers, offset):
+    """Header fields of a game in DB_HEADER_MAP order"""
+    try:
+        white_elo = int(headers['WhiteElo'])
+    except (KeyError, ValueError):
+        white_elo = 2400
+    try:
+        black_elo = int(headers['BlackElo'])
+    except (KeyError, ValueError):
+        black_elo = 2400
+
+    return [headers.get('White', '?'), white_elo, headers.get('Black', '?'), black_elo,
+            headers.get('Result', '*'), headers.get('Date', '?'), headers.get('Event', '?'),
+            headers.get('Site', '?'), headers.get('ECO', '*'), offset, headers.get('FEN', '*')]
+
+
+def game_header_record(headers, offset):
+    """Pipe delimited game record as laid out by DB_HEADER_MAP"""
+    return "|".join(str(f) for f in game_header_fields(headers, offset))
+
+
+def read_checkpoint(db):
+    try:
+        return json.loads(db.Get(INDEX_CHECKPOINT))
+    except KeyError:
+        return None
+
+
+def index_is_complete(leveldb_path):
+    """True if the index was fully built, False if its build was interrupted"""
+    db = leveldb.LevelDB(leveldb_path)
+    try:
+        db.Get(INDEX_TOTAL_GAME_COUNT)
+    except KeyError:
+        return False
+    return read_checkpoint(db) is None
+
+
+def create_indexer(pgn_path, leveldb_path, processes=1, **options):
+    """
+    Indexer building the index of a PGN file in processes, taking the options
+    of PgnIndexer. An interrupted build is resumed the way it was started,
+    whatever the number of processes: a parallel build with the chunks it
+    was split into, a single pass build in a single pass.
+    """
+    checkpoint = None
+    if os.path.exists(leveldb_path):
+        db = leveldb.LevelDB(leveldb_path)
+        checkpoint = read_checkpoint(db)
+        del db
+    if checkpoint is not None:
+        parallel = "boundaries" in checkpoint
+    else:
+        parallel = processes > 1
+    if parallel:
+        return ParallelPgnIndexer(pgn_path, leveldb_path, processes=max(processes, 1), **options)
+    return PgnIndexer(pgn_path, leveldb_path, **options)
+
+
+def progress_total_bytes(pgn_path):
+    """Bytes an index build of the file reads, 0 if unknown, as for a compressed file"""
+    if not os.path.exists(pgn_path) or compression(pgn_path) is not None:
+        return 0
+    return os.path.getsize(pgn_path)
+
+
+class IndexProgress(object):
+    """
+    Progress of an index build, polled by the UI or the command line while
+    the build runs in another thread.
+
+    Work restored from a checkpoint is counted in the totals but not in the
+    rates. Without total_bytes there is no percentage or ETA. With
+    shared=True the counters live in shared memory, so the worker processes
+    of a ParallelPgnIndexer can update them.
+    """
+    # games, positions, bytes, then the same for resumed work
+    NUM_COUNTERS = 6
+
+    def __init__(self, total_bytes=0, shared=False):
+        self.total_bytes = total_bytes
+        self.shared = shared
+        if shared:
+            self.counters = multiprocessing.Array('d', self.NUM_COUNTERS)
+        else:
+            self.counters = [0.0] * self.NUM_COUNTERS
+        self.start_time = time.time()
+        self.done = False
+
+    def add(self, games, positions, num_bytes, resumed=False):
+        if self.shared:
+            with self.counters.get_lock():
+                self.add_counts(games, positions, num_bytes, resumed)
+        else:
+            self.add_counts(games, positions, num_bytes, resumed)
+
+    def add_counts(self, games, positions, num_bytes, resumed):
+        self.counters[0] += games
+        self.counters[1] += positions
+        self.counters[2] += num_bytes
+        if resumed:
+            self.counters[3] += games
+            self.counters[4] += positions
+            self.counters[5] += num_bytes
+
+    def resume(self, games, num_bytes):
+        """Counts the games and bytes indexed before the build was interrupted"""
+        self.add(games, 0, num_bytes, resumed=True)
+
+    def snapshot(self):
+        """Returns the totals, the rates per second and the estimated seconds left"""
+        games, positions, num_bytes, resumed_games, resumed_positions, resumed_bytes = self.counters[:]
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        bytes_per_sec = (num_bytes - resumed_bytes) / elapsed
+        eta = None
+        if self.done:
+            eta = 0
+        elif bytes_per_sec > 0 and self.total_bytes:
+            eta = max(self.total_bytes - num_bytes, 0) / bytes_per_sec
+        return {"games": int(games), "positions": int(positions), "bytes": int(num_bytes),
+                "total_bytes": self.total_bytes, "elapsed": elapsed,
+                "games_per_sec": (games - resumed_games) / elapsed,
+                "positions_per_sec": (positions - resumed_positions) / elapsed,
+                "bytes_per_sec": bytes_per_sec, "eta": eta, "done": self.done}
+
+    def __str__(self):
+        stats = self.snapshot()
+        if stats["eta"] is None:
+            eta = "?"
+        else:
+            eta = "{0:.0f}s".format(stats["eta"])
+        if stats["total_bytes"]:
+            percent = "{0:.1f}%".format(100.0 * stats["bytes"] / stats["total_bytes"])
+        else:
+            percent = "{0:.1f} MB".format(stats["bytes"] / (1024.0 * 1024))
+        return "{0} games, {1} positions, {2} ({3:.0f} games/s, {4:.0f} positions/s, {5:.2f} MB/s), ETA {6}".format(
+            stats["games"], stats["positions"], percent, stats["games_per_sec"], stats["positions_per_sec"],
+            stats["bytes_per_sec"] / (1024 * 1024), eta)
+
+
+def prune_positions(db, min_frequency):
+    """
+    Deletes the records and posting lists of the positions reached fewer
+    than min_frequency times over all partitions. Their games stay in the
+    index and the positions can still be reached by replaying them.
+    Returns the number of positions deleted.
+    """
+    pruned = 0
+    if min_frequency <= 1:
+        return pruned
+    batch = leveldb.WriteBatch()
+    pending = 0
+    items = db.RangeIter(key_from=RECORD_PREFIX, key_to=POSTINGS_PREFIX)
+    for zobrist_hash, fragments in groupby(items, lambda item: split_position_key(item[0])[1]):
+        fragments = list(fragments)
+        # Only the record header is needed for the frequency
+        if sum(RECORD_HEADER.unpack_from(v)[1] for k, v in fragments) >= min_frequency:
+            continue
+        for k, v in fragments:
+            batch.Delete(k)
+            batch.Delete(POSTINGS_PREFIX + k[1:])
+            pending += 2
+        pruned += 1
+        if pending >= WRITE_BATCH_SIZE:
+            db.Write(batch)
+            batch = leveldb.WriteBatch()
+            pending = 0
+    db.Write(batch)
+    logging.info("pruned {0} positions seen fewer than {1} times".format(pruned, min_frequency))
+    return pruned
+
+
+def build_bloom_filter(db, leveldb_path):
+    """Saves a Bloom filter over the zobrist hashes of every position in the index"""
+    def record_keys():
+        return db.RangeIter(key_from=RECORD_PREFIX, key_to=POSTINGS_PREFIX, include_value=False)
+
+    # Counts every partition of a position, which only oversizes the filter
+    bloom_filter = BloomFilter.for_capacity(sum(1 for k in record_keys()))
+    last_hash = None
+    for k in record_keys():
+        zobrist_hash = split_position_key(k)[1]
+        if zobrist_hash != last_hash:
+            bloom_filter.add(zobrist_hash)
+            last_hash = zobrist_hash
+    bloom_filter.save(bloom_filter_path(leveldb_path))
+    return bloom_filter
+
+
+class PositionStats(PositionRecord):
+    """PositionRecord that also collects the ids of the games reaching the position and the ply they do"""
+    def __init__(self):
+        PositionRecord.__init__(self)
+        self.game_ids = []
+        self.plies = []
+
+    def postings(self):
+        return zip(self.game_ids, self.plies)
+
+
+class PgnIndexer(object):
+    """
+    Streams a PGN file into a partitioned LevelDB index.
+
+    Positions are accumulated in memory until the estimated size of the
+    pending partition reaches memory_budget bytes. The partition is then
+    written to LevelDB in write batches and the in-memory index is dropped,
+    so peak memory does not depend on the size of the PGN file.
+
+    Each position gets one packed record (freq, white score, draws and the
+    results of every move played from it) and one binary posting list per
+    partition, keyed by its 8 byte zobrist hash and the partition number,
+    see leveldict.position_key.
+
+    Every flush also records a checkpoint with the file offset reached, so
+    an interrupted build resumes from its last partition instead of starting
+    over, see index_range. Progress is counted in self.progress.
+
+    Only the first max_ply moves of each game are indexed when max_ply is
+    set, and positions reached fewer than min_frequency times in the whole
+    file are pruned once every game is indexed. Both limits are stored in
+    the index metadata.
+
+    With patterns=True the piece bitboards of every position are written to
+    a pattern store for partial board searches, see pattern_search.
+
+    With duplicates set to DUPLICATES_SKIP or DUPLICATES_FLAG, games with
+    the same game_fingerprint as a game indexed before are skipped, or
+    indexed anyway, and listed in a duplicate report, see
+    duplicates.DuplicateTracker.
+
+    The game headers are also written to a columnar header store next to
+    the LevelDB files, see game_store.HeaderStore, the byte range of every
+    game to a game offsets file, see game_store.GameStore, the main line
+    moves to a 16 bit move store, see move_store.MoveStore, and the words of the
+    player, event and site names to an inverted index of posting lists per
+    partition, see leveldict.token_key. Material signatures and pawn
+    structures are indexed the same way, with the first ply each game
+    reaches them.
+
+    The PGN file may be gzip or bzip2 compressed. Game offsets then count
+    uncompressed bytes and the seek points found while reading it are
+    written next to the index, see compressed_pgn.CompressedPgnReader.
+    """
+    def __init__(self, pgn_path, leveldb_path, memory_budget=DEFAULT_MEMORY_BUDGET, progress=None,
+                 max_ply=None, min_frequency=1, patterns=False, duplicates=None):
+        self.pgn_path = pgn_path
+        self.leveldb_path = leveldb_path
+        self.memory_budget = memory_budget
+        self.max_ply = max_ply
+        self.min_frequency = min_frequency
+        self.patterns = patterns
+        self.duplicates = duplicates
+        self.num_duplicates = 0
+        self.partition = 0
+        self.num_games = 0
+        self.next_offset = 0
+        self.header_writer = None
+        # Number and total size of the header store strings covered by the checkpoint
+        self.header_strings = (0, 0)
+        self.pattern_writer = None
+        self.offsets_writer = None
+        self.move_writer = None
+        self.duplicate_tracker = None
+        if progress is None:
+            progress = IndexProgress(progress_total_bytes(pgn_path))
+        self.progress = progress
+        self.reset()
+
+    def reset(self):
+        self.position_index = {}
+        self.game_index = {}
+        self.token_index = {}
+        self.structure_index = {}
+        self.pending_bytes = 0
+
+    def add_game(self, game_num, game, offset):
+        headers = game.headers
+        result, draw = game_result(headers)
+
+        fields = game_header_fields(headers, offset)
+        self.game_index[game_num] = "|".join(str(f) for f in fields)
+        self.pending_bytes += GAME_HEADER_OVERHEAD
+        if self.header_writer is not None:
+            self.header_writer.add(fields)
+        if self.pattern_writer is not None:
+            self.pattern_writer.add_game(game_bitboards(game, self.max_ply))
+        if self.move_writer is not None:
+            self.move_writer.add_game(move for zobrist_hash, move in game_positions(game, self.max_ply))
+
+        tokens = set()
+        for header in TOKEN_HEADERS:
+            tokens.update(header_tokens(headers.get(header, "")))
+        for token in tokens:
+            game_ids = self.token_index.get(token)
+            if game_ids is None:
+                game_ids = self.token_index[token] = []
+                self.pending_bytes += TOKEN_OVERHEAD
+            game_ids.append(game_num)
+            self.pending_bytes += GAME_ID_OVERHEAD
+
+        for structure, ply in game_structures(game, self.max_ply).iteritems():
+            entries = self.structure_index.get(structure)
+            if entries is None:
+                entries = self.structure_index[structure] = []
+                self.pending_bytes += STRUCTURE_OVERHEAD
+            entries.append((game_num, ply))
+            self.pending_bytes += STRUCTURE_ENTRY_OVERHEAD
+
+        # White wins, draws and black wins counted for every move of the game
+        move_result = (int(result == 1), int(draw), int(result == -1))
+
+        for ply, (zobrist_hash, move) in enumerate(game_positions(game, self.max_ply)):
+            stats = self.position_index.get(zobrist_hash)
+            if stats is None:
+                stats = self.position_index[zobrist_hash] = PositionStats()
+                self.pending_bytes += POSITION_OVERHEAD
+            stats.freq += 1
+            stats.white_score += result
+            if draw:
+                stats.draws += 1
+            uci = move.uci()
+            if uci not in stats.move_stats:
+                self.pending_bytes += MOVE_OVERHEAD
+            stats.add_move(uci, *move_result)
+            if not stats.game_ids or stats.game_ids[-1] != game_num:
+                stats.game_ids.append(game_num)
+                stats.plies.append(ply)
+                stats.num_games += 1
+                self.pending_bytes += GAME_ID_OVERHEAD
+
+    def write_batches(self, db, items):
+        batch = leveldb.WriteBatch()
+        pending = 0
+        for k, v in items:
+            batch.Put(k, v)
+            pending += 1
+            if pending >= WRITE_BATCH_SIZE:
+                db.Write(batch)
+                batch = leveldb.WriteBatch()
+                pending = 0
+        if pending:
+            db.Write(batch)
+
+    def partition_items(self):
+        for k, v in self.game_index.iteritems():
+            yield "game_{0}_data".format(k), v
+        for k, v in self.position_index.iteritems():
+            yield position_key(RECORD_PREFIX, k, self.partition), encode_record(v)
+            yield position_key(POSTINGS_PREFIX, k, self.partition), encode_position_postings(v.postings())
+        for k, v in self.token_index.iteritems():
+            yield token_key(k, self.partition), encode_postings(v)
+        for (prefix, name), v in self.structure_index.iteritems():
+            yield named_key(prefix, name, self.partition), encode_ply_postings(v)
+
+    def checkpoint_item(self):
+        report_size = self.duplicate_tracker.report_size() if self.duplicate_tracker is not None else 0
+        if self.header_writer is not None:
+            self.header_strings = self.header_writer.num_strings, self.header_writer.strings_size
+        return INDEX_CHECKPOINT, json.dumps({"offset": self.next_offset, "partition": self.partition,
+                                             "num_games": self.num_games, "memory_budget": self.memory_budget,
+                                             "max_ply": self.max_ply, "min_frequency": self.min_frequency,
+                                             "patterns": self.patterns, "duplicates": self.duplicates,
+                                             "report_size": report_size, "header_strings": self.header_strings})
+
+    def flush(self, db):
+        if not self.position_index and not self.game_index:
+            return
+        logging.info("writing partition {0} ({1} positions, {2} games)".format(
+            self.partition, len(self.position_index), len(self.game_index)))
+        # Header, pattern and offset rows must be on disk before the checkpoint that covers them
+        if self.header_writer is not None:
+            self.header_writer.flush()
+        if self.offsets_writer is not None:
+            self.offsets_writer.flush()
+        if self.move_writer is not None:
+            self.move_writer.flush()
+        if self.pattern_writer is not None:
+            self.pattern_writer.flush()
+        if self.duplicate_tracker is not None:
+            self.duplicate_tracker.flush()
+        self.write_batches(db, self.partition_items())
+        self.partition += 1
+        # Written last, so a partition is only skipped on resume once all of it is stored
+        self.write_batches(db, [self.checkpoint_item()])
+        self.reset()
+        logging.info(str(self.progress))
+
+    def write_metadata(self, db):
+        last_partition = max(self.partition - 1, 0)
+        batch = leveldb.WriteBatch()
+        batch.Put(INDEX_TOTAL_GAME_COUNT, str(self.num_games))
+        batch.Put(INDEX_PGN_FILENAME, self.pgn_path)
+        batch.Put(INDEX_NUM_PASSES, str(last_partition))
+        batch.Put(INDEX_FORMAT, INDEX_FORMAT_PACKED)
+        batch.Put(TOKEN_INDEX, "1")
+        batch.Put(INDEX_MAX_PLY, str(self.max_ply or 0))
+        batch.Put(INDEX_MIN_FREQUENCY, str(self.min_frequency))
+        if self.duplicates:
+            batch.Put(INDEX_DUPLICATE_GAMES, str(self.num_duplicates))
+        batch.Delete(INDEX_CHECKPOINT)
+        db.Write(batch, sync=True)
+
+    def append_game(self, db, game, offset, index=None):
+        """
+        Indexes a single game appended to the end of the PGN file.
+
+        The game gets the next game number and its positions are merged
+        into the last partition of the existing index, so saving a game
+        does not require rebuilding the index. The game is indexed up to the
+        max ply of the index, but is not pruned by its min frequency. It is
+        indexed even if it duplicates another game, but its fingerprint is
+        recorded so later builds and appends see it.
+
+        The files next to LevelDB only get the game appended, or its bits set
+        in the Bloom filter, none of them is read whole. index, the open
+        PartitionedLevelDB of db if there is one, gets the game added to its
+        Bloom filter and seek points and its stores mapped again instead of
+        reloading its files.
+
+        Indexes written before positions were packed into one record get the
+        game merged into their per-field keys instead, see legacy_position_items.
+        """
+        self.reset()
+        game_num = int(db.Get(INDEX_TOTAL_GAME_COUNT))
+        try:
+            packed = db.Get(INDEX_FORMAT) == INDEX_FORMAT_PACKED
+        except KeyError:
+            packed = False
+        try:
+            self.partition = int(db.Get(INDEX_NUM_PASSES))
+            legacy_suffix = "_p_{0}".format(self.partition)
+        except KeyError:
+            # Unpartitioned legacy index, keys have no _p_N suffix
+            self.partition = 0
+            legacy_suffix = ""
+        try:
+            self.max_ply = int(db.Get(INDEX_MAX_PLY)) or None
+        except KeyError:
+            self.max_ply = None
+        # Indexes built before the header store existed keep using the LevelDB records only.
+        # Opening a writer reads at most the last entry of its store.
+        header_path = header_store_path(self.leveldb_path)
+        if os.path.exists(os.path.join(header_path, STRING_OFFSETS_FILE)):
+            self.header_writer = HeaderStoreWriter(header_path)
+            if self.header_writer.num_rows != game_num:
+                self.header_writer.close()
+                self.header_writer = None
+        patterns_path = pattern_store_path(self.leveldb_path)
+        if os.path.exists(os.path.join(patterns_path, GAME_ROWS_FILE)):
+            self.pattern_writer = PatternStoreWriter(patterns_path)
+            if self.pattern_writer.num_games != game_num:
+                self.pattern_writer.close()
+                self.pattern_writer = None
+        moves_path = move_store_path(self.leveldb_path)
+        if os.path.exists(os.path.join(moves_path, GAME_MOVES_FILE)):
+            self.move_writer = MoveStoreWriter(moves_path)
+            if self.move_writer.num_games != game_num:
+                self.move_writer.close()
+                self.move_writer = None
+        last_seek_point = read_last_seek_point(self.leveldb_path)
+        end_offset = pgn_size(self.pgn_path, [last_seek_point] if last_seek_point is not None else None)
+        seek_point = None
+        if last_seek_point is not None:
+            # The appended gzip member or bzip2 stream starts at the end the index knew of
+            seek_point = (os.path.getsize(self.pgn_path), end_offset)
+            append_seek_point(self.leveldb_path, seek_point)
+        offsets_path = game_offsets_path(self.leveldb_path)
+        if os.path.exists(offsets_path) and os.path.getsize(offsets_path) == game_num * GAME_OFFSETS.size:
+            # The game was appended at offset - 1, up to the end of the file
+            self.offsets_writer = GameOffsetsWriter(offsets_path)
+            self.offsets_writer.add(offset - 1, end_offset)
+        fingerprints_path = os.path.join(self.leveldb_path, FINGERPRINTS_FILE)
+        if os.path.exists(fingerprints_path) and os.path.getsize(fingerprints_path) == game_num * FINGERPRINT.size:
+            append_fingerprint(self.leveldb_path, game_fingerprint(game))
+        try:
+            self.add_game(game_num, game, offset)
+        finally:
+            self.close_writers()
+
+        items = [("game_{0}_data".format(game_num), self.game_index[game_num])]
+        for k, v in self.position_index.iteritems():
+            if not packed:
+                items.extend(self.legacy_position_items(db, k, v, legacy_suffix))
+                continue
+            record_key = position_key(RECORD_PREFIX, k, self.partition)
+            postings_key = position_key(POSTINGS_PREFIX, k, self.partition)
+            try:
+                record = decode_record(db.Get(record_key)).merge(v)
+                postings = decode_position_postings(db.Get(postings_key)) + v.postings()
+            except KeyError:
+                record = v
+                postings = v.postings()
+            items.append((record_key, encode_record(record)))
+            items.append((postings_key, encode_position_postings(postings)))
+        # Indexes built before the token index existed are left without one
+        try:
+            has_token_index = db.Get(TOKEN_INDEX) == "1"
+        except KeyError:
+            has_token_index = False
+        if has_token_index:
+            for token, token_game_ids in self.token_index.iteritems():
+                key = token_key(token, self.partition)
+                try:
+                    token_game_ids = list(decode_postings(db.Get(key))) + token_game_ids
+                except KeyError:
+                    pass
+                items.append((key, encode_postings(token_game_ids)))
+        for (prefix, name), entries in self.structure_index.iteritems():
+            key = named_key(prefix, name, self.partition)
+            try:
+                entries = decode_ply_postings(db.Get(key)) + entries
+            except KeyError:
+                pass
+            items.append((key, encode_ply_postings(entries)))
+        items.append((INDEX_TOTAL_GAME_COUNT, str(game_num + 1)))
+
+        # The Bloom filter has to know the new positions before lookups see them
+        BloomFilter.add_to_file(bloom_filter_path(self.leveldb_path), self.position_index)
+        if index is not None:
+            if index.bloom_filter is not None:
+                for zobrist_hash in self.position_index:
+                    index.bloom_filter.add(zobrist_hash)
+            if seek_point is not None and index.seek_points is not None:
+                index.seek_points.append(seek_point)
+
+        self.write_batches(db, items)
+        self.num_games = game_num + 1
+        self.reset()
+        if index is not None:
+            index.reopen_stores()
+        return game_num
+
+    def merge_value(self, db, key, value, numeric=False, unique=False):
+        try:
+            old = db.Get(key)
+        except KeyError:
+            return value
+        if numeric:
+            return str(int(old) + int(value))
+        tokens = [t for t in old.split(",") if t]
+        for t in value.split(","):
+            if t and not (unique and t in tokens):
+                tokens.append(t)
+        return ",".join(tokens)
+
+    def legacy_position_items(self, db, zobrist_hash, stats, suffix):
+        """Merges the stats of a position into the _freq, _moves, ... keys of a legacy index"""
+        k = str(zobrist_hash)
+        game_ids = stats.game_ids
+        try:
+            game_ids = list(decode_postings(db.Get(k + suffix))) + game_ids
+        except KeyError:
+            pass
+        yield k + suffix, encode_postings(game_ids)
+        for field, value in [("_freq", stats.freq), ("_white_score", stats.white_score), ("_draws", stats.draws)]:
+            key = k + field + suffix
+            yield key, self.merge_value(db, key, str(value), numeric=True)
+        key = k + "_moves" + suffix
+        yield key, self.merge_value(db, key, ",".join(stats.moves), unique=True)
+
+    def index_range(self, db, start_offset=0, end_offset=None, first_game_num=0, skipped=None):
+        """
+        Indexes the games starting in [start_offset, end_offset) of the PGN file in one pass.
+        The games starting at an offset in skipped are left out, see
+        ParallelPgnIndexer.cross_chunk_duplicates.
+
+        If db holds the checkpoint of an interrupted build, indexing resumes
+        from it with the memory budget of that build, so that the partitions
+        are cut at the same games and the keys of the partition that was being
+        written when the build stopped are overwritten.
+        """
+        checkpoint = read_checkpoint(db)
+        if checkpoint is not None and "offset" not in checkpoint:
+            raise ValueError("{0} is being built in chunks, resume it with a ParallelPgnIndexer".format(
+                self.leveldb_path))
+        if checkpoint is not None:
+            self.partition = checkpoint["partition"]
+            self.num_games = checkpoint["num_games"]
+            self.memory_budget = checkpoint["memory_budget"]
+            self.max_ply = checkpoint.get("max_ply")
+            self.min_frequency = checkpoint.get("min_frequency", 1)
+            self.patterns = checkpoint.get("patterns", False)
+            self.duplicates = checkpoint.get("duplicates")
+            self.header_strings = checkpoint.get("header_strings", (None, None))
+            self.progress.resume(self.num_games, checkpoint["offset"] - start_offset)
+            logging.info("resuming index build at offset {0}, partition {1}".format(
+                checkpoint["offset"], self.partition))
+            start_offset = checkpoint["offset"]
+        self.next_offset = start_offset
+        if self.duplicates:
+            # Drops the fingerprints and report lines written after the checkpoint
+            report_size = checkpoint.get("report_size", 0) if checkpoint is not None else 0
+            self.duplicate_tracker = DuplicateTracker(self.leveldb_path, num_games=self.num_games,
+                                                      report_size=report_size)
+        if checkpoint is None:
+            self.write_batches(db, [self.checkpoint_item()])
+
+        num_strings, strings_size = self.header_strings
+        self.header_writer = HeaderStoreWriter(header_store_path(self.leveldb_path), num_rows=self.num_games,
+                                               num_strings=num_strings, strings_size=strings_size)
+        self.offsets_writer = GameOffsetsWriter(game_offsets_path(self.leveldb_path), num_games=self.num_games)
+        self.move_writer = MoveStoreWriter(move_store_path(self.leveldb_path), num_games=self.num_games)
+        if self.patterns:
+            self.pattern_writer = PatternStoreWriter(pattern_store_path(self.leveldb_path), num_games=self.num_games)
+        try:
+            self.read_games(db, start_offset, end_offset, first_game_num, skipped)
+        finally:
+            self.close_writers()
+        self.flush(db)
+
+    def close_writers(self):
+        if self.header_writer is not None:
+            self.header_writer.close()
+            self.header_writer = None
+        if self.pattern_writer is not None:
+            self.pattern_writer.close()
+            self.pattern_writer = None
+        if self.offsets_writer is not None:
+            self.offsets_writer.close()
+            self.offsets_writer = None
+        if self.move_writer is not None:
+            self.move_writer.close()
+            self.move_writer = None
+        if self.duplicate_tracker is not None:
+            self.num_duplicates = self.duplicate_tracker.num_duplicates
+            self.duplicate_tracker.close()
+            self.duplicate_tracker = None
+
+    def read_games(self, db, start_offset, end_offset, first_game_num, skipped=None):
+        # The seek points of an interrupted build get a compressed file to start_offset faster
+        with open_pgn(self.pgn_path, read_seek_points(self.leveldb_path)) as pgn:
+            pgn.seek(start_offset)
+            while True:
+                game = read_indexed_game(pgn, self.max_ply, self.patterns)
+                if game is None or (end_offset is not None and game.start_offset >= end_offset):
+                    break
+                if (skipped and game.start_offset in skipped) or \
+                        (self.duplicate_tracker is not None and self.is_skipped_duplicate(game, first_game_num)):
+                    self.progress.add(0, 0, game.end_offset - self.next_offset)
+                    self.next_offset = game.end_offset
+                    continue
+                # Offsets point just past the opening bracket of the Event tag,
+                # which is where get_file_seek_segment expects to start reading.
+                self.add_game(first_game_num + self.num_games, game, game.start_offset + 1)
+                self.offsets_writer.add(game.start_offset, game.end_offset)
+                self.num_games += 1
+                self.progress.add(1, len(game.positions), game.end_offset - self.next_offset)
+                self.next_offset = game.end_offset
+                if self.pending_bytes >= self.memory_budget:
+                    self.flush(db)
+            if isinstance(pgn, CompressedPgnReader):
+                write_seek_points(self.leveldb_path, pgn.index_seek_points())
+
+    def is_skipped_duplicate(self, game, first_game_num):
+        """Looks the game up in the duplicate tracker, returns True if it should not be indexed"""
+        fingerprint = game_fingerprint(game)
+        original = self.duplicate_tracker.find(fingerprint)
+        if original is not None:
+            headers = game.headers
+            self.duplicate_tracker.report(game.start_offset + 1, first_game_num + original, self.duplicates,
+                                          headers.get("White", "?"), headers.get("Black", "?"),
+                                          headers.get("Date", "?"))
+            if self.duplicates == DUPLICATES_SKIP:
+                return True
+        self.duplicate_tracker.add(fingerprint)
+        return False
+
+    def index(self):
+        db = leveldb.LevelDB(self.leveldb_path)
+        self.index_range(db)
+        write_string_tables(header_store_path(self.leveldb_path))
+        prune_positions(db, self.min_frequency)
+        build_bloom_filter(db, self.leveldb_path)
+        self.write_metadata(db)
+        self.progress.done = True
+        return self.num_games
+
+
+# Progress counters shared with the pool workers, set by init_worker
+worker_progress = None
+
+
+def init_worker(progress):
+    global worker_progress
+    worker_progress = progress
+
+
+def index_chunk(args):
+    """
+    Worker entry point for ParallelPgnIndexer, indexes one chunk into its own LevelDB.
+
+    A chunk that was completed by an interrupted build is not indexed again,
+    one that was not resumes from its checkpoint.
+    """
+    pgn_path, chunk_path, memory_budget, max_ply, patterns, duplicates, start_offset, end_offset, skipped = args
+    db = leveldb.LevelDB(chunk_path)
+    if read_checkpoint(db) is None:
+        try:
+            num_games = int(db.Get(INDEX_TOTAL_GAME_COUNT))
+            num_partitions = int(db.Get(INDEX_NUM_PASSES)) + 1 if num_games else 0
+            if worker_progress is not None:
+                worker_progress.resume(num_games, (end_offset or os.path.getsize(pgn_path)) - start_offset)
+            return num_games, num_partitions
+        except KeyError:
+            pass
+    indexer = PgnIndexer(pgn_path, chunk_path, memory_budget=memory_budget, progress=worker_progress,
+                         max_ply=max_ply, patterns=patterns, duplicates=duplicates)
+    indexer.index_range(db, start_offset, end_offset, skipped=skipped)
+    # Marks the chunk as complete
+    indexer.write_metadata(db)
+    return indexer.num_games, indexer.partition
+
+
+def fingerprint_chunk(args):
+    """
+    Worker entry point for ParallelPgnIndexer.cross_chunk_duplicates, lists
+    the (offset, fingerprint) of every game of a chunk.
+    """
+    pgn_path, start_offset, end_offset = args
+    games = []
+    with open_pgn(pgn_path) as pgn:
+        pgn.seek(start_offset)
+        while True:
+            # The moves are listed for the fingerprint without being replayed
+            game = read_indexed_game(pgn, max_ply=0)
+            if game is None or (end_offset is not None and game.start_offset >= end_offset):
+                break
+            games.append((game.start_offset, game_fingerprint(game)))
+    return games
+
+
+class ParallelPgnIndexer(object):
+    """
+    Indexes a PGN file with a pool of worker processes.
+
+    The file is cut into roughly equal byte ranges, each starting at the
+    Event tag of a game. Each worker indexes its range into a private
+    LevelDB with game numbers starting at 0. The chunks are then copied into
+    the final index with their game numbers shifted past the games of the
+    previous chunks and their partitions renumbered into one consecutive
+    sequence.
+
+    The final index keeps a checkpoint with the chunk boundaries and the
+    number of chunks merged so far. An interrupted build reuses the
+    boundaries, skips the merged chunks and lets every other chunk resume
+    from its own checkpoint.
+
+    Duplicate games are skipped or flagged by each worker within its chunk.
+    When they are flagged, a game repeating a game of an earlier chunk is
+    flagged as the chunks are merged. When they are skipped, the chunks are
+    fingerprinted before they are indexed, so that the workers also skip the
+    repeats of earlier chunks, see cross_chunk_duplicates.
+
+    A compressed PGN file is indexed as a single chunk.
+    """
+    def __init__(self, pgn_path, leveldb_path, processes=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 max_ply=None, min_frequency=1, patterns=False, duplicates=None):
+        self.pgn_path = pgn_path
+        self.leveldb_path = leveldb_path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.memory_budget = memory_budget
+        self.max_ply = max_ply
+        self.min_frequency = min_frequency
+        self.patterns = patterns
+        self.duplicates = duplicates
+        self.pattern_writer = None
+        self.offsets_writer = None
+        self.move_writer = None
+        self.duplicate_tracker = None
+        self.num_games = 0
+        self.partition = 0
+        self.progress = IndexProgress(progress_total_bytes(pgn_path), shared=True)
+
+    def chunk_boundaries(self):
+        """Returns the offsets where each chunk starts, found by seeking instead of scanning the file"""
+        if compression(self.pgn_path) is not None:
+            # The uncompressed offsets are only known once the file was read, so it is one chunk
+            return [0]
+        chunk_size = os.path.getsize(self.pgn_path) / self.processes + 1
+        boundaries = [0]
+        with open(self.pgn_path) as pgn:
+            for chunk in range(1, self.processes):
+                pgn.seek(max(chunk * chunk_size, boundaries[-1]))
+                # Skip the partial line and move to the next game
+                pgn.readline()
+                while True:
+                    offset = pgn.tell()
+                    line = pgn.readline()
+                    if not line or line.startswith("[Event \""):
+                        break
+                if not line:
+                    break
+                if offset > boundaries[-1]:
+                    boundaries.append(offset)
+        return boundaries
+
+    def chunk_path(self, chunk):
+        return "{0}.chunk{1}".format(self.leveldb_path, chunk)
+
+    def chunk_tasks(self, boundaries, skipped=None):
+        budget = self.memory_budget / self.processes
+        tasks = []
+        for chunk, start_offset in enumerate(boundaries):
+            if chunk + 1 < len(boundaries):
+                end_offset = boundaries[chunk + 1]
+            else:
+                end_offset = None
+            tasks.append((self.pgn_path, self.chunk_path(chunk), budget, self.max_ply, self.patterns,
+                          self.duplicates, start_offset, end_offset, skipped[chunk] if skipped else None))
+        return tasks
+
+    def cross_chunk_duplicates(self, pool, boundaries):
+        """
+        Finds the games repeating a game of an earlier chunk, which a worker
+        cannot see. Every chunk is fingerprinted in the pool, then the games
+        are numbered in file order the way the merge numbers them, leaving
+        out the repeats. Returns an {offset: id of the repeated game} dict per
+        chunk. Repeats within a chunk are left to its worker.
+        """
+        ends = boundaries[1:] + [None]
+        chunks = pool.map(fingerprint_chunk, [(self.pgn_path, start, end) for start, end in zip(boundaries, ends)])
+        # Fingerprint -> (game id, chunk) of its first game
+        first_games = {}
+        num_games = 0
+        skipped = []
+        for chunk, games in enumerate(chunks):
+            chunk_skipped = {}
+            for offset, fingerprint in games:
+                first = first_games.get(fingerprint)
+                if first is None:
+                    first_games[fingerprint] = (num_games, chunk)
+                    num_games += 1
+                elif first[1] < chunk:
+                    chunk_skipped[offset] = first[0]
+            skipped.append(chunk_skipped)
+        return skipped
+
+    def skipped_reports(self, skipped):
+        """Yields the report fields of the games of a chunk skipped by cross_chunk_duplicates, in file order"""
+        with open_pgn(self.pgn_path) as pgn:
+            for offset in sorted(skipped):
+                pgn.seek(offset)
+                headers = read_indexed_game(pgn, max_ply=0).headers
+                yield (offset + 1, skipped[offset], DUPLICATES_SKIP, headers.get("White", "?"),
+                       headers.get("Black", "?"), headers.get("Date", "?"))
+
+    def renumbered_items(self, chunk_db):
+        for k, v in chunk_db.RangeIter():
+            if k[0] in (RECORD_PREFIX, POSTINGS_PREFIX):
+                prefix, zobrist_hash, partition = split_position_key(k)
+                if prefix == POSTINGS_PREFIX:
+                    v = encode_position_postings((g + self.num_games, ply) for g, ply in decode_position_postings(v))
+                k = position_key(prefix, zobrist_hash, partition + self.partition)
+            elif k[0] == TOKEN_PREFIX:
+                prefix, token, partition = split_named_key(k)
+                v = encode_postings(g + self.num_games for g in decode_postings(v))
+                k = token_key(token, partition + self.partition)
+            elif k[0] in STRUCTURE_PREFIXES:
+                prefix, name, partition = split_named_key(k)
+                v = encode_ply_postings((g + self.num_games, ply) for g, ply in decode_ply_postings(v))
+                k = named_key(prefix, name, partition + self.partition)
+            elif k.startswith("game_"):
+                k = "game_{0}_data".format(int(k.split("_")[1]) + self.num_games)
+            else:
+                # Chunk metadata
+                continue
+            yield k, v
+
+    def merge_chunk(self, db, chunk_path, writer, header_writer, skipped=None):
+        """Copies a chunk index into db after the games and partitions already merged"""
+        chunk_db = leveldb.LevelDB(chunk_path)
+        writer.write_batches(db, self.renumbered_items(chunk_db))
+        del chunk_db
+        if self.offsets_writer is not None and os.path.exists(game_offsets_path(chunk_path)):
+            self.offsets_writer.extend(game_offsets_path(chunk_path))
+        chunk_store = HeaderStore.open(chunk_path)
+        if self.duplicate_tracker is not None:
+            self.duplicate_tracker.extend(chunk_path, chunk_store, self.skipped_reports(skipped or {}))
+        if chunk_store is not None:
+            header_writer.extend(chunk_store)
+            del chunk_store
+        chunk_moves = MoveStore.open(chunk_path)
+        if self.move_writer is not None and chunk_moves is not None:
+            self.move_writer.extend(chunk_moves)
+            del chunk_moves
+        chunk_patterns = PatternStore.open(chunk_path)
+        if self.pattern_writer is not None and chunk_patterns is not None:
+            self.pattern_writer.extend(chunk_patterns)
+        # Only a compressed file has seek points, and it is never split into several chunks
+        if os.path.exists(seek_points_path(chunk_path)):
+            shutil.copyfile(seek_points_path(chunk_path), seek_points_path(self.leveldb_path))
+
+    def checkpoint_item(self, boundaries, merged, header_writer=None):
+        report_size = self.duplicate_tracker.report_size() if self.duplicate_tracker is not None else 0
+        header_strings = (0, 0)
+        if header_writer is not None:
+            header_strings = header_writer.num_strings, header_writer.strings_size
+        return INDEX_CHECKPOINT, json.dumps({"boundaries": boundaries, "merged": merged,
+                                             "num_games": self.num_games, "partition": self.partition,
+                                             "max_ply": self.max_ply, "min_frequency": self.min_frequency,
+                                             "patterns": self.patterns, "duplicates": self.duplicates,
+                                             "report_size": report_size, "header_strings": header_strings})
+
+    def remove_chunks(self, num_chunks):
+        for chunk in range(num_chunks):
+            if os.path.exists(self.chunk_path(chunk)):
+                shutil.rmtree(self.chunk_path(chunk))
+
+    def index(self):
+        db = leveldb.LevelDB(self.leveldb_path)
+        writer = PgnIndexer(self.pgn_path, self.leveldb_path, memory_budget=self.memory_budget,
+                            progress=self.progress)
+        checkpoint = read_checkpoint(db)
+        report_size = 0
+        header_strings = (0, 0)
+        if checkpoint is None:
+            boundaries = self.chunk_boundaries()
+            merged = 0
+            # Chunks left by a build that stopped before writing its checkpoint
+            self.remove_chunks(self.processes)
+            writer.write_batches(db, [self.checkpoint_item(boundaries, merged)])
+        elif "boundaries" not in checkpoint:
+            raise ValueError("{0} is being built in a single pass, resume it with a PgnIndexer".format(
+                self.leveldb_path))
+        else:
+            # The chunks are those of the interrupted build, whatever the number of processes
+            boundaries = checkpoint["boundaries"]
+            merged = checkpoint["merged"]
+            self.num_games = checkpoint["num_games"]
+            self.partition = checkpoint["partition"]
+            self.max_ply = checkpoint.get("max_ply")
+            self.min_frequency = checkpoint.get("min_frequency", 1)
+            self.patterns = checkpoint.get("patterns", False)
+            self.duplicates = checkpoint.get("duplicates")
+            report_size = checkpoint.get("report_size", 0)
+            header_strings = checkpoint.get("header_strings", (None, None))
+            resumed_bytes = boundaries[merged] if merged < len(boundaries) else self.progress.total_bytes
+            self.progress.resume(self.num_games, resumed_bytes)
+            logging.info("resuming index build after {0} merged chunks".format(merged))
+        # The workers are forked without the open LevelDB
+        del db
+
+        pool = multiprocessing.Pool(self.processes, initializer=init_worker, initargs=(self.progress,))
+        try:
+            skipped = None
+            if self.duplicates == DUPLICATES_SKIP and len(boundaries) > 1:
+                # Every chunk is fingerprinted again on resume, the merged ones number the games after them
+                skipped = self.cross_chunk_duplicates(pool, boundaries)
+            tasks = self.chunk_tasks(boundaries, skipped)
+            results = pool.map(index_chunk, tasks[merged:])
+        finally:
+            pool.close()
+            pool.join()
+
+        db = leveldb.LevelDB(self.leveldb_path)
+        # Drops the header rows of a chunk whose merge was interrupted
+        header_writer = HeaderStoreWriter(header_store_path(self.leveldb_path), num_rows=self.num_games,
+                                          num_strings=header_strings[0], strings_size=header_strings[1])
+        self.offsets_writer = GameOffsetsWriter(game_offsets_path(self.leveldb_path), num_games=self.num_games)
+        self.move_writer = MoveStoreWriter(move_store_path(self.leveldb_path), num_games=self.num_games)
+        if self.patterns:
+            self.pattern_writer = PatternStoreWriter(pattern_store_path(self.leveldb_path), num_games=self.num_games)
+        if self.duplicates:
+            self.duplicate_tracker = DuplicateTracker(self.leveldb_path, num_games=self.num_games,
+                                                      report_size=report_size)
+        for task, (num_games, num_partitions) in zip(tasks[merged:], results):
+            self.merge_chunk(db, task[1], writer, header_writer, task[-1])
+            self.num_games += num_games
+            self.partition += num_partitions
+            merged += 1
+            header_writer.flush()
+            self.offsets_writer.flush()
+            self.move_writer.flush()
+            if self.pattern_writer is not None:
+                self.pattern_writer.flush()
+            if self.duplicate_tracker is not None:
+                self.duplicate_tracker.flush()
+            writer.write_batches(db, [self.checkpoint_item(boundaries, merged, header_writer)])
+            shutil.rmtree(task[1])
+        header_writer.close()
+        write_string_tables(header_store_path(self.leveldb_path))
+        self.offsets_writer.close()
+        self.offsets_writer = None
+        self.move_writer.close()
+        self.move_writer = None
+        if self.pattern_writer is not None:
+            self.pattern_writer.close()
+            self.pattern_writer = None
+        if self.duplicate_tracker is not None:
+            writer.num_duplicates = self.duplicate_tracker.num_duplicates
+            self.duplicate_tracker.close()
+            self.duplicate_tracker = None
+
+        prune_positions(db, self.min_frequency)
+        build_bloom_filter(db, self.leveldb_path)
+        writer.num_games = self.num_games
+        writer.partition = self.partition
+        writer.max_ply = self.max_ply
+        writer.min_frequency = self.min_frequency
+        writer.duplicates = self.duplicates
+        writer.write_metadata(db)
+        self.remove_chunks(len(boundaries))
+        self.progress.done = True
+        return self.num_games
+
+
+# Counters summed by legacy compaction, every other legacy key holds a comma separated list
+LEGACY_COUNTER_SUFFIXES = ("_freq", "_white_score", "_draws")
+
+
+class IndexCompactor(object):
+    """
+    Merges the partitions of an index into partition 0.
+
+    Every position record is merged with PositionRecord.merge, posting lists,
+    token lists and structure lists are unioned, and the keys of the other partitions are
+    deleted in the same write batch as the merged key, so a position reads
+    the same before and after it is compacted. Once every key is merged
+    numPasses is set to 0 and a lookup is a single Get again.
+
+    Legacy indexes keep their <hash>_p_N layout, with the counters summed
+    and the move and game lists unioned into the _p_0 keys.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.merged_keys = 0
+        self.deleted_keys = 0
+
+    def packed_groups(self):
+        """Yields the fragments of every packed key, grouped per position or token"""
+        def group_key(item):
+            k = item[0]
+            if k[0] in (RECORD_PREFIX, POSTINGS_PREFIX):
+                return split_position_key(k)[:2]
+            return split_named_key(k)[:2]
+
+        for prefix in (RECORD_PREFIX, POSTINGS_PREFIX, TOKEN_PREFIX) + STRUCTURE_PREFIXES:
+            # Keys of the next prefix start at chr(prefix + 1), which is never a key itself
+            items = self.db.db.RangeIter(key_from=prefix, key_to=chr(ord(prefix) + 1))
+            for (group_prefix, name), fragments in groupby(items, group_key):
+                fragments = list(fragments)
+                if group_prefix == RECORD_PREFIX:
+                    record = decode_record(fragments[0][1])
+                    for k, v in fragments[1:]:
+                        record.merge(decode_record(v))
+                    yield position_key(RECORD_PREFIX, name), encode_record(record), fragments
+                elif group_prefix == POSTINGS_PREFIX:
+                    postings = []
+                    for k, v in fragments:
+                        postings.extend(decode_position_postings(v))
+                    yield position_key(POSTINGS_PREFIX, name), encode_position_postings(postings), fragments
+                elif group_prefix == TOKEN_PREFIX:
+                    game_ids = []
+                    for k, v in fragments:
+                        game_ids.extend(decode_postings(v))
+                    yield token_key(name), encode_postings(game_ids), fragments
+                else:
+                    entries = []
+                    for k, v in fragments:
+                        entries.extend(decode_ply_postings(v))
+                    yield named_key(group_prefix, name), encode_ply_postings(entries), fragments
+
+    def legacy_groups(self):
+        """Yields the fragments of every legacy key, grouped per key without its _p_N suffix"""
+        items = (item for item in self.db.db.RangeIter() if "_p_" in item[0])
+        for name, fragments in groupby(items, lambda item: item[0].rpartition("_p_")[0]):
+            fragments = list(fragments)
+            if name.endswith(LEGACY_COUNTER_SUFFIXES):
+                value = str(sum(int(v) for k, v in fragments))
+            elif name.endswith("_moves"):
+                moves = []
+                for k, v in fragments:
+                    moves.extend(m for m in v.split(",") if m and m not in moves)
+                value = ",".join(moves)
+            else:
+                game_ids = []
+                for k, v in fragments:
+                    game_ids.extend(decode_postings(v))
+                value = encode_postings(game_ids)
+            yield name + "_p_0", value, fragments
+
+    def compact(self):
+        if read_checkpoint(self.db.db) is not None:
+            raise ValueError("cannot compact an index whose build is not finished")
+        if not self.db.num_passes:
+            # Unpartitioned legacy index, keys have no _p_N suffix
+            return 0
+        groups = self.packed_groups() if self.db.packed else self.legacy_groups()
+        batch = leveldb.WriteBatch()
+        pending = 0
+        for key, value, fragments in groups:
+            if len(fragments) == 1 and fragments[0][0] == key:
+                continue
+            batch.Put(key, value)
+            for k, v in fragments:
+                if k != key:
+                    batch.Delete(k)
+                    self.deleted_keys += 1
+            self.merged_keys += 1
+            pending += len(fragments)
+            if pending >= WRITE_BATCH_SIZE:
+                self.db.db.Write(batch)
+                batch = leveldb.WriteBatch()
+                pending = 0
+        batch.Put(INDEX_NUM_PASSES, "0")
+        self.db.db.Write(batch, sync=True)
+        self.db.num_passes = "0"
+        logging.info("compacted {0} keys, deleted {1} partition fragments".format(
+            self.merged_keys, self.deleted_keys))
+        return self.merged_keys
+
+    def start(self):
+        """Compacts in a background thread, lookups on the same index keep working meanwhile"""
+        thread = threading.Thread(target=self.compact)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main(argv):
+    """
+    Builds or resumes the index of a PGN file from the command line, printing
+    progress every second, compacts an index with --compact, or compresses a
+    PGN file into gzip members (bzip2 streams for a .bz2 output) that the
+    index can seek to with --compress.
+    """
+    if len(argv) < 2:
+        print("usage: pgn_index.py <pgn file> [processes] | --compact <index dir> | --compress <pgn file> <output>")
+        return 1
+    if argv[1] == "--compact":
+        IndexCompactor(PartitionedLevelDB(argv[2])).compact()
+        return 0
+    if argv[1] == "--compress":
+        compress_pgn(argv[2], argv[3], BZIP2 if argv[3].endswith(".bz2") else GZIP)
+        return 0
+    pgn_path = argv[1]
+    processes = int(argv[2]) if len(argv) > 2 else multiprocessing.cpu_count()
+    indexer = create_indexer(pgn_path, pgn_path + ".db", processes)
+    thread = threading.Thread(target=indexer.index)
+    thread.daemon = True
+    thread.start()
+    while thread.is_alive():
+        thread.join(1)
+        print(str(indexer.progress))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
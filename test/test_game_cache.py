@@ -0,0 +1,78 @@
+import unittest
+
+import chess
+import chess.pgn
+
+from game_cache import GameCache, copy_game
+
+PGN_FILE = "test/kasparov-deep-blue-1997.pgn"
+
+
+class GameCacheTestCase(unittest.TestCase):
+    """Tests the LRU cache of parsed games."""
+
+    def test_hits_and_misses(self):
+        cache = GameCache(max_size=2)
+        self.assertEqual(cache.get("a.db", 0), None)
+        cache.put("a.db", 0, "game 0")
+        self.assertEqual(cache.get("a.db", 0), "game 0")
+        self.assertEqual(cache.get("b.db", 0), None)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 1.0 / 3)
+
+    def test_evicts_least_recently_used(self):
+        cache = GameCache(max_size=2)
+        cache.put("a.db", 0, "game 0")
+        cache.put("a.db", 1, "game 1")
+        cache.get("a.db", 0)
+        cache.put("a.db", 2, "game 2")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a.db", 1), None)
+        self.assertEqual(cache.get("a.db", 0), "game 0")
+        self.assertEqual(cache.get("a.db", 2), "game 2")
+
+    def test_invalidate(self):
+        cache = GameCache()
+        cache.put("a.db", 0, "game 0")
+        cache.put("b.db", 0, "other game 0")
+        cache.invalidate("a.db")
+        self.assertEqual(cache.get("a.db", 0), None)
+        self.assertEqual(cache.get("b.db", 0), "other game 0")
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_copy_game(self):
+        with open(PGN_FILE) as pgn:
+            game = chess.pgn.read_game(pgn)
+        moves = list(game.main_line())
+        positions = {}
+        node = game
+        while node.variations:
+            node = node.variation(0)
+            positions[node.board().zobrist_hash()] = node
+
+        copied, copied_positions = copy_game(game, positions)
+        self.assertEqual(list(copied.main_line()), moves)
+        self.assertEqual(copied.end().board().fen(), game.end().board().fen())
+        self.assertEqual(sorted(copied_positions), sorted(positions))
+        for zobrist_hash, node in copied_positions.iteritems():
+            self.assertTrue(node.root() is copied)
+            self.assertEqual(node.board().zobrist_hash(), zobrist_hash)
+
+        # Edits to the copy do not reach the cached game
+        copied.headers["White"] = "Someone else"
+        first = copied.variation(0)
+        first.nags.add(1)
+        first.comment = "changed"
+        first.add_variation(chess.Move.from_uci("a7a6"))
+        copied.variations[0].variations.pop(0)
+        self.assertEqual(game.headers["White"], "Garry Kasparov")
+        self.assertEqual(game.variation(0).nags, set())
+        self.assertEqual(game.variation(0).comment, "")
+        self.assertEqual(list(game.main_line()), moves)
+        self.assertEqual(list(copy_game(game).main_line()), moves)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from game_list import GameListPager
+
+
+class GameListPagerTestCase(unittest.TestCase):
+    """Tests paging the database list."""
+
+    def setUp(self):
+        self.fetched = []
+
+    def fetch_headers(self, game_ids):
+        self.fetched.append(list(game_ids))
+        return dict((g, "record {0}".format(g)) for g in game_ids)
+
+    def test_pages(self):
+        pager = GameListPager(range(100, 125), self.fetch_headers, page_size=10, prefetch=2)
+        self.assertEqual(pager.total, 25)
+        self.assertEqual(pager.num_pages, 3)
+        self.assertEqual(pager.page_ids(), range(100, 110))
+        self.assertEqual(pager.next_page(), range(110, 120))
+        self.assertEqual(pager.next_page(), range(120, 125))
+        self.assertEqual(pager.next_page(), range(120, 125))
+        self.assertEqual(pager.set_page(-3), range(100, 110))
+        self.assertEqual(GameListPager([], self.fetch_headers).num_pages, 1)
+
+    def test_fetches_window_once(self):
+        pager = GameListPager(range(100), self.fetch_headers, page_size=10, prefetch=2)
+        self.assertEqual(pager.header(3), "record 3")
+        self.assertEqual(pager.header(11), "record 11")
+        self.assertEqual(self.fetched, [range(12)])
+
+        pager.next_page()
+        self.assertEqual(pager.header(15), "record 15")
+        # Only the games the previous window did not cover
+        self.assertEqual(self.fetched[1], range(12, 22))
+        self.assertEqual(sorted(pager.headers), range(8, 22))
+
+    def test_sorts_as_far_as_needed(self):
+        limits = []
+
+        def order(game_ids, limit):
+            limits.append(limit)
+            return sorted(game_ids, reverse=True)[:limit]
+
+        pager = GameListPager(range(100), self.fetch_headers, page_size=10, prefetch=2, order=order)
+        self.assertEqual(pager.page_ids(), range(99, 89, -1))
+        self.assertEqual(pager.header(99), "record 99")
+        self.assertEqual(pager.next_page(), range(89, 79, -1))
+        self.assertEqual(pager.set_page(9), range(9, -1, -1))
+        self.assertEqual(pager.sorted_ids(), range(99, -1, -1))
+        self.assertEqual(limits, [10, 20, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,995 @@
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import chess
+import chess.pgn
+
+import bloom_filter
+import compressed_pgn
+import game_store
+import leveldict
+import move_store
+import pattern_search
+import pgn_index
+
+PGN_FILE = "test/kasparov-deep-blue-1997.pgn"
+
+
+class ReadIndexedGameTestCase(unittest.TestCase):
+    """Tests the single pass indexing reader."""
+
+    def test_matches_read_game(self):
+        with open(PGN_FILE) as pgn:
+            offsets = list(chess.pgn.scan_offsets(pgn))
+        with open(PGN_FILE) as pgn, open(PGN_FILE) as indexed_pgn:
+            for offset in offsets:
+                game = chess.pgn.read_game(pgn)
+                indexed_game = pgn_index.read_indexed_game(indexed_pgn)
+                self.assertEqual(indexed_game.start_offset, offset)
+                self.assertEqual(indexed_game.headers["Site"], game.headers["Site"])
+                self.assertEqual(indexed_game.positions, pgn_index.game_positions(game))
+            self.assertEqual(pgn_index.read_indexed_game(indexed_pgn), None)
+
+    def test_skips_comments_and_variations(self):
+        pgn_text = "\n".join([
+            '[Event "A"]',
+            '',
+            '1. e4 {a comment with 2. d4 and',
+            '',
+            'a blank line} e5 (1... c5 2. Nf3 (2. c3)) 2. Nf3 ; Nc3',
+            '$1 Nc6 1-0',
+            '[Event "B"]',
+            '1. d4 *',
+            ''])
+        pgn = StringIO(pgn_text)
+        first = pgn_index.read_indexed_game(pgn)
+        self.assertEqual([m.uci() for h, m in first.positions], ["e2e4", "e7e5", "g1f3", "b8c6"])
+        self.assertEqual(first.start_offset, 0)
+        self.assertEqual(first.end_offset, pgn_text.index('[Event "B"]'))
+
+        second = pgn_index.read_indexed_game(pgn)
+        self.assertEqual(second.headers["Event"], "B")
+        self.assertEqual(second.start_offset, first.end_offset)
+        self.assertEqual(second.end_offset, len(pgn_text))
+        self.assertEqual(pgn_index.read_indexed_game(pgn), None)
+
+    def test_fingerprint_matches_read_game(self):
+        with open(PGN_FILE) as pgn, open(PGN_FILE) as indexed_pgn:
+            fingerprints = set()
+            for i in range(6):
+                game = chess.pgn.read_game(pgn)
+                # Moves past max ply still count
+                indexed_game = pgn_index.read_indexed_game(indexed_pgn, max_ply=2)
+                fingerprint = pgn_index.game_fingerprint(game)
+                self.assertEqual(pgn_index.game_fingerprint(indexed_game), fingerprint)
+                fingerprints.add(fingerprint)
+        self.assertEqual(len(fingerprints), 6)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedPgnIndexer(pgn_index.PgnIndexer):
+    """Stops while reading the fourth game, after three partitions were written"""
+    def add_game(self, game_num, game, offset):
+        if game_num == 3:
+            raise Interrupted()
+        pgn_index.PgnIndexer.add_game(self, game_num, game, offset)
+
+
+class KilledPgnIndexer(pgn_index.PgnIndexer):
+    """Dies without closing its files while reading the fifth game, as on SIGKILL"""
+    def add_game(self, game_num, game, offset):
+        if game_num == 4:
+            os._exit(1)
+        pgn_index.PgnIndexer.add_game(self, game_num, game, offset)
+
+
+def killed_build(pgn_path, leveldb_path):
+    KilledPgnIndexer(pgn_path, leveldb_path, memory_budget=1).index()
+
+
+class InterruptedParallelPgnIndexer(pgn_index.ParallelPgnIndexer):
+    """Stops while merging the second chunk"""
+    def merge_chunk(self, db, chunk_path, writer, header_writer, skipped=None):
+        if chunk_path.endswith("chunk1"):
+            header_writer.add(["?", 0, "?", 0, "*", "?", "?", "?", "?", 0])
+            raise Interrupted()
+        pgn_index.ParallelPgnIndexer.merge_chunk(self, db, chunk_path, writer, header_writer, skipped)
+
+
+class PgnIndexerTestCase(unittest.TestCase):
+    """Tests building LevelDB indexes from PGN files."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build_index(self, name, **kwargs):
+        leveldb_path = os.path.join(self.tmp_dir, name)
+        pgn_index.PgnIndexer(PGN_FILE, leveldb_path, **kwargs).index()
+        return leveldict.PartitionedLevelDB(leveldb_path)
+
+    def assertSamePosition(self, first, second, pos_hash):
+        def summary(record):
+            return (record.freq, record.white_score, record.draws, record.num_games,
+                    sorted((m.uci, m.wins, m.draws, m.losses) for m in record.move_stats.values()))
+
+        self.assertEqual(summary(first.get_position(pos_hash)), summary(second.get_position(pos_hash)))
+        self.assertEqual(first.get_game_ids(pos_hash), second.get_game_ids(pos_hash))
+
+    def test_partitioned_index_matches_single_pass(self):
+        single = self.build_index("single.db")
+        # A tiny budget forces a flush after every game
+        partitioned = self.build_index("partitioned.db", memory_budget=1)
+
+        self.assertEqual(single.num_passes, "0")
+        self.assertEqual(partitioned.num_passes, "5")
+        self.assertTrue(partitioned.packed)
+        self.assertEqual(partitioned.Get(pgn_index.INDEX_TOTAL_GAME_COUNT, regular=True), "6")
+
+        start_hash = str(chess.Board().zobrist_hash())
+        record = partitioned.get_position(start_hash)
+        self.assertEqual(record.freq, 6)
+        self.assertEqual(record.draws, 3)
+        self.assertEqual(record.white_score, 3)
+        self.assertEqual(record.num_games, 6)
+        self.assertEqual(set(record.moves), set(["g1f3", "e2e4", "d2d3"]))
+        e4 = record.move_stats["e2e4"]
+        self.assertEqual((e4.freq, e4.wins, e4.draws, e4.losses), (3, 2, 1, 0))
+        self.assertEqual(list(partitioned.get_game_ids(start_hash)), [0, 1, 2, 3, 4, 5])
+        self.assertSamePosition(single, partitioned, start_hash)
+        self.assertEqual(single.get_position("1234"), None)
+
+    def test_parallel_index_matches_single_pass(self):
+        single = self.build_index("single.db")
+        leveldb_path = os.path.join(self.tmp_dir, "parallel.db")
+        indexer = pgn_index.ParallelPgnIndexer(PGN_FILE, leveldb_path, processes=3, memory_budget=3)
+        self.assertEqual(indexer.index(), 6)
+        parallel = leveldict.PartitionedLevelDB(leveldb_path)
+
+        self.assertEqual(parallel.num_passes, "5")
+        self.assertFalse(os.path.exists(indexer.chunk_path(0)))
+        for game_num in range(6):
+            key = "game_{0}_data".format(game_num)
+            self.assertEqual(parallel.Get(key, regular=True), single.Get(key, regular=True))
+
+        board = chess.Board()
+        for san in ["e4", "c6", "d4"]:
+            board.push_san(san)
+            self.assertSamePosition(single, parallel, str(board.zobrist_hash()))
+
+    def test_append_game(self):
+        pgn_path = os.path.join(self.tmp_dir, "append.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "append.db")
+        pgn_index.PgnIndexer(pgn_path, leveldb_path, memory_budget=1).index()
+
+        game = chess.pgn.Game()
+        game.headers["White"] = "Appended"
+        game.add_main_variation(chess.Move.from_uci("e2e4")).add_main_variation(chess.Move.from_uci("e7e5"))
+        game.headers["Result"] = "0-1"
+        offset = os.path.getsize(pgn_path)
+        with open(pgn_path, "a") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        indexer = pgn_index.PgnIndexer(pgn_path, leveldb_path)
+        self.assertEqual(indexer.append_game(db.db, game, offset + 1), 6)
+
+        self.assertEqual(db.Get(pgn_index.INDEX_TOTAL_GAME_COUNT, regular=True), "7")
+        record = db.Get("game_6_data", regular=True).split("|")
+        self.assertEqual(record[0], "Appended")
+        self.assertEqual(int(record[9]), offset + 1)
+
+        board = chess.Board()
+        board.push_san("e4")
+        pos_hash = str(board.zobrist_hash())
+        self.assertEqual(list(db.get_game_ids(pos_hash)), [1, 3, 5, 6])
+        record = db.get_position(pos_hash)
+        self.assertEqual(record.freq, 4)
+        self.assertEqual(record.white_score, 1)
+        self.assertEqual(set(record.moves), set(["e7e5", "c7c6"]))
+        self.assertEqual(record.move_stats["e7e5"].losses, 1)
+
+    def test_binary_posting_lists(self):
+        db = self.build_index("postings.db", memory_budget=1)
+        start_hash = str(chess.Board().zobrist_hash())
+        key = leveldict.position_key(leveldict.POSTINGS_PREFIX, start_hash, 0)
+        self.assertTrue(db.Get(key, regular=True).startswith(leveldict.PLY_POSTINGS_MARKER))
+        self.assertEqual(list(db.get_game_ids("1234")), [])
+
+    def test_ply_postings(self):
+        partitioned = self.build_index("plies.db", memory_budget=1)
+        parallel_path = os.path.join(self.tmp_dir, "plies_parallel.db")
+        pgn_index.ParallelPgnIndexer(PGN_FILE, parallel_path, processes=3).index()
+        parallel = leveldict.PartitionedLevelDB(parallel_path)
+        with open(PGN_FILE) as pgn:
+            game = chess.pgn.read_game(pgn)
+        for ply, (zobrist_hash, move) in enumerate(pgn_index.game_positions(game)[:12]):
+            self.assertEqual(partitioned.get_game_ply(str(zobrist_hash), 0), ply)
+            for db in [partitioned, parallel]:
+                entries = db.get_game_plies(str(zobrist_hash))
+                self.assertEqual([g for g, p in entries], list(db.get_game_ids(str(zobrist_hash))))
+                self.assertTrue(all(p <= ply for g, p in entries))
+        self.assertEqual(partitioned.get_game_ply("1234", 0), None)
+        value = leveldict.encode_ply_postings([(2, 5), (4, 1), (9, 30)])
+        self.assertEqual([leveldict.find_game_ply(value, g) for g in [0, 2, 3, 4, 9, 10]], [None, 5, None, 1, 30, None])
+
+        start_hash = str(chess.Board().zobrist_hash())
+        plies = partitioned.get_game_plies(start_hash)
+        pgn_index.IndexCompactor(partitioned).compact()
+        self.assertEqual(partitioned.get_game_plies(start_hash), plies)
+        self.assertEqual(plies, [(g, 0) for g in range(6)])
+
+        # Merging with a posting list written without plies drops them
+        value = leveldict.encode_position_postings(
+            leveldict.decode_position_postings(leveldict.encode_postings([1, 3])) + [(5, 7)])
+        self.assertEqual(leveldict.decode_position_postings(value), [(1, None), (3, None), (5, None)])
+
+    def test_legacy_posting_lists(self):
+        self.assertEqual(list(leveldict.decode_postings("12,3,3,")), [3, 12])
+        value = leveldict.encode_postings([7, 2, 2, 100000])
+        self.assertEqual(len(value), 1 + 3 * 4)
+        self.assertEqual(list(leveldict.decode_postings(value)), [2, 7, 100000])
+
+    def build_legacy_index(self):
+        leveldb_path = os.path.join(self.tmp_dir, "legacy.db")
+        db = leveldict.LevelDict(leveldb_path)
+        db["numPasses"] = "1"
+        db["42_p_0"] = "1,2,"
+        db["42_p_1"] = "7,"
+        db["42_freq_p_0"] = "2"
+        db["42_freq_p_1"] = "1"
+        db["42_moves_p_0"] = str(leveldict.encode_move("e2e4"))
+        db["42_moves_p_1"] = "e2e4,g1f3"
+        db["42_white_score_p_0"] = "1"
+        db["42_draws_p_1"] = "1"
+        del db
+        return leveldict.PartitionedLevelDB(leveldb_path)
+
+    def test_legacy_index(self):
+        legacy = self.build_legacy_index()
+        self.assertFalse(legacy.packed)
+        record = legacy.get_position("42")
+        self.assertEqual((record.freq, record.white_score, record.draws), (3, 1, 1))
+        self.assertEqual(sorted(record.moves), ["e2e4", "g1f3"])
+        self.assertEqual(list(legacy.get_game_ids("42")), [1, 2, 7])
+        self.assertEqual(legacy.get_position("43"), None)
+
+    def test_append_game_legacy_index(self):
+        board = chess.Board()
+        board.push_san("e4")
+        key = str(board.zobrist_hash())
+        leveldb_path = os.path.join(self.tmp_dir, "legacy.db")
+        db = leveldict.LevelDict(leveldb_path)
+        db["numPasses"] = "0"
+        db[pgn_index.INDEX_TOTAL_GAME_COUNT] = "6"
+        db[key + "_p_0"] = "1,3,5,"
+        db[key + "_freq_p_0"] = "3"
+        db[key + "_white_score_p_0"] = "2"
+        db[key + "_draws_p_0"] = "1"
+        db[key + "_moves_p_0"] = "e7e5"
+        del db
+
+        game = chess.pgn.Game()
+        game.add_main_variation(chess.Move.from_uci("e2e4")).add_main_variation(chess.Move.from_uci("c7c5"))
+        game.headers["Result"] = "1-0"
+        pgn_path = os.path.join(self.tmp_dir, "legacy.pgn")
+        with open(pgn_path, "w") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+        legacy = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertEqual(pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(legacy.db, game, 1), 6)
+
+        self.assertFalse(legacy.packed)
+        self.assertEqual(list(legacy.get_game_ids(key)), [1, 3, 5, 6])
+        record = legacy.get_position(key)
+        self.assertEqual((record.freq, record.white_score, record.draws), (4, 3, 1))
+        self.assertEqual(sorted(record.moves), ["c7c5", "e7e5"])
+
+    def record_keys(self, db):
+        return [k for k, v in db.db.RangeIter(key_from=leveldict.RECORD_PREFIX, key_to=leveldict.POSTINGS_PREFIX)]
+
+    def test_max_ply_and_min_frequency(self):
+        full = self.build_index("full.db")
+        limited = self.build_index("limited.db", memory_budget=1, max_ply=3, min_frequency=2)
+        self.assertEqual(limited.Get(pgn_index.INDEX_MAX_PLY, regular=True), "3")
+        self.assertEqual(limited.Get(pgn_index.INDEX_MIN_FREQUENCY, regular=True), "2")
+        self.assertEqual(full.Get(pgn_index.INDEX_MAX_PLY, regular=True), "0")
+        self.assertTrue(len(self.record_keys(limited)) < len(self.record_keys(full)))
+
+        board = chess.Board()
+        for san in ["e4", "c6", "d4"]:
+            self.assertSamePosition(full, limited, str(board.zobrist_hash()))
+            board.push_san(san)
+        # Ply 3 is past the limit
+        self.assertEqual(limited.get_position(str(board.zobrist_hash())), None)
+        self.assertEqual(list(limited.get_game_ids(str(board.zobrist_hash()))), [])
+        # Reached by a single game only
+        board = chess.Board()
+        board.push_san("d3")
+        self.assertEqual(full.get_position(str(board.zobrist_hash())).freq, 1)
+        self.assertEqual(limited.get_position(str(board.zobrist_hash())), None)
+
+        leveldb_path = os.path.join(self.tmp_dir, "parallel.db")
+        pgn_index.ParallelPgnIndexer(PGN_FILE, leveldb_path, processes=3, max_ply=3, min_frequency=2).index()
+        parallel = leveldict.PartitionedLevelDB(leveldb_path)
+        pgn_index.IndexCompactor(limited).compact()
+        pgn_index.IndexCompactor(parallel).compact()
+        self.assertEqual(self.record_keys(parallel), self.record_keys(limited))
+
+    def test_append_game_max_ply(self):
+        leveldb_path = os.path.join(self.tmp_dir, "append.db")
+        pgn_index.PgnIndexer(PGN_FILE, leveldb_path, max_ply=1).index()
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        game = chess.pgn.Game()
+        game.add_main_variation(chess.Move.from_uci("a2a3")).add_main_variation(chess.Move.from_uci("a7a6"))
+        pgn_index.PgnIndexer(PGN_FILE, leveldb_path).append_game(db.db, game, 1)
+        self.assertTrue("a2a3" in db.get_position(str(chess.Board().zobrist_hash())).moves)
+        board = chess.Board()
+        board.push_san("a3")
+        self.assertEqual(db.get_position(str(board.zobrist_hash())), None)
+
+    def test_bloom_filter(self):
+        db = self.build_index("bloom.db", memory_budget=1)
+        self.assertTrue(db.bloom_filter is not None)
+        for k in self.record_keys(db):
+            self.assertTrue(leveldict.split_position_key(k)[1] in db.bloom_filter)
+        missing = [h for h in range(1000) if h not in db.bloom_filter]
+        self.assertTrue(len(missing) > 950)
+
+        # Misses are answered without reading LevelDB
+        leveldb_db, db.db = db.db, None
+        self.assertEqual(db.get_position(str(missing[0])), None)
+        self.assertEqual(list(db.get_game_ids(str(missing[0]))), [])
+        db.db = leveldb_db
+
+        game = chess.pgn.Game()
+        game.add_main_variation(chess.Move.from_uci("a2a3")).add_main_variation(chess.Move.from_uci("h7h6"))
+        count = db.bloom_filter.count
+        # The open index gets the new positions without reloading its filter
+        pgn_index.PgnIndexer(PGN_FILE, db.path).append_game(db.db, game, 1, db)
+        board = chess.Board()
+        board.push_san("a3")
+        self.assertEqual(db.get_position(str(board.zobrist_hash())).freq, 1)
+        # The bits of the saved filter are set in place
+        saved = bloom_filter.BloomFilter.load(bloom_filter.bloom_filter_path(db.path))
+        self.assertEqual((saved.count, db.bloom_filter.count), (count + 2, count + 2))
+        self.assertEqual(saved.bits, db.bloom_filter.bits)
+
+    def test_structure_indexes(self):
+        db = self.build_index("structures.db", memory_budget=1)
+        board = chess.Board()
+        self.assertEqual(pgn_index.material_signature(board), "KQRRBBNNPPPPPPPPvKQRRBBNNPPPPPPPP")
+        self.assertEqual(db.get_material_games(pgn_index.material_signature(board)),
+                         [(g, 0) for g in range(6)])
+        self.assertEqual(db.get_pawn_structure_games(0xff00, 0xff000000000000), [(g, 0) for g in range(6)])
+        self.assertEqual(db.get_material_games("KvK"), [])
+        self.assertEqual(db.get_material_games(u"KQRRBBNNPPPPPPPPvKQRRBBNNPPPPPPPP"), [(g, 0) for g in range(6)])
+
+        with open(PGN_FILE) as pgn:
+            for game_num in range(6):
+                game = chess.pgn.read_game(pgn)
+                with open(PGN_FILE) as indexed_pgn:
+                    indexed_pgn.seek(int(db.Get("game_{0}_data".format(game_num), regular=True).split("|")[9]) - 1)
+                    self.assertEqual(pgn_index.game_structures(game),
+                                     pgn_index.read_indexed_game(indexed_pgn).structures)
+                for (prefix, name), ply in pgn_index.game_structures(game).items():
+                    self.assertTrue((game_num, ply) in db.get_structure_games(prefix, name))
+
+        leveldb_path = os.path.join(self.tmp_dir, "parallel.db")
+        pgn_index.ParallelPgnIndexer(PGN_FILE, leveldb_path, processes=3).index()
+        parallel = leveldict.PartitionedLevelDB(leveldb_path)
+        pgn_index.IndexCompactor(db).compact()
+        structures = pgn_index.game_structures(game)
+        for prefix, name in structures:
+            self.assertEqual(parallel.get_structure_games(prefix, name), db.get_structure_games(prefix, name))
+
+    def board_at(self, db, game_num, ply):
+        with open(PGN_FILE) as pgn:
+            pgn.seek(int(db.Get("game_{0}_data".format(game_num), regular=True).split("|")[9]) - 1)
+            node = chess.pgn.read_game(pgn)
+        board = node.board()
+        for i in range(ply):
+            node = node.variation(0)
+            board.push(node.move)
+        return board
+
+    def test_pattern_search(self):
+        self.assertEqual(pattern_search.parse_pattern("Nd5, pd6 !b@light"),
+                         [(1, 1 << 35, True), (6, 1 << 43, True), (8, pattern_search.BB_LIGHT_SQUARES, False)])
+        self.assertRaises(ValueError, pattern_search.parse_pattern, "Xd5")
+        self.assertRaises(ValueError, pattern_search.parse_pattern, "")
+
+        db = self.build_index("patterns.db", memory_budget=1, patterns=True)
+        store = db.pattern_store
+        self.assertEqual(store.num_games, 6)
+        self.assertEqual(store.search("Ke1,ke8,Pe2"), [(g, 0) for g in range(6)])
+        self.assertEqual(store.search("!K*"), [])
+
+        pattern = "Nf5,!b@dark"
+        matches = store.search(pattern)
+        self.assertEqual(matches, [(4, 77)])
+        for game_num, ply in matches:
+            board = self.board_at(db, game_num, ply)
+            self.assertEqual(board.piece_at(chess.F5), chess.Piece(chess.KNIGHT, chess.WHITE))
+            self.assertEqual(list(store.bitboards(game_num, ply)), pattern_search.board_bitboards(board))
+
+        rows = store.matching_rows(pattern_search.parse_pattern(pattern))
+        self.assertEqual(list(store.matching_rows_unvectorised(pattern_search.parse_pattern(pattern))), list(rows))
+        parallel_scan_rows = pattern_search.PARALLEL_SCAN_ROWS
+        pattern_search.PARALLEL_SCAN_ROWS = 1
+        try:
+            self.assertEqual(store.search(pattern, processes=3), matches)
+        finally:
+            pattern_search.PARALLEL_SCAN_ROWS = parallel_scan_rows
+
+        pgn_path = os.path.join(self.tmp_dir, "patterns.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "parallel.db")
+        pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=3, patterns=True).index()
+        parallel = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertEqual(parallel.pattern_store.search(pattern), matches)
+
+        game = chess.pgn.Game()
+        game.add_main_variation(chess.Move.from_uci("g1f3"))
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(parallel.db, game, 1)
+        parallel.reload_files()
+        self.assertEqual(parallel.pattern_store.search("Nf3,Nb1,ng8")[-1], (6, 1))
+
+    def test_compact(self):
+        single = self.build_index("single.db")
+        db = self.build_index("compact.db", memory_budget=1)
+        self.assertEqual(db.num_passes, "5")
+        self.assertTrue(pgn_index.IndexCompactor(db).compact() > 0)
+        self.assertEqual(db.num_passes, "0")
+        self.assertEqual(db.Get(pgn_index.INDEX_NUM_PASSES, regular=True), "0")
+
+        start_hash = str(chess.Board().zobrist_hash())
+        record_key = leveldict.position_key(leveldict.RECORD_PREFIX, start_hash)
+        self.assertEqual([k for k, v in db.db.RangeIter(key_from=leveldict.RECORD_PREFIX, key_to=leveldict.POSTINGS_PREFIX)],
+                         [k for k, v in single.db.RangeIter(key_from=leveldict.RECORD_PREFIX, key_to=leveldict.POSTINGS_PREFIX)])
+        self.assertEqual(db.Get(record_key, regular=True), single.Get(record_key, regular=True))
+        board = chess.Board()
+        for san in ["e4", "c6", "d4"]:
+            board.push_san(san)
+            self.assertSamePosition(single, db, str(board.zobrist_hash()))
+        self.assertEqual(db.get_token_game_ids("kasparov"), single.get_token_game_ids("kasparov"))
+        # Nothing left to merge
+        self.assertEqual(pgn_index.IndexCompactor(db).compact(), 0)
+
+    def test_compact_legacy_index(self):
+        legacy = self.build_legacy_index()
+        pgn_index.IndexCompactor(legacy).compact()
+        self.assertEqual(list(legacy.db.RangeIter(key_from="42_p_1", key_to="42_p_9")), [])
+        self.assertEqual(legacy.Get("42_freq", num=True), 3)
+        record = legacy.get_position("42")
+        self.assertEqual((record.freq, record.white_score, record.draws), (3, 1, 1))
+        self.assertEqual(sorted(record.moves), ["e2e4", "g1f3"])
+        self.assertEqual(list(legacy.get_game_ids("42")), [1, 2, 7])
+
+    def test_version_1_records(self):
+        value = leveldict.RECORD_HEADER.pack(1, 5, 1, 2, 4, 2) + struct.pack('<2H', leveldict.encode_move("e2e4"),
+                                                                         leveldict.encode_move("d2d4"))
+        record = leveldict.decode_record(value)
+        self.assertEqual((record.freq, record.white_score, record.draws, record.num_games), (5, 1, 2, 4))
+        self.assertEqual(record.moves, ["e2e4", "d2d4"])
+        self.assertEqual(record.move_stats, {})
+
+    def test_move_encoding(self):
+        for uci in ["e2e4", "a7a8q", "h2h1n", "g8f6"]:
+            self.assertEqual(leveldict.decode_move(leveldict.encode_move(uci)), uci)
+        # Polyglot castling
+        self.assertEqual(leveldict.decode_move(leveldict.encode_move("e1h1")), "e1g1")
+
+    def test_game_offsets(self):
+        db = self.build_index("offsets.db")
+        with open(PGN_FILE) as pgn:
+            offsets = list(chess.pgn.scan_offsets(pgn))
+        for game_num, offset in enumerate(offsets):
+            record = db.Get("game_{0}_data".format(game_num), regular=True).split("|")
+            self.assertEqual(int(record[9]), offset + 1)
+
+    def test_token_index(self):
+        db = self.build_index("tokens.db", memory_budget=1)
+        self.assertTrue(db.has_token_index)
+        self.assertEqual(leveldict.header_tokens("Deep Blue (Computer)"), ["deep", "blue", "computer"])
+        self.assertEqual(list(db.get_token_game_ids("kasparov")), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(db.get_token_game_ids("Kasp DEEP")), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(db.get_token_game_ids("kasparov nobody")), [])
+        self.assertEqual(db.get_token_game_ids("-"), None)
+        self.assertEqual(list(db.get_token_game_ids(u"Kasp deep")), [0, 1, 2, 3, 4, 5])
+        # Non-ASCII letters are not part of words, in the index or the filter
+        self.assertEqual(list(db.get_token_game_ids(u"kasp \xe9")), [0, 1, 2, 3, 4, 5])
+
+        board = chess.Board()
+        board.push_san("e4")
+        game_ids = db.get_game_ids(str(board.zobrist_hash()))
+        self.assertEqual(list(leveldict.intersect_postings(game_ids, db.get_token_game_ids("ibm"))), [1, 3, 5])
+
+    def test_token_index_parallel_and_append(self):
+        single = self.build_index("single.db")
+        pgn_path = os.path.join(self.tmp_dir, "tokens.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "tokens.db")
+        pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=3, memory_budget=3).index()
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        for text in ["garry", "deep blue", "new york"]:
+            self.assertEqual(db.get_token_game_ids(text), single.get_token_game_ids(text))
+
+        game = chess.pgn.Game()
+        game.headers["White"] = "Garry Appended"
+        offset = os.path.getsize(pgn_path)
+        with open(pgn_path, "a") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, offset + 1)
+        self.assertEqual(list(db.get_token_game_ids("garry")), [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(db.get_token_game_ids("append")), [6])
+
+    def interrupted_build(self, indexer):
+        try:
+            indexer.index()
+        except Interrupted:
+            pass
+        sys.exc_clear()
+
+    def test_resume_interrupted_build(self):
+        single = self.build_index("single.db")
+        leveldb_path = os.path.join(self.tmp_dir, "resume.db")
+        self.interrupted_build(InterruptedPgnIndexer(PGN_FILE, leveldb_path, memory_budget=1))
+        self.assertFalse(pgn_index.index_is_complete(leveldb_path))
+
+        indexer = pgn_index.PgnIndexer(PGN_FILE, leveldb_path)
+        self.assertEqual(indexer.index(), 6)
+        self.assertTrue(pgn_index.index_is_complete(leveldb_path))
+        # The partitions are cut with the budget of the interrupted build
+        self.assertEqual(indexer.memory_budget, 1)
+        stats = indexer.progress.snapshot()
+        self.assertEqual(stats["games"], 6)
+        self.assertEqual(stats["bytes"], os.path.getsize(PGN_FILE))
+        self.assertTrue(stats["done"])
+
+        resumed = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertEqual(resumed.num_passes, "5")
+        self.assertSameHeaders(resumed)
+        board = chess.Board()
+        for san in ["e4", "c6", "d4"]:
+            self.assertSamePosition(single, resumed, str(board.zobrist_hash()))
+            board.push_san(san)
+        self.assertEqual(resumed.get_token_game_ids("garry"), single.get_token_game_ids("garry"))
+
+    def test_resume_killed_build(self):
+        leveldb_path = os.path.join(self.tmp_dir, "killed.db")
+        process = multiprocessing.Process(target=killed_build, args=(PGN_FILE, leveldb_path))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 1)
+
+        self.assertEqual(pgn_index.PgnIndexer(PGN_FILE, leveldb_path).index(), 6)
+        resumed = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameHeaders(resumed)
+        self.assertEqual(resumed.header_store.value("offset", 0), "1")
+
+    def test_resume_interrupted_parallel_build(self):
+        single = self.build_index("single.db")
+        leveldb_path = os.path.join(self.tmp_dir, "resume.db")
+        self.interrupted_build(InterruptedParallelPgnIndexer(PGN_FILE, leveldb_path, processes=3, memory_budget=3))
+        self.assertFalse(pgn_index.index_is_complete(leveldb_path))
+
+        indexer = pgn_index.ParallelPgnIndexer(PGN_FILE, leveldb_path, processes=2)
+        self.assertEqual(indexer.index(), 6)
+        self.assertEqual(indexer.progress.snapshot()["games"], 6)
+        self.assertFalse(os.path.exists(indexer.chunk_path(2)))
+        resumed = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameHeaders(resumed)
+        for game_num in range(6):
+            key = "game_{0}_data".format(game_num)
+            self.assertEqual(resumed.Get(key, regular=True), single.Get(key, regular=True))
+        self.assertSamePosition(single, resumed, str(chess.Board().zobrist_hash()))
+
+    def test_resume_with_other_process_count(self):
+        single = self.build_index("single.db")
+        leveldb_path = os.path.join(self.tmp_dir, "parallel.db")
+        self.interrupted_build(InterruptedParallelPgnIndexer(PGN_FILE, leveldb_path, processes=3, memory_budget=3))
+        self.assertRaises(ValueError, pgn_index.PgnIndexer(PGN_FILE, leveldb_path).index)
+        indexer = pgn_index.create_indexer(PGN_FILE, leveldb_path, 1)
+        self.assertIsInstance(indexer, pgn_index.ParallelPgnIndexer)
+        self.assertEqual(indexer.index(), 6)
+        resumed = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameHeaders(resumed)
+        self.assertSamePosition(single, resumed, str(chess.Board().zobrist_hash()))
+
+        leveldb_path = os.path.join(self.tmp_dir, "single_pass.db")
+        self.interrupted_build(InterruptedPgnIndexer(PGN_FILE, leveldb_path, memory_budget=1))
+        self.assertRaises(ValueError, pgn_index.ParallelPgnIndexer(PGN_FILE, leveldb_path, processes=2).index)
+        indexer = pgn_index.create_indexer(PGN_FILE, leveldb_path, 4)
+        self.assertNotIsInstance(indexer, pgn_index.ParallelPgnIndexer)
+        self.assertEqual(indexer.index(), 6)
+        self.assertSameHeaders(leveldict.PartitionedLevelDB(leveldb_path))
+
+    def assertSameHeaders(self, db):
+        store = db.header_store
+        self.assertEqual(len(store), int(db.Get(pgn_index.INDEX_TOTAL_GAME_COUNT, regular=True)))
+        for game_num in range(len(store)):
+            record = db.Get("game_{0}_data".format(game_num), regular=True).split("|")
+            self.assertEqual(store.fields(game_num)[:10], record[:10])
+
+    def test_header_store(self):
+        db = self.build_index("headers.db")
+        self.assertSameHeaders(db)
+        store = db.header_store
+        self.assertEqual(store.value("white", 0), "Garry Kasparov")
+        self.assertEqual(store.value("date", 0), "1997.??.??")
+        self.assertEqual(store.value("result", 2), "1/2-1/2")
+
+        game_ids = db.get_game_ids(str(chess.Board().zobrist_hash()))
+        self.assertEqual(list(store.filter(game_ids, ["Deep Blue", "Kasparov"])), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(store.filter(game_ids, ["Nobody"])), [])
+        self.assertEqual(store.num_sorted, store.num_strings)
+        # Word prefixes of any case, like the token index
+        self.assertEqual(list(store.filter(game_ids, [u"deep bl", "KASP"])), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(store.filter(game_ids, ["eep"])), [])
+        self.assertEqual(list(store.sort(game_ids, "result")), [0, 1, 5, 2, 3, 4])
+        by_black = sorted(game_ids, key=lambda g: store.value("black", g), reverse=True)
+        self.assertEqual([store.value("black", g) for g in store.sort(game_ids, "black", asc=False)],
+                         [store.value("black", g) for g in by_black])
+        self.assertEqual(list(store.sort(game_ids, "id", asc=False)), [5, 4, 3, 2, 1, 0])
+
+    def test_header_store_elo(self):
+        path = os.path.join(self.tmp_dir, "elo")
+        writer = game_store.HeaderStoreWriter(path)
+        for white_elo, black_elo in [(-5, 2700), ("2700x", 70000)]:
+            writer.add(["White", white_elo, "Black", black_elo, "1-0", "2000.??.??", "?", "?", "*", 0])
+        writer.close()
+        store = game_store.HeaderStore(path)
+        self.assertEqual([store.value("whiteelo", g) for g in range(2)], ["0", "0"])
+        self.assertEqual([store.value("blackelo", g) for g in range(2)], ["2700", "65535"])
+
+    def test_header_store_sort_multi(self):
+        db = self.build_index("sort.db")
+        game_ids = list(db.get_game_ids(str(chess.Board().zobrist_hash())))
+        # Draws first, then Deep Blue before Kasparov, then the latest game first
+        expected = [3, 4, 2, 5, 1, 0]
+        criteria = [("result", False), ("white", True), ("id", False)]
+
+        def check(store):
+            self.assertEqual([int(g) for g in store.sort_multi(game_ids, criteria)], expected)
+            for limit in [0, 1, 2, 5, 6, 10]:
+                self.assertEqual([int(g) for g in store.sort_multi(game_ids, criteria, limit)], expected[:limit])
+            self.assertEqual(list(store.sort_multi(game_ids, [])), game_ids)
+
+        check(db.header_store)
+        numpy = game_store.numpy
+        try:
+            game_store.numpy = None
+            check(game_store.HeaderStore.open(db.path))
+        finally:
+            game_store.numpy = numpy
+
+    def test_header_store_parallel_and_append(self):
+        pgn_path = os.path.join(self.tmp_dir, "headers.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "headers.db")
+        pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=3).index()
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameHeaders(db)
+
+        game = chess.pgn.Game()
+        game.headers["White"] = "Appended"
+        game.headers["Date"] = "2001.??.??"
+        offset = os.path.getsize(pgn_path)
+        with open(pgn_path, "a") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, offset + 1)
+        db.reload_files()
+        self.assertSameHeaders(db)
+        self.assertEqual(db.header_store.value("white", 6), "Appended")
+        self.assertEqual(db.header_store.value("date", 6), "2001.??.??")
+
+        # The appended strings are past the string tables
+        store = db.header_store
+        self.assertLess(store.num_sorted, store.num_strings)
+        game_ids = range(7)
+        self.assertEqual(list(store.filter(game_ids, ["app"])), [6])
+        self.assertEqual(list(store.filter(game_ids, ["kasparov"])), range(6))
+        for name in ["white", "black", "event"]:
+            by_value = sorted(game_ids, key=lambda g: (store.value(name, g), g))
+            self.assertEqual([int(g) for g in store.sort_multi(game_ids, [(name, True), ("id", True)])], by_value)
+
+    def repeated_pgn(self, copies=2):
+        """A PGN file holding every game of the test file copies times"""
+        pgn_path = os.path.join(self.tmp_dir, "repeated{0}.pgn".format(copies))
+        with open(PGN_FILE) as f:
+            text = f.read().strip() + "\n\n"
+        with open(pgn_path, "w") as f:
+            f.write(text * copies)
+        return pgn_path
+
+    def read_report(self, leveldb_path):
+        with open(os.path.join(leveldb_path, "duplicates.txt")) as f:
+            return [line.rstrip("\n").split("\t") for line in f]
+
+    def test_skip_duplicates(self):
+        single = self.build_index("single.db")
+        pgn_path = self.repeated_pgn()
+        leveldb_path = os.path.join(self.tmp_dir, "skip.db")
+        indexer = pgn_index.PgnIndexer(pgn_path, leveldb_path, memory_budget=1, duplicates=pgn_index.DUPLICATES_SKIP)
+        self.assertEqual(indexer.index(), 6)
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertEqual(db.Get(pgn_index.INDEX_DUPLICATE_GAMES, regular=True), "6")
+        self.assertEqual(indexer.progress.snapshot()["bytes"], os.path.getsize(pgn_path))
+        start_hash = str(chess.Board().zobrist_hash())
+        self.assertSamePosition(single, db, start_hash)
+
+        report = self.read_report(leveldb_path)
+        self.assertEqual([r[1:3] for r in report], [[str(g), "skip"] for g in range(6)])
+        self.assertEqual(report[0][3], "Garry Kasparov")
+        self.assertEqual(int(report[0][0]), os.path.getsize(pgn_path) / 2 + 1)
+
+    def test_flag_duplicates_parallel(self):
+        pgn_path = self.repeated_pgn()
+        leveldb_path = os.path.join(self.tmp_dir, "flag.db")
+        indexer = pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=2,
+                                               duplicates=pgn_index.DUPLICATES_FLAG)
+        self.assertEqual(indexer.index(), 12)
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertEqual(db.Get(pgn_index.INDEX_DUPLICATE_GAMES, regular=True), "6")
+        report = self.read_report(leveldb_path)
+        self.assertEqual(sorted(int(r[1]) for r in report), range(6))
+        self.assertEqual(set(r[2] for r in report), set(["flag"]))
+        for offset, original, action, white, black, date in report:
+            self.assertEqual(db.header_store.value("white", int(original)), white)
+            self.assertEqual(db.header_store.value("date", int(original)), date)
+
+        # Appended games are indexed even when they repeat a game, but their fingerprint is kept
+        with open(PGN_FILE) as pgn:
+            game = chess.pgn.read_game(pgn)
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, os.path.getsize(pgn_path) + 1)
+        self.assertEqual(os.path.getsize(os.path.join(leveldb_path, "fingerprints")), 13 * 8)
+
+    def test_skip_duplicates_parallel(self):
+        single = self.build_index("single.db")
+        pgn_path = self.repeated_pgn()
+        start_hash = str(chess.Board().zobrist_hash())
+        for processes in (2, 3):
+            leveldb_path = os.path.join(self.tmp_dir, "skip{0}.db".format(processes))
+            indexer = pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=processes,
+                                                   duplicates=pgn_index.DUPLICATES_SKIP)
+            # The repeats of games of an earlier chunk are skipped too
+            self.assertEqual(indexer.index(), 6)
+            db = leveldict.PartitionedLevelDB(leveldb_path)
+            self.assertEqual(db.Get(pgn_index.INDEX_DUPLICATE_GAMES, regular=True), "6")
+            self.assertEqual(len(db.game_store), 6)
+            self.assertSamePosition(single, db, start_hash)
+            report = self.read_report(leveldb_path)
+            self.assertEqual(sorted(int(r[1]) for r in report), range(6))
+            self.assertEqual(set(r[2] for r in report), set(["skip"]))
+            for offset, original, action, white, black, date in report:
+                self.assertTrue(int(offset) > os.path.getsize(pgn_path) / 2)
+                self.assertEqual(db.header_store.value("white", int(original)), white)
+                self.assertEqual(db.header_store.value("date", int(original)), date)
+            del db
+
+    def test_duplicate_reports_parallel(self):
+        # The second chunk repeats games of the first one, and some of them twice
+        pgn_path = self.repeated_pgn(3)
+        for duplicates in (pgn_index.DUPLICATES_FLAG, pgn_index.DUPLICATES_SKIP):
+            leveldb_path = os.path.join(self.tmp_dir, "{0}.db".format(duplicates))
+            num_games = pgn_index.PgnIndexer(pgn_path, leveldb_path, duplicates=duplicates).index()
+            db = leveldict.PartitionedLevelDB(leveldb_path)
+            num_duplicates = db.Get(pgn_index.INDEX_DUPLICATE_GAMES, regular=True)
+            self.assertEqual(num_duplicates, "12")
+            report = self.read_report(leveldb_path)
+            del db
+            for processes in (2, 3):
+                parallel_path = os.path.join(self.tmp_dir, "{0}{1}.db".format(duplicates, processes))
+                indexer = pgn_index.ParallelPgnIndexer(pgn_path, parallel_path, processes=processes,
+                                                       duplicates=duplicates)
+                self.assertEqual(indexer.index(), num_games)
+                db = leveldict.PartitionedLevelDB(parallel_path)
+                self.assertEqual(db.Get(pgn_index.INDEX_DUPLICATE_GAMES, regular=True), num_duplicates)
+                self.assertEqual(self.read_report(parallel_path), report)
+                del db
+
+    def assertSameGames(self, db, pgn_path):
+        with open(pgn_path) as pgn:
+            offsets = list(chess.pgn.scan_offsets(pgn))
+        self.assertEqual(len(db.game_store), len(offsets))
+        with open(pgn_path) as pgn:
+            for game_id, offset in enumerate(offsets):
+                pgn.seek(offset)
+                expected = chess.pgn.read_game(pgn)
+                game = chess.pgn.read_game(db.game_store.game_file(game_id))
+                self.assertEqual(game.headers, expected.headers)
+                self.assertEqual(list(game.main_line()), list(expected.main_line()))
+
+    def test_game_store(self):
+        db = self.build_index("games.db", memory_budget=1)
+        self.assertSameGames(db, PGN_FILE)
+        self.assertEqual(db.game_store.game_text(6), None)
+
+        # The text around a game and the game itself make up the whole file
+        start, end = db.game_store.game_range(2)
+        out = StringIO()
+        db.game_store.copy_text(out, 0, start)
+        out.write(db.game_store.game_text(2))
+        db.game_store.copy_text(out, end)
+        with open(PGN_FILE, "rb") as pgn:
+            self.assertEqual(out.getvalue(), pgn.read())
+
+    def test_batch_game_fetch(self):
+        db = self.build_index("batch.db")
+        store = db.game_store
+        # Game 7 is not in the index
+        game_ids = [4, 1, 7, 5, 0]
+        self.assertEqual(store.file_order(game_ids), [0, 1, 4, 5])
+        games = list(store.iter_games(game_ids))
+        self.assertEqual([g for g, game in games], [0, 1, 4, 5])
+        for game_id, game in games:
+            self.assertEqual(game.headers["Date"], db.header_store.value("date", game_id))
+            self.assertEqual(list(game.main_line()), db.move_store.moves(game_id))
+
+        out = StringIO()
+        self.assertEqual(store.export(range(6)[::-1], out), 6)
+        with open(PGN_FILE) as pgn:
+            expected = [game.headers for game in iter(lambda: chess.pgn.read_game(pgn), None)]
+        out.seek(0)
+        self.assertEqual([game.headers for game in iter(lambda: chess.pgn.read_game(out), None)], expected)
+
+    def test_game_exporter(self):
+        db = self.build_index("export.db")
+        out_path = os.path.join(self.tmp_dir, "export.pgn")
+        exporter = game_store.GameExporter(db.game_store, [3, 0, 9], out_path)
+        exporter.start().join()
+        stats = exporter.snapshot()
+        self.assertEqual((stats["games"], stats["done"], stats["cancelled"]), (2, True, False))
+        with open(out_path) as pgn:
+            self.assertEqual(list(chess.pgn.read_game(pgn).main_line()), db.move_store.moves(3))
+            self.assertEqual(list(chess.pgn.read_game(pgn).main_line()), db.move_store.moves(0))
+            self.assertEqual(chess.pgn.read_game(pgn), None)
+
+        exporter = game_store.GameExporter(db.game_store, range(6), out_path, append=True, in_file_order=True)
+        self.assertEqual(exporter.export(), 6)
+        with open(out_path) as pgn:
+            self.assertEqual(len(list(iter(lambda: chess.pgn.read_game(pgn), None))), 8)
+
+        # A cancelled export leaves the file as it was
+        size = os.path.getsize(out_path)
+        for append in [True, False]:
+            exporter = game_store.GameExporter(db.game_store, range(6), out_path, append=append)
+            exporter.cancel()
+            self.assertEqual(exporter.export(), 0)
+            self.assertTrue(exporter.snapshot()["cancelled"])
+            self.assertEqual(os.path.getsize(out_path), size)
+        self.assertFalse(os.path.exists(out_path + ".tmp"))
+
+        # A failed export is done, so the next one can start
+        exporter = game_store.GameExporter(db.game_store, range(6), os.path.join(self.tmp_dir, "missing", "x.pgn"))
+        self.assertRaises(IOError, exporter.export)
+        stats = exporter.snapshot()
+        self.assertTrue(stats["done"])
+        self.assertTrue(isinstance(stats["error"], IOError))
+        self.assertTrue(str(exporter).startswith("export failed"))
+
+    def test_game_store_parallel_and_append(self):
+        pgn_path = os.path.join(self.tmp_dir, "games.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "games.db")
+        pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=3).index()
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameGames(db, pgn_path)
+
+        with open(PGN_FILE) as pgn:
+            game = chess.pgn.read_game(pgn)
+        offset = os.path.getsize(pgn_path)
+        with open(pgn_path, "a") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, offset + 1)
+        self.assertEqual(db.game_store.game_text(6), None)
+        db.reload_files()
+        self.assertSameGames(db, pgn_path)
+
+    def test_compressed_pgn(self):
+        with open(PGN_FILE, "rb") as pgn:
+            text = pgn.read()
+        plain = self.build_index("plain.db")
+        for kind in (compressed_pgn.GZIP, compressed_pgn.BZIP2):
+            pgn_path = os.path.join(self.tmp_dir, "games.pgn." + kind)
+            # One member per game
+            compressed_pgn.compress_pgn(PGN_FILE, pgn_path, kind, member_size=1)
+            self.assertEqual(compressed_pgn.compression(pgn_path), kind)
+            with compressed_pgn.CompressedPgnReader(pgn_path, spacing=1) as reader:
+                self.assertEqual(reader.read(), text)
+                seek_points = reader.index_seek_points()
+            self.assertEqual(len(seek_points), 7)
+            self.assertEqual(seek_points[-1], (os.path.getsize(pgn_path), len(text)))
+            with compressed_pgn.CompressedPgnReader(pgn_path, seek_points) as reader:
+                for start, end in [(900, 1200), (10, 50), (len(text) - 5, len(text) + 5), (0, 3)]:
+                    reader.seek(start)
+                    self.assertEqual(reader.read(end - start), text[start:end])
+
+            for processes in (1, 3):
+                leveldb_path = os.path.join(self.tmp_dir, "{0}{1}.db".format(kind, processes))
+                if processes > 1:
+                    pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=processes).index()
+                else:
+                    pgn_index.PgnIndexer(pgn_path, leveldb_path).index()
+                db = leveldict.PartitionedLevelDB(leveldb_path)
+                self.assertEqual(db.seek_points[-1], (os.path.getsize(pgn_path), len(text)))
+                self.assertSameGames(db, PGN_FILE)
+                self.assertSamePosition(db, plain, chess.Board().zobrist_hash())
+
+            with open(PGN_FILE) as pgn:
+                game = chess.pgn.read_game(pgn)
+            game_text = StringIO()
+            game.accept(chess.pgn.FileExporter(game_text))
+            offset = compressed_pgn.pgn_size(pgn_path, db.seek_points)
+            compressed_pgn.append_pgn_text(pgn_path, game_text.getvalue())
+            pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, offset + 1, db)
+            self.assertEqual(db.seek_points[-1], (os.path.getsize(pgn_path), len(text) + len(game_text.getvalue())))
+            self.assertEqual(compressed_pgn.read_seek_points(leveldb_path), db.seek_points)
+            self.assertEqual(db.game_store.game_text(6), game_text.getvalue())
+            out = StringIO()
+            db.game_store.copy_text(out, 10)
+            self.assertEqual(out.getvalue(), text[10:] + game_text.getvalue())
+
+    def assertSameMoves(self, db, pgn_path):
+        with open(pgn_path) as pgn:
+            games = []
+            while True:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                games.append(game)
+        self.assertEqual(len(db.move_store), len(games))
+        for game_id, game in enumerate(games):
+            self.assertEqual(db.move_store.moves(game_id), list(game.main_line()))
+
+    def test_move_store(self):
+        db = self.build_index("moves.db", memory_budget=1)
+        # Opened on first use only
+        self.assertEqual(db.opened_move_store, None)
+        self.assertSameMoves(db, PGN_FILE)
+        board = chess.Board()
+        for ply, move in db.move_store.replay(0, board):
+            self.assertTrue(board.is_legal(move))
+        with open(PGN_FILE) as pgn:
+            self.assertEqual(board.fen(), chess.pgn.read_game(pgn).end().board().fen())
+
+        for uci in ["e1g1", "e1h1", "a7a8q", "b2a1n", "h7h8r"]:
+            move = chess.Move.from_uci(uci)
+            self.assertEqual(move_store.decode_move(move_store.encode_move(move)), move)
+        self.assertEqual(move_store.encode_move(chess.Move.from_uci("a7a8q")), leveldict.encode_move("a7a8q"))
+
+    def test_move_store_parallel_and_append(self):
+        pgn_path = os.path.join(self.tmp_dir, "moves.pgn")
+        shutil.copyfile(PGN_FILE, pgn_path)
+        leveldb_path = os.path.join(self.tmp_dir, "moves.db")
+        pgn_index.ParallelPgnIndexer(pgn_path, leveldb_path, processes=3).index()
+        db = leveldict.PartitionedLevelDB(leveldb_path)
+        self.assertSameMoves(db, pgn_path)
+
+        with open(PGN_FILE) as pgn:
+            game = chess.pgn.read_game(pgn)
+        offset = os.path.getsize(pgn_path)
+        with open(pgn_path, "a") as pgn:
+            game.accept(chess.pgn.FileExporter(pgn))
+        pgn_index.PgnIndexer(pgn_path, leveldb_path).append_game(db.db, game, offset + 1, db)
+        self.assertSameMoves(db, pgn_path)
+
+
+if __name__ == '__main__':
+    unittest.main()